@@ -0,0 +1,137 @@
+"""
+Accrued return of investment subscriptions.
+
+A subscription earns its daily return (amount * rate / 100, rounded
+half-even to a minor unit) once for every calendar day after the day it
+started, for at most its plan's duration_days. total_return holds what was
+earned up to accrued_on (the start day when unset); the return to date is
+that plus the daily return for every day since. It is computed here both
+in Python and as an SQL expression, which agree to the minor unit.
+
+With ACCRUAL_MODE 'eager' the daily job stores the return to date on every
+active subscription. With 'lazy' reads compute it, and it is only stored
+when a subscription settles or its plan's rate or duration changes.
+"""
+from django.conf import settings
+from django.db.models import (BigIntegerField, Case, DateField, ExpressionWrapper, F, Func,
+                              Value, When)
+from django.db.models.functions import Cast, Coalesce, Greatest, Least, Mod, Round, TruncDate
+from django.db.models.lookups import Exact, GreaterThan
+from django.utils import timezone
+
+from .money import MoneyField, percent_of, to_minor
+
+EAGER = 'eager'
+LAZY = 'lazy'
+
+
+def is_lazy():
+    return settings.ACCRUAL_MODE == LAZY
+
+
+def accrual_day(at=None):
+    # Returns accrue per calendar day in the current time zone
+    return timezone.localdate(at or timezone.now())
+
+
+def elapsed_days(start_day, day, duration_days):
+    return min(max((day - start_day).days, 0), duration_days)
+
+
+def accrued_minor(amount, rate, subscription_date, duration_days, total_return=0,
+                  accrued_on=None, at=None):
+    """Return to date in minor units; amounts are in major units."""
+    start_day = timezone.localdate(subscription_date)
+    days = (elapsed_days(start_day, accrual_day(at), duration_days)
+            - elapsed_days(start_day, accrued_on or start_day, duration_days))
+    return to_minor(total_return) + percent_of(to_minor(amount), rate) * days
+
+
+class DaysBetween(Func):
+    # Whole days from date `start` to date `end`
+    output_field = BigIntegerField()
+
+    def __init__(self, start, end):
+        super().__init__(end, start)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        # PostgreSQL: date - date is a day count
+        return super().as_sql(compiler, connection, template='(%(expressions)s)',
+                              arg_joiner=' - ', **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection,
+                              template='CAST(julianday(%(expressions)s) AS INTEGER)',
+                              arg_joiner=') - julianday(', **extra_context)
+
+
+def integer(expression):
+    # Every term is a 64-bit integer, so the types of the mixed
+    # expressions below resolve
+    if isinstance(expression, int):
+        return Value(expression, output_field=BigIntegerField())
+    return ExpressionWrapper(expression, output_field=BigIntegerField())
+
+
+def accrued_minor_expression(at=None, rate_hundredths=None, duration_days=None):
+    """
+    accrued_minor() as an SQL expression over InvestmentSubscription rows.
+    The plan's rate (in hundredths of a percent) and duration are read
+    through the join unless given as ints, which update() requires.
+    """
+    if rate_hundredths is None:
+        rate_hundredths = Cast(
+            Round(F('investment_plan__daily_return_rate') * 100), BigIntegerField())
+    if duration_days is None:
+        duration_days = Cast('investment_plan__duration_days', BigIntegerField())
+    rate_hundredths, duration_days = integer(rate_hundredths), integer(duration_days)
+    start_day = TruncDate('subscription_date')
+
+    def elapsed(day):
+        return Least(Greatest(DaysBetween(start_day, day), integer(0)), duration_days)
+
+    # percent_of() in SQL: round half-even on the remainder of the division
+    product = integer(Cast('amount', BigIntegerField()) * rate_hundredths)
+    quotient = integer(product / integer(10000))
+    twice_remainder = integer(Mod(product, integer(10000)) * integer(2))
+    daily = integer(quotient + Case(
+        When(GreaterThan(twice_remainder, 10000), then=integer(1)),
+        When(Exact(twice_remainder, 10000), then=Mod(quotient, integer(2))),
+        default=integer(0), output_field=BigIntegerField()))
+    today = Value(accrual_day(at), output_field=DateField())
+    days = integer(elapsed(today) - elapsed(Coalesce('accrued_on', start_day)))
+    return integer(Cast('total_return', BigIntegerField()) + daily * days)
+
+
+def accrued_return_expression(at=None):
+    """Return to date of each subscription; the stored one once settled."""
+    return Case(
+        When(settled=True, then=F('total_return')),
+        default=ExpressionWrapper(accrued_minor_expression(at), output_field=MoneyField()),
+        output_field=MoneyField())
+
+
+def with_accrued_return(queryset, at=None):
+    return queryset.annotate(accrued_return=accrued_return_expression(at))
+
+
+def materialize_accrued_returns(queryset, at=None, plan=None):
+    """
+    Store the return to date (as of `at`) of the unsettled subscriptions
+    in `queryset`, one UPDATE per plan. `plan` stands in for the plan of
+    every row, e.g. with the rate it had before a change. Returns the
+    number of rows updated.
+    """
+    unsettled = queryset.filter(settled=False)
+    if plan is not None:
+        plans = [(plan.pk, plan.daily_return_rate, plan.duration_days)]
+    else:
+        plans = set(unsettled.order_by().values_list(
+            'investment_plan', 'investment_plan__daily_return_rate',
+            'investment_plan__duration_days'))
+    updated = 0
+    for plan_id, rate, duration_days in plans:
+        updated += unsettled.filter(investment_plan=plan_id).update(
+            total_return=accrued_minor_expression(at, to_minor(rate, 2), duration_days),
+            accrued_on=accrual_day(at))
+    return updated
@@ -1,11 +1,190 @@
+import json
+
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.utils.functional import cached_property
 
+from .accrual import with_accrued_return
+from .jobs import enqueue
+from .ledger import settle_pending_transactions
 from .models import *
+from .sharding import LEDGER_MODELS, group_by_shard, is_sharded, shard_for_id, shards, use_shard
+
+# Below this many (estimated) rows an exact COUNT(*) is cheap enough
+EXACT_COUNT_THRESHOLD = 10000
+ACTION_BATCH_SIZE = 1000
+
+
+def estimated_count(queryset):
+    # Ask the PostgreSQL planner how many rows the changelist query returns
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is None or estimate < EXACT_COUNT_THRESHOLD:
+            return super().count
+        return estimate
+
+
+@admin.display(description='Wallet', ordering='wallet__title')
+def wallet_title(obj):
+    return obj.wallet.title
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    # Changelists of ledger rows show one shard at a time, the first unless
+    # another is picked
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shards()] if is_sharded() else []
+
+    def value(self):
+        value = super().value()
+        return value if value in shards() else shards()[0]
+
+    def choices(self, changelist):
+        # Skip "All"; there is no query over every shard
+        return list(super().choices(changelist))[1:]
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.value())
+
+
+class LedgerAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+    ordering = ('-id',)
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if self.model in LEDGER_MODELS:
+            return (ShardListFilter, *list_filter)
+        return list_filter
+
+    def get_object(self, request, object_id, from_field=None):
+        # Ledger ids say which shard their row is on
+        with use_shard(shard_for_id(object_id)):
+            return super().get_object(request, object_id, from_field)
+
+
+@admin.register(Wallet)
+class WalletAdmin(LedgerAdmin):
+    list_display = ('id', 'user', 'title', 'wallet_address', 'balance')
+    list_select_related = ('user',)
+    list_filter = ('title',)
+    raw_id_fields = ('user',)
+
+
+@admin.register(Transaction)
+class TransactionAdmin(LedgerAdmin):
+    list_display = ('id', 'date', 'user', wallet_title, 'transaction_type',
+                    'amount', 'status')
+    list_select_related = ('user', 'wallet')
+    list_filter = ('status', 'transaction_type', 'date')
+    raw_id_fields = ('user', 'wallet')
+    actions = ['approve_transactions', 'decline_transactions']
+
+    def settle(self, request, queryset, new_status):
+        settled = 0
+        ids = list(queryset.filter(status='pending').values_list('id', flat=True))
+        if len(ids) > ACTION_BATCH_SIZE:
+            # No job gets more ids than the settle API would accept
+            chunk = settings.TRANSACTION_SETTLE_MAX_IDS
+            jobs = [enqueue('transactions.settle',
+                            {'transaction_ids': ids[start:start + chunk], 'status': new_status},
+                            user=request.user)
+                    for start in range(0, len(ids), chunk)]
+            label = 'job' if len(jobs) == 1 else 'jobs'
+            self.message_user(request, f"Queued {label} {', '.join(str(job.id) for job in jobs)} "
+                                       f"to mark {len(ids)} transactions {new_status}.")
+            return
+        for shard, shard_ids in group_by_shard(ids).items():
+            with use_shard(shard):
+                for start in range(0, len(shard_ids), ACTION_BATCH_SIZE):
+                    with transaction.atomic(using=shard):
+                        settled += settle_pending_transactions(
+                            shard_ids[start:start + ACTION_BATCH_SIZE], new_status)
+        self.message_user(request, f"{settled} pending transactions marked {new_status}.")
+
+    @admin.action(description='Approve selected pending transactions')
+    def approve_transactions(self, request, queryset):
+        self.settle(request, queryset, 'done')
+
+    @admin.action(description='Decline selected pending transactions')
+    def decline_transactions(self, request, queryset):
+        self.settle(request, queryset, 'declined')
+
+
+@admin.register(ArchivedTransaction)
+class ArchivedTransactionAdmin(LedgerAdmin):
+    list_display = ('id', 'date', 'user', wallet_title, 'transaction_type',
+                    'amount', 'status')
+    list_select_related = ('user', 'wallet')
+    list_filter = ('status', 'transaction_type')
+    raw_id_fields = ('user', 'wallet')
+
+
+@admin.register(InvestmentSubscription)
+class InvestmentSubscriptionAdmin(LedgerAdmin):
+    list_display = ('id', 'user', 'investment_plan', 'amount', 'accrued_return',
+                    'subscription_date', 'end_date', 'settled')
+    list_select_related = ('user', 'investment_plan')
+    list_filter = ('investment_plan', 'settled', 'end_date')
+    raw_id_fields = ('user', 'wallet')
+
+    def get_queryset(self, request):
+        # Return to date whatever the accrual mode, computed in the query
+        return with_accrued_return(super().get_queryset(request))
+
+    @admin.display(description='Total return', ordering='accrued_return')
+    def accrued_return(self, obj):
+        return obj.accrued_return
+
+
+@admin.register(BalanceAuditEntry)
+class BalanceAuditEntryAdmin(LedgerAdmin):
+    list_display = ('id', 'created_at', 'wallet', 'user', 'actor',
+                    'balance_before', 'balance_after', 'source')
+    list_filter = ('source',)
+    raw_id_fields = ('wallet', 'user', 'actor')
+
+    # The trail is append-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Job)
+class JobAdmin(LedgerAdmin):
+    list_display = ('id', 'job_type', 'status', 'priority', 'attempts',
+                    'run_after', 'finished_at')
+    list_filter = ('status', 'job_type')
+    raw_id_fields = ('user',)
+
 
 # Register your models here.
 admin.site.register(CustomUser)
 admin.site.register(UserProfile)
-admin.site.register(Wallet)
-admin.site.register(Transaction)
 admin.site.register(Investment)
-admin.site.register(InvestmentSubscription)
@@ -6,6 +6,5 @@ class BaseConfig(AppConfig):
     name = 'base'
 
     def ready(self):
+        import base.checks
         import base.signals
-        from .apscheduler import start
-        start()
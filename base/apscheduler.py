@@ -1,52 +1,113 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.triggers.interval import IntervalTrigger
-from django.utils import timezone
-from .tasks import daily_update_total_return
-import logging
+"""
+Periodic jobs. Nothing here runs at import time: the scheduler, its
+SQLAlchemy job store and their imports are only built by `start()`, which
+is called by `manage.py run_scheduler` (or at app start-up when
+SCHEDULER_AUTOSTART is set, for single-process deployments).
+"""
 import atexit
+import logging
+
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
-# Check environment settings
-ENVIRONMENT = settings.ENVIRONMENT
-POSTGRES_LOCALLY = settings.POSTGRES_LOCALLY
-
-if ENVIRONMENT == 'production' or POSTGRES_LOCALLY:
-    database_url = settings.DATABASES['default']
-    if isinstance(database_url, dict):
-        from django.db.utils import ConnectionHandler
-        connections = ConnectionHandler(settings.DATABASES)
-        db_conn = connections['default']
-        database_url = f"postgresql://{db_conn.settings_dict['USER']}:{db_conn.settings_dict['PASSWORD']}@{db_conn.settings_dict['HOST']}:{db_conn.settings_dict['PORT']}/{db_conn.settings_dict['NAME']}"
-        print(database_url)
-
-    # Using PostgreSQL as job store
-    jobstores = {
-        'default': SQLAlchemyJobStore(url=database_url)
-    }
-    scheduler = BackgroundScheduler(jobstores=jobstores)
-else:
-    scheduler = BackgroundScheduler()
-
-
-def start():
-    global scheduler
-    if not scheduler.running:
-        scheduler.add_job(
-            daily_update_total_return,
-            trigger=IntervalTrigger(hours=20),
-            id='daily_update_total_return',
-            name='Update total return every day',
-            replace_existing=True,
-        )
-        scheduler.start()
-        logger.info("Scheduler started!")
-        atexit.register(lambda: scheduler.shutdown())
+scheduler = None
+
+
+def jobstore_url():
+    # SQLAlchemy URL for the default database; None keeps jobs in memory
+    if not (settings.ENVIRONMENT == 'production' or settings.POSTGRES_LOCALLY):
+        return None
+    from sqlalchemy.engine import URL
+
+    db = settings.DATABASES['default']
+    return URL.create(
+        'postgresql',
+        username=db.get('USER') or None,
+        password=db.get('PASSWORD') or None,
+        host=db.get('HOST') or None,
+        port=int(db['PORT']) if db.get('PORT') else None,
+        database=db.get('NAME') or None,
+    )
+
+
+def build_scheduler(blocking=False):
+    if blocking:
+        from apscheduler.schedulers.blocking import BlockingScheduler as Scheduler
     else:
+        from apscheduler.schedulers.background import BackgroundScheduler as Scheduler
+
+    url = jobstore_url()
+    if url is None:
+        return Scheduler()
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    return Scheduler(jobstores={'default': SQLAlchemyJobStore(url=url)})
+
+
+def add_jobs(scheduler):
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    from .tasks import (daily_update_total_return, nightly_archive_transactions,
+                        nightly_export_snapshots, nightly_roll_up_wallet_balances,
+                        settle_matured_investments)
+
+    scheduler.add_job(
+        daily_update_total_return,
+        trigger=IntervalTrigger(hours=20),
+        id='daily_update_total_return',
+        name='Update total return every day',
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        settle_matured_investments,
+        trigger=IntervalTrigger(hours=20),
+        id='settle_matured_investments',
+        name='Settle matured subscriptions every day',
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        nightly_archive_transactions,
+        trigger=IntervalTrigger(hours=24),
+        id='nightly_archive_transactions',
+        name='Archive settled transactions every night',
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        nightly_roll_up_wallet_balances,
+        trigger=IntervalTrigger(hours=24),
+        id='nightly_roll_up_wallet_balances',
+        name='Roll up wallet balances every night',
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        nightly_export_snapshots,
+        trigger=IntervalTrigger(hours=24),
+        id='nightly_export_snapshots',
+        name='Append settled rows to the analytics snapshots every night',
+        replace_existing=True,
+    )
+
+
+def start(blocking=False):
+    """
+    Build and start the scheduler once per process. With `blocking=True`
+    this only returns when the scheduler is shut down.
+    """
+    global scheduler
+    if scheduler is not None and scheduler.running:
         logger.info("Scheduler is already running.")
+        return scheduler
+
+    scheduler = build_scheduler(blocking)
+    add_jobs(scheduler)
+    logger.info("Scheduler started!")
+    if not blocking:
+        atexit.register(lambda: scheduler.shutdown())
+    scheduler.start()
+    return scheduler
 
 
-# Initialize the scheduler
-start()
+def autostart():
+    # Called by wsgi.py/asgi.py once the application is loaded
+    if settings.SCHEDULER_AUTOSTART:
+        start()
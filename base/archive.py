@@ -0,0 +1,67 @@
+import heapq
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .db_routers import use_primary
+from .sharding import ledger_db
+from .models import ArchivedTransaction, Transaction
+
+logger = logging.getLogger(__name__)
+
+SETTLED_STATUSES = ('done', 'declined')
+ARCHIVED_FIELDS = [
+    'id', 'transaction_type', 'user_id', 'wallet_id', 'wallet_address',
+    'amount', 'status', 'date',
+]
+
+
+def archive_settled_transactions(older_than_days=None, batch_size=None):
+    """
+    Move settled transactions older than `older_than_days` into the
+    ArchivedTransaction table, one batch per database transaction, and
+    return the number of rows moved.
+    """
+    if older_than_days is None:
+        older_than_days = settings.TRANSACTION_ARCHIVE_AFTER_DAYS
+    if batch_size is None:
+        batch_size = settings.TRANSACTION_ARCHIVE_BATCH_SIZE
+    cutoff = timezone.now() - timezone.timedelta(days=older_than_days)
+
+    moved = 0
+    with use_primary():
+        while True:
+            with transaction.atomic(using=ledger_db()):
+                rows = list(
+                    Transaction.objects
+                    .filter(status__in=SETTLED_STATUSES, date__lt=cutoff)
+                    .order_by('id')
+                    .values(*ARCHIVED_FIELDS)[:batch_size]
+                )
+                if not rows:
+                    break
+                ArchivedTransaction.objects.bulk_create(
+                    [ArchivedTransaction(**row) for row in rows],
+                    ignore_conflicts=True,
+                )
+                Transaction.objects.filter(
+                    id__in=[row['id'] for row in rows]).delete()
+            moved += len(rows)
+            logger.info(f"Archived {moved} settled transactions so far")
+    return moved
+
+
+def wants_full_history(request):
+    return request is not None and request.query_params.get('history') == 'all'
+
+
+def full_transaction_history(hot_queryset, archived_queryset):
+    # Both tables share the id sequence, so merging on id keeps the
+    # order the hot table alone would have produced.
+    return list(heapq.merge(
+        hot_queryset.order_by('id'),
+        archived_queryset.order_by('id'),
+        key=lambda row: row.id,
+    ))
@@ -0,0 +1,148 @@
+"""
+Audit trail of wallet balance changes.
+
+Changes are captured once their transaction commits, together with the
+actor and source of the active audit_context(), into an in-process buffer.
+A background thread writes the buffer to BalanceAuditEntry in batched
+inserts every AUDIT_FLUSH_SECONDS, or sooner once AUDIT_FLUSH_SIZE entries
+are waiting, and whatever is left is written at interpreter exit. The
+buffer holds at most AUDIT_BUFFER_SIZE entries; a change arriving at a
+full buffer writes everything synchronously instead.
+"""
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import BalanceAuditEntry
+from .sharding import ledger_db
+
+logger = logging.getLogger(__name__)
+
+# Who and what is changing balances right now: {'source': ..., 'actor': ...},
+# where either value may be a callable resolved at capture time
+_audit_context = ContextVar('audit_context', default=None)
+
+
+@contextmanager
+def audit_context(source, actor=None):
+    # Without an actor of its own, the enclosing context's actor is kept
+    if actor is None and _audit_context.get() is not None:
+        actor = _audit_context.get()['actor']
+    token = _audit_context.set({'source': source, 'actor': actor})
+    try:
+        yield
+    finally:
+        _audit_context.reset(token)
+
+
+def current_context():
+    context = _audit_context.get() or {'source': 'system', 'actor': None}
+    return tuple(value() if callable(value) else value
+                 for value in (context['source'], context['actor']))
+
+
+def write_entries(entries):
+    BalanceAuditEntry.objects.bulk_create(
+        [BalanceAuditEntry(**entry) for entry in entries],
+        batch_size=settings.AUDIT_FLUSH_SIZE)
+
+
+class AuditBuffer:
+    # Limits left as None are read from the AUDIT_* settings when needed
+    def __init__(self, max_size=None, flush_size=None, interval=None):
+        self._max_size = max_size
+        self._flush_size = flush_size
+        self._interval = interval
+        self._entries = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flusher = None
+
+    @property
+    def max_size(self):
+        return self._max_size or settings.AUDIT_BUFFER_SIZE
+
+    @property
+    def flush_size(self):
+        return self._flush_size or settings.AUDIT_FLUSH_SIZE
+
+    @property
+    def interval(self):
+        # 0 disables the flusher thread; entries then wait for flush()
+        return settings.AUDIT_FLUSH_SECONDS if self._interval is None else self._interval
+
+    def add(self, entry):
+        with self._lock:
+            if len(self._entries) < self.max_size:
+                self._entries.append(entry)
+                waiting, overflow = len(self._entries), None
+            else:
+                overflow, self._entries = self._entries + [entry], []
+        if overflow is not None:
+            # Full: write in this thread rather than grow or drop anything
+            write_entries(overflow)
+            return
+        self.start()
+        if waiting >= self.flush_size:
+            self._wake.set()
+
+    def flush(self):
+        """Write every buffered entry now; returns how many were written."""
+        with self._lock:
+            entries, self._entries = self._entries, []
+        if not entries:
+            return 0
+        try:
+            write_entries(entries)
+        except Exception:
+            logger.exception(f"Could not write {len(entries)} balance audit entries")
+            # Keep them for the next flush, as far as the bound allows
+            with self._lock:
+                kept = entries[:max(self.max_size - len(self._entries), 0)]
+                self._entries[:0] = kept
+            if len(kept) < len(entries):
+                logger.error(f"Dropped {len(entries) - len(kept)} balance audit entries")
+            return 0
+        return len(entries)
+
+    def start(self):
+        if self._flusher is not None or not self.interval:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self.run, name='audit-flusher', daemon=True)
+        atexit.register(self.flush)
+        self._flusher.start()
+
+    def run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            close_old_connections()
+            self.flush()
+
+
+audit_buffer = AuditBuffer()
+
+
+def audit_balance_change(wallet_id, user_id, before, after):
+    # Only changes that actually commit end up in the trail
+    source, actor = current_context()
+    entry = {
+        'wallet_id': wallet_id,
+        'user_id': user_id,
+        'actor_id': actor,
+        'balance_before': before,
+        'balance_after': after,
+        'source': source[:255],
+        'created_at': timezone.now(),
+    }
+    transaction.on_commit(lambda: audit_buffer.add(entry), using=ledger_db())
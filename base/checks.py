@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Cache backends whose entries other processes never see
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches, Tags.database)
+def check_replica_pin_cache(app_configs, **kwargs):
+    # ReplicaPinningMiddleware keeps the users who just wrote in the cache,
+    # and their next request may be served by any process
+    if not getattr(settings, 'DATABASE_REPLICAS', []):
+        return []
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        f"Read replicas need a cache shared by every process, not {backend}.",
+        hint="Set CACHE_URL to a shared cache (e.g. pymemcache://127.0.0.1:11211), or "
+             "unset DB_REPLICA_URLS.",
+        id='base.E001',
+    )]
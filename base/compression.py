@@ -0,0 +1,46 @@
+import gzip
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only API JSON and scripts. Compressed HTML would let an attacker who can
+# reflect text into an admin page recover its CSRF token from the response
+# sizes (BREACH); the API authenticates with bearer tokens, which a
+# cross-site request does not carry.
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'text/javascript')
+
+
+def accepted_encodings(request):
+    # Accept-Encoding: "gzip, deflate, br;q=0.9" -> {'gzip': 1.0, ...}
+    encodings = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if not coding:
+            continue
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        encodings[coding.strip().lower()] = quality
+    return encodings
+
+
+def choose_encoding(request):
+    encodings = accepted_encodings(request)
+    if brotli is not None and encodings.get('br', 0) > 0:
+        return 'br'
+    if encodings.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content, quality=settings.RESPONSE_COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=settings.RESPONSE_COMPRESSION_GZIP_LEVEL)
@@ -0,0 +1,118 @@
+"""
+Per-user cache of the dashboard (the UserProfileSerializer response).
+
+Entries are keyed by a per-user version which every write to the user's
+wallets, transactions or subscriptions bumps, so stale entries are never
+read again and simply expire. Concurrent misses for the same dashboard
+wait briefly for the one request that holds the compute lock instead of
+all rendering it at once, then render their own uncached copy.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .accrual import accrual_day, is_lazy
+from .archive import wants_full_history
+from .sharding import ledger_db
+
+HITS_KEY = 'dashboard:hits'
+MISSES_KEY = 'dashboard:misses'
+LOCK_POLL_SECONDS = 0.05
+
+
+def version_key(user_id):
+    return f'dashboard:version:{user_id}'
+
+
+def dashboard_version(user_id):
+    version = cache.get(version_key(user_id))
+    if version is None:
+        # Start from the clock rather than 1, so a version lost to eviction
+        # cannot come back and match entries cached under the old one
+        cache.add(version_key(user_id), time.time_ns(), timeout=None)
+        version = cache.get(version_key(user_id))
+    return version
+
+
+def bump_version(user_id):
+    try:
+        cache.incr(version_key(user_id))
+    except ValueError:
+        cache.set(version_key(user_id), time.time_ns(), timeout=None)
+
+
+def invalidate_dashboard(user_id, using=None):
+    # Bump once the write on `using` (the ledger database by default) is
+    # visible, or a concurrent miss could cache the old rows under the new
+    # version
+    transaction.on_commit(lambda: bump_version(user_id), using=using or ledger_db())
+
+
+def count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def dashboard_variant(request, profile_id):
+    # Image URLs are absolute and history=all adds archived rows, so both
+    # the host and that flag are part of the key
+    history = 'all' if wants_full_history(request) else 'recent'
+    origin = f'{request.scheme}://{request.get_host()}'
+    variant = f'{profile_id}:{history}:{hashlib.md5(origin.encode()).hexdigest()}'
+    # Lazily accrued returns grow every day without any write to bump the
+    # version, so entries last a day at most
+    return f'{variant}:{accrual_day()}' if is_lazy() else variant
+
+
+def cached_dashboard(user_id, variant, compute, cacheable=lambda: True):
+    """
+    Return the cached dashboard for `user_id`, calling `compute()` to
+    render it on a miss. It is only cached if `cacheable()` then agrees.
+    """
+    key = f'dashboard:{user_id}:{dashboard_version(user_id)}:{variant}'
+    data = cache.get(key)
+    if data is not None:
+        count(HITS_KEY)
+        return data
+
+    lock = f'{key}:lock'
+    locked = cache.add(lock, True, settings.DASHBOARD_CACHE_LOCK_SECONDS)
+    if not locked:
+        # Another request is rendering this dashboard; use its result if it
+        # comes soon
+        deadline = time.monotonic() + settings.DASHBOARD_CACHE_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_SECONDS)
+            data = cache.get(key)
+            if data is not None:
+                count(HITS_KEY)
+                return data
+
+    count(MISSES_KEY)
+    if not locked:
+        # Still rendering elsewhere; the lock holder caches its own result
+        return dict(compute())
+    try:
+        data = dict(compute())
+        if cacheable():
+            cache.set(key, data, settings.DASHBOARD_CACHE_SECONDS)
+    finally:
+        cache.delete(lock)
+    return data
+
+
+def cache_stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / lookups, 4) if lookups else None,
+    }
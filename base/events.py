@@ -0,0 +1,112 @@
+import asyncio
+import json
+import secrets
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .sharding import ledger_db
+
+
+class Subscription:
+    """
+    One connected client's inbox. Events are handed over from whichever
+    thread published them onto the event loop that is streaming them, and
+    the oldest event is dropped if a slow client lets the inbox fill up.
+    """
+
+    def __init__(self, user_id, max_queued):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queued)
+
+    def deliver(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class LocalBroker:
+    """
+    In-process broker: only clients connected to the same process as the
+    publisher are notified. A cross-process backend (Redis, PostgreSQL
+    LISTEN/NOTIFY) only needs the same subscribe/unsubscribe/publish
+    methods and can be selected with settings.EVENT_BROKER.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id, settings.EVENT_STREAM_MAX_QUEUED)
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.user_id, None)
+
+    def publish(self, user_id, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(settings.EVENT_BROKER)()
+
+
+def publish_user_event(user_id, event_type, data):
+    # Only tell clients about changes that were actually committed
+    if user_id is None:
+        return
+    event = {'type': event_type, 'data': data}
+    transaction.on_commit(lambda: get_broker().publish(user_id, event), using=ledger_db())
+
+
+def ticket_key(ticket):
+    return f'event-ticket:{ticket}'
+
+
+def issue_stream_ticket(user_id):
+    """
+    A ticket that opens one event stream for `user_id` within
+    EVENT_STREAM_TICKET_SECONDS. EventSource cannot send headers, so it goes
+    in the URL instead of the access token, where an expired or used
+    ticket is all that ends up in access logs.
+    """
+    ticket = secrets.token_urlsafe(32)
+    cache.set(ticket_key(ticket), user_id, settings.EVENT_STREAM_TICKET_SECONDS)
+    return ticket
+
+
+async def redeem_stream_ticket(ticket):
+    # The user the ticket was issued to, or None; only the first redemption
+    # gets to delete it
+    user_id = await cache.aget(ticket_key(ticket))
+    if user_id is None or not await cache.adelete(ticket_key(ticket)):
+        return None
+    return user_id
+
+
+def encode_event(event):
+    # Decimals go out as strings, the same way the REST API renders them
+    data = json.dumps(event['data'], default=str)
+    return f"event: {event['type']}\ndata: {data}\n\n"
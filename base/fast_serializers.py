@@ -0,0 +1,146 @@
+"""
+Read-only fast path for list responses. Rows are built straight from
+values_list() tuples with one formatter per column, chosen once per
+response from the serializer's own fields, so the output matches the
+ModelSerializer byte for byte without instantiating a model per row.
+"""
+from django.utils.dateformat import DateFormat
+from rest_framework import serializers
+
+from .accrual import accrued_minor, is_lazy
+from .models import CustomUser, InvestmentSubscription, Transaction, Wallet
+from .money import MONEY_SCALE, from_minor
+from .prices import price_snapshot, usd_value
+
+
+def date_formatter():
+    # Dates repeat heavily across rows, so format each calendar day once
+    formatted = {}
+
+    def format_date(value):
+        key = (value.year, value.month, value.day)
+        if key not in formatted:
+            formatted[key] = DateFormat(value).format('F j, Y')
+        return formatted[key]
+    return format_date
+
+
+def image_url_formatter(model, field_name, context):
+    storage = model._meta.get_field(field_name).storage
+    request = context.get('request')
+
+    def format_image(name):
+        if not name:
+            return None
+        url = storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+    return format_image
+
+
+def user_columns(context):
+    return {
+        'profile_picture': ('profile_picture',
+                            image_url_formatter(CustomUser, 'profile_picture', context)),
+        'date_joined': ('date_joined', date_formatter()),
+    }
+
+
+def wallet_columns(context):
+    prices = price_snapshot(context)
+    return {
+        'usd_value': (('title', 'balance'),
+                      lambda title, balance: usd_value(title, balance, prices)),
+    }
+
+
+def current_return_column():
+    # InvestmentSubscription.current_return, rendered as MoneySerializerField does
+    money = serializers.DecimalField(max_digits=18, decimal_places=MONEY_SCALE)
+    if not is_lazy():
+        return 'total_return', money.to_representation
+    columns = ('settled', 'total_return', 'amount', 'investment_plan__daily_return_rate',
+               'subscription_date', 'investment_plan__duration_days', 'accrued_on')
+
+    def current_return(settled, total_return, amount, rate, subscription_date,
+                       duration_days, accrued_on):
+        if not settled:
+            total_return = from_minor(accrued_minor(
+                amount, rate, subscription_date, duration_days, total_return, accrued_on))
+        return money.to_representation(total_return)
+    return columns, current_return
+
+
+def subscription_columns(context):
+    format_date = date_formatter()
+    return {
+        'total_return': current_return_column(),
+        'investment_plan_plan': ('investment_plan__plan', None),
+        'wallet_title': ('wallet__title', None),
+        'subscription_date': ('subscription_date', format_date),
+        'end_date': ('end_date', format_date),
+    }
+
+
+def transaction_columns(context):
+    return {
+        'user_name': ('user__full_name', lambda full_name: f"{full_name}"),
+        'wallet_title': ('wallet__title', None),
+        'date': ('date', date_formatter()),
+    }
+
+
+# Serialized model -> the columns and formatters of its computed fields
+COMPUTED_COLUMNS = {
+    CustomUser: user_columns,
+    Wallet: wallet_columns,
+    InvestmentSubscription: subscription_columns,
+    Transaction: transaction_columns,
+}
+
+
+def serialize_rows(serializer_class, queryset, context=None):
+    """
+    Equivalent of `serializer_class(queryset, many=True, context=context).data`
+    for the list serializers of the models in COMPUTED_COLUMNS.
+    """
+    context = {} if context is None else context
+    computed = COMPUTED_COLUMNS[serializer_class.Meta.model](context)
+    columns, fields = [], []
+
+    def position(column):
+        if column not in columns:
+            columns.append(column)
+        return columns.index(column)
+
+    for name, field in serializer_class(context=context).fields.items():
+        if field.write_only:
+            continue
+        if name in computed:
+            column, formatter = computed[name]
+            if isinstance(column, tuple):
+                # Computed from several columns; the formatter takes them all
+                fields.append((name, tuple(map(position, column)), formatter, False))
+                continue
+            # Method fields see the value even when it is None
+            keep_none = False
+        elif isinstance(field, serializers.RelatedField):
+            # values_list() already yields the primary key
+            column, formatter, keep_none = name, None, True
+        else:
+            column, formatter, keep_none = field.source, field.to_representation, True
+        fields.append((name, position(column), formatter, keep_none))
+
+    rows = []
+    for values in queryset.values_list(*columns):
+        row = {}
+        for name, index, formatter, keep_none in fields:
+            if isinstance(index, tuple):
+                row[name] = formatter(*(values[i] for i in index))
+                continue
+            value = values[index]
+            if formatter is None or (value is None and keep_none):
+                row[name] = value
+            else:
+                row[name] = formatter(value)
+        rows.append(row)
+    return rows
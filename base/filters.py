@@ -0,0 +1,51 @@
+"""
+Query parameter filters for the transaction and subscription lists. Every
+filter and ordering offered here is backed by an index (see the models'
+Meta.indexes), so none of them turns into a full table scan.
+"""
+import django_filters
+
+from .models import InvestmentSubscription, Transaction
+from .money import MONEY_SCALE
+
+
+def amount_filter(lookup_expr):
+    # The precision the API uses for money, so NaN, infinities and amounts
+    # too large for the column are rejected with a 400 like any bad value
+    return django_filters.NumberFilter(
+        field_name='amount', lookup_expr=lookup_expr,
+        max_digits=18, decimal_places=MONEY_SCALE)
+
+
+class TransactionFilter(django_filters.FilterSet):
+    amount__gte = amount_filter('gte')
+    amount__lte = amount_filter('lte')
+
+    class Meta:
+        model = Transaction
+        fields = {
+            'status': ['exact', 'in'],
+            'transaction_type': ['exact'],
+            'wallet': ['exact'],
+            'date': ['gte', 'lte'],
+        }
+
+
+class InvestmentSubscriptionFilter(django_filters.FilterSet):
+    amount__gte = amount_filter('gte')
+    amount__lte = amount_filter('lte')
+
+    class Meta:
+        model = InvestmentSubscription
+        fields = {
+            'investment_plan': ['exact'],
+            'wallet': ['exact'],
+            'settled': ['exact'],
+            'subscription_date': ['gte', 'lte'],
+            'end_date': ['gte', 'lte'],
+        }
+
+
+# Sorts clients may ask for with ?ordering=; each has a supporting index
+TRANSACTION_ORDERING = ['id', 'date', 'amount']
+SUBSCRIPTION_ORDERING = ['id', 'subscription_date', 'end_date', 'amount']
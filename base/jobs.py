@@ -0,0 +1,194 @@
+import inspect
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from importlib import import_module
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .audit import audit_context
+from .db_routers import use_primary
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# job_type -> (handler, concurrency limit)
+registry = {}
+
+
+def register_job(job_type, concurrency=1):
+    """
+    Register the decorated function as the handler for `job_type`. It is
+    called with the job's payload as keyword arguments and may return any
+    JSON-serialisable result.
+    """
+    def decorator(handler):
+        registry[job_type] = (handler, concurrency)
+        return handler
+    return decorator
+
+
+def load_handlers():
+    # Handlers register themselves when their module is imported
+    import_module('base.tasks')
+
+
+def check_payload(job_type, payload):
+    """
+    Raise ValueError unless `job_type` is registered and `payload` is a
+    dict of the keyword arguments its handler takes.
+    """
+    load_handlers()
+    if job_type not in registry:
+        raise ValueError(f"Unknown job type: {job_type}")
+    if not isinstance(payload, dict):
+        raise ValueError("The payload must be an object of handler arguments")
+    try:
+        inspect.signature(registry[job_type][0]).bind(**payload)
+    except TypeError as error:
+        raise ValueError(f"Invalid payload for {job_type}: {error}")
+
+
+def enqueue(job_type, payload=None, user=None, priority=0, max_attempts=3):
+    payload = {} if payload is None else payload
+    check_payload(job_type, payload)
+    return Job.objects.create(
+        job_type=job_type, payload=payload, user=user,
+        priority=priority, max_attempts=max_attempts)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def release_stale_jobs():
+    # Jobs whose worker died mid-run go back to the queue
+    cutoff = timezone.now() - timezone.timedelta(seconds=settings.JOB_LOCK_TIMEOUT_SECONDS)
+    return Job.objects.filter(status='running', locked_at__lt=cutoff).update(
+        status='queued', slot=None, locked_by='', locked_at=None)
+
+
+def claim_next(worker):
+    """
+    Claim the most urgent runnable job whose type still has a free
+    concurrency slot. Candidate rows are read with SKIP LOCKED so workers
+    never wait on each other, and the claim itself is a conditional UPDATE
+    so only one worker can win a row on any backend.
+    """
+    load_handlers()
+    with transaction.atomic():
+        candidates = (
+            Job.objects
+            .select_for_update(skip_locked=True)
+            .filter(status='queued', run_after__lte=timezone.now(),
+                    job_type__in=list(registry))
+            .order_by('-priority', 'run_after', 'id')
+            .values_list('id', 'job_type')[:settings.JOB_CLAIM_CANDIDATES]
+        )
+        for job_id, job_type in list(candidates):
+            limit = registry[job_type][1]
+            taken = set(Job.objects.filter(job_type=job_type, status='running')
+                        .values_list('slot', flat=True))
+            free = [slot for slot in range(limit) if slot not in taken]
+            if not free:
+                continue
+            try:
+                with transaction.atomic():
+                    claimed = Job.objects.filter(id=job_id, status='queued').update(
+                        status='running', slot=free[0], locked_by=worker,
+                        locked_at=timezone.now(), attempts=F('attempts') + 1)
+            except IntegrityError:
+                # Another worker took the slot first
+                continue
+            if claimed:
+                return Job.objects.get(id=job_id)
+    return None
+
+
+def claimed(job):
+    # The job's row, as long as this run still holds the claim on it
+    return Job.objects.filter(id=job.id, status='running', locked_by=job.locked_by)
+
+
+@contextmanager
+def heartbeat(job):
+    """
+    Refresh the job's locked_at every JOB_HEARTBEAT_SECONDS while the
+    block runs, so release_stale_jobs() only requeues the jobs of workers
+    that died, however long a job takes.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.JOB_HEARTBEAT_SECONDS):
+                claimed(job).update(locked_at=timezone.now())
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f'job-{job.id}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def finish(job, **fields):
+    # Record the outcome, unless the job was released and claimed again
+    # meanwhile; the run that holds the claim records its own
+    if not claimed(job).update(slot=None, **fields):
+        logger.warning(f"Job {job.id} ({job.job_type}) lost its claim; outcome not recorded")
+
+
+def run_job(job):
+    handler = registry[job.job_type][0]
+    try:
+        with heartbeat(job), audit_context(f'job:{job.job_type}', actor=job.user_id):
+            result = handler(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception(f"Job {job.id} ({job.job_type}) failed")
+        if job.attempts < job.max_attempts:
+            backoff = settings.JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+            finish(job, status='queued', locked_by='', locked_at=None, error=error,
+                   run_after=timezone.now() + timezone.timedelta(seconds=backoff))
+        else:
+            finish(job, status='failed', error=error, finished_at=timezone.now())
+        return False
+    finish(job, status='done', result=result, finished_at=timezone.now())
+    return True
+
+
+def run_worker(once=False, idle_sleep=1.0):
+    """
+    Claim and run jobs until stopped. Start more worker processes to add
+    throughput; with `once`, drain the queue and return the number run.
+    """
+    worker = worker_name()
+    processed = 0
+    released_at = None
+    with use_primary():
+        while True:
+            # On a timer rather than when idle, so a busy queue still gets
+            # back the jobs of dead workers
+            if released_at is None or \
+                    time.monotonic() - released_at >= settings.JOB_RELEASE_STALE_SECONDS:
+                release_stale_jobs()
+                released_at = time.monotonic()
+            job = claim_next(worker)
+            if job is None:
+                if once:
+                    return processed
+                time.sleep(idle_sleep)
+                continue
+            run_job(job)
+            processed += 1
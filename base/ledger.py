@@ -0,0 +1,114 @@
+from decimal import Decimal
+
+from django.db.models import Case, F, Sum, Value, When
+from django.utils import timezone
+
+from .accrual import materialize_accrued_returns
+from .audit import audit_balance_change
+from .dashboard import invalidate_dashboard
+from .events import publish_user_event
+from .models import InvestmentSubscription, Transaction, Wallet
+from .money import MoneyField
+from .rollups import record_balance_deltas
+
+
+def signed_amount():
+    # Deposits add to a wallet, withdrawals take from it
+    return Case(
+        When(transaction_type='deposit', then=F('amount')),
+        default=-F('amount'),
+        output_field=MoneyField(),
+    )
+
+
+def net_amounts_by_wallet(transactions):
+    return dict(
+        transactions.order_by()
+        .values('wallet')
+        .annotate(net=Sum(signed_amount()))
+        .values_list('wallet', 'net')
+    )
+
+
+def apply_balance_deltas(deltas):
+    """
+    Add each amount in `deltas` (wallet id -> Decimal) to that wallet's
+    balance in a single UPDATE, then fold the moves into today's rollups.
+    Must run inside a transaction.
+    """
+    deltas = {wallet_id: delta for wallet_id, delta in deltas.items() if delta}
+    if not deltas:
+        return 0
+    money = MoneyField()
+    updated = Wallet.objects.filter(id__in=deltas).update(balance=F('balance') + Case(
+        *(When(id=wallet_id, then=Value(delta, output_field=money))
+          for wallet_id, delta in deltas.items()),
+        default=Value(Decimal(0), output_field=money),
+        output_field=money,
+    ))
+    record_balance_deltas(deltas)
+    for wallet_id, user_id, title, balance in Wallet.objects.filter(
+            id__in=deltas).values_list('id', 'user_id', 'title', 'balance'):
+        audit_balance_change(wallet_id, user_id, balance - deltas[wallet_id], balance)
+        invalidate_dashboard(user_id)
+        publish_user_event(user_id, 'wallet', {
+            'id': wallet_id, 'title': title, 'balance': balance})
+    return updated
+
+
+def settle_pending_transactions(transaction_ids, new_status):
+    """
+    Move the pending transactions among `transaction_ids` to `new_status`,
+    crediting or debiting wallets when they are approved. Returns the number
+    of transactions settled. Must run inside a transaction.
+    """
+    pending = Transaction.objects.select_for_update().filter(
+        id__in=transaction_ids, status='pending')
+    ids = list(pending.values_list('id', flat=True))
+    if new_status == 'done':
+        apply_balance_deltas(net_amounts_by_wallet(
+            Transaction.objects.filter(id__in=ids)))
+    settled = Transaction.objects.filter(id__in=ids).update(status=new_status)
+    for row in Transaction.objects.filter(id__in=ids).values(
+            'id', 'user_id', 'transaction_type', 'wallet_id', 'amount', 'status'):
+        invalidate_dashboard(row['user_id'])
+        publish_user_event(row.pop('user_id'), 'transaction', {
+            'id': row['id'],
+            'transaction_type': row['transaction_type'],
+            'wallet': row['wallet_id'],
+            'amount': row['amount'],
+            'status': row['status'],
+        })
+    return settled
+
+
+def settle_matured_subscriptions(ids):
+    """
+    Pay principal plus accrued return back into the wallets of the matured,
+    unsettled subscriptions among `ids` and flag them settled. Rows already
+    settled (or locked by a concurrent run) are skipped, so each subscription
+    pays out exactly once. Returns the number settled. Must run inside a
+    transaction.
+    """
+    matured = InvestmentSubscription.objects.select_for_update(skip_locked=True).filter(
+        id__in=ids, settled=False, end_date__lt=timezone.now())
+    ids = list(matured.values_list('id', flat=True))
+    if not ids:
+        return 0
+    # Store the final return first; it is what gets paid
+    materialize_accrued_returns(InvestmentSubscription.objects.filter(id__in=ids))
+    deltas = dict(
+        InvestmentSubscription.objects.filter(id__in=ids, wallet__isnull=False)
+        .order_by()
+        .values('wallet')
+        .annotate(payout=Sum(F('amount') + F('total_return'), output_field=MoneyField()))
+        .values_list('wallet', 'payout')
+    )
+    settled = InvestmentSubscription.objects.filter(id__in=ids).update(settled=True)
+    apply_balance_deltas(deltas)
+    for subscription_id, user_id, total_return in InvestmentSubscription.objects.filter(
+            id__in=ids).values_list('id', 'user_id', 'total_return'):
+        invalidate_dashboard(user_id)
+        publish_user_event(user_id, 'investment', {
+            'id': subscription_id, 'total_return': total_return, 'settled': True})
+    return settled
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from base.archive import archive_settled_transactions
+
+
+class Command(BaseCommand):
+    help = "Move settled transactions older than the archive age into the archive table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        moved = archive_settled_transactions(
+            older_than_days=options['older_than_days'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {moved} settled transactions"))
@@ -0,0 +1,71 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.tokens import AccessToken
+
+from base.models import CustomUser
+
+
+def request_host():
+    # The test client's default 'testserver' is not an allowed host in production
+    hosts = [host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')]
+    return hosts[0] if hosts else 'localhost'
+
+
+class Command(BaseCommand):
+    help = ("Time bearer-token requests to an API path through the full middleware "
+            "stack and through the lean one used for LEAN_API_PATHS")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--email', help="User to authenticate as; defaults to the first user")
+        parser.add_argument('--with-session', action='store_true',
+                            help="Also send a session cookie, like a browser that used the admin")
+
+    def handle(self, *args, **options):
+        users = CustomUser.objects.filter(is_active=True).order_by('id')
+        if options['email']:
+            users = users.filter(email=options['email'])
+        user = users.first()
+        if user is None:
+            raise CommandError("No active user to authenticate as")
+
+        client = Client(HTTP_HOST=request_host(),
+                        HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        if options['with_session']:
+            client.force_login(user)
+        path, count = options['path'], options['requests']
+        lean_paths = [prefix for prefix in settings.LEAN_API_PATHS if path.startswith(prefix)]
+        if not lean_paths:
+            raise CommandError(f"{path} is not under LEAN_API_PATHS")
+
+        self.stdout.write(f"{count} GET {path} as {user.email}\n")
+        self.stdout.write(f"{'stack':<12}{'us/request':>12}{'queries/request':>18}")
+        results = {}
+        try:
+            for stack, prefixes in (('full', []), ('lean', lean_paths)):
+                with override_settings(LEAN_API_PATHS=prefixes):
+                    response = client.get(path)
+                    if response.status_code >= 400:
+                        raise CommandError(f"{path} answered {response.status_code}")
+                    with CaptureQueriesContext(connection) as queries:
+                        start = time.perf_counter()
+                        for _ in range(count):
+                            client.get(path)
+                        elapsed = time.perf_counter() - start
+                results[stack] = elapsed / count * 1e6
+                self.stdout.write(
+                    f"{stack:<12}{results[stack]:>12.1f}{len(queries) / count:>18.2f}")
+        finally:
+            if options['with_session']:
+                client.logout()
+
+        saving = results['full'] - results['lean']
+        self.stdout.write(self.style.SUCCESS(
+            f"Lean stack saves {saving:.1f} us per request "
+            f"({saving / results['full']:.0%})"))
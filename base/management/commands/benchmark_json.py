@@ -0,0 +1,57 @@
+import gzip
+import itertools
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from base.compression import brotli
+from base.fast_serializers import serialize_rows
+from base.models import Transaction
+from base.renderers import FastJSONRenderer, orjson
+from base.serializers import TransactionSerializer
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000, result
+
+
+class Command(BaseCommand):
+    help = ("Time JSON rendering and compression of a /api/transaction/ payload "
+            "to show the CPU-versus-bytes tradeoff")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000,
+                            help="Payload size; existing transactions are repeated to reach it")
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rows = serialize_rows(TransactionSerializer, Transaction.objects.all()[:options['rows']])
+        if not rows:
+            raise CommandError("No transactions to build a payload from")
+        payload = list(itertools.islice(itertools.cycle(rows), options['rows']))
+        repeat = options['repeat']
+
+        self.stdout.write(f"/api/transaction/ payload: {len(payload)} rows\n")
+        self.stdout.write(f"{'step':<28}{'ms':>10}{'bytes':>12}")
+
+        stdlib_ms, body = best_of(repeat, lambda: JSONRenderer().render(payload))
+        self.stdout.write(f"{'render: stdlib json':<28}{stdlib_ms:>10.2f}{len(body):>12}")
+        if orjson is not None:
+            fast_ms, fast_body = best_of(repeat, lambda: FastJSONRenderer().render(payload))
+            self.stdout.write(f"{'render: orjson':<28}{fast_ms:>10.2f}{len(fast_body):>12}")
+            if fast_body != body:
+                self.stderr.write("orjson output differs from stdlib output")
+
+        for level in (1, 6, 9):
+            ms, compressed = best_of(repeat, lambda: gzip.compress(body, compresslevel=level))
+            self.stdout.write(f"{f'gzip level {level}':<28}{ms:>10.2f}{len(compressed):>12}")
+        if brotli is not None:
+            for quality in (1, 4, 11):
+                ms, compressed = best_of(repeat, lambda: brotli.compress(body, quality=quality))
+                self.stdout.write(f"{f'brotli quality {quality}':<28}{ms:>10.2f}{len(compressed):>12}")
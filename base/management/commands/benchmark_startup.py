@@ -0,0 +1,90 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What each entry point runs in a fresh interpreter. `web` is a worker boot
+# plus loading the URLconf, which the first request would otherwise pay for.
+ENTRY_POINTS = {
+    'settings': "import importlib, os; importlib.import_module(os.environ['DJANGO_SETTINGS_MODULE'])",
+    'setup': "import django; django.setup()",
+    'web': ("from dynamic_clay_trading_backend.wsgi import application\n"
+            "from django.urls import get_resolver\n"
+            "get_resolver().url_patterns"),
+}
+
+# Only the processes that need these should import them
+LAZY_MODULES = ('apscheduler', 'sqlalchemy', 'numpy', 'cloudinary')
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+exec(compile({code!r}, '<entry point>', 'exec'))
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'ms': elapsed * 1000,
+    'loaded': [name for name in {lazy!r} if name in sys.modules],
+}}))
+"""
+
+
+def probe(code):
+    # Run `code` in a fresh interpreter; returns (ms, lazy modules it loaded)
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE.format(code=code, lazy=LAZY_MODULES)],
+        capture_output=True, text=True, cwd=settings.BASE_DIR)
+    if result.returncode != 0:
+        raise CommandError(result.stderr.strip().splitlines()[-1])
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return report['ms'], report['loaded']
+
+
+def time_manage_check():
+    # Wall time of a whole `manage.py check`, interpreter start-up included
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'manage.py', 'check'],
+                   capture_output=True, check=True, cwd=settings.BASE_DIR)
+    return (time.perf_counter() - start) * 1000
+
+
+class Command(BaseCommand):
+    help = ("Time imports and django.setup() for each entry point in fresh "
+            "processes, and fail if start-up regresses")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--entry', action='append', choices=sorted(ENTRY_POINTS),
+                            help="Entry point to time (repeatable); defaults to all")
+        parser.add_argument('--manage', action='store_true',
+                            help="Also time a full `manage.py check`")
+        parser.add_argument('--budget-ms', type=float,
+                            help="Fail when any entry point's median exceeds this")
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        failures = []
+
+        self.stdout.write(f"{'entry point':<16}{'best ms':>10}{'median ms':>12}  eager imports")
+        for name in options['entry'] or ENTRY_POINTS:
+            runs = [probe(ENTRY_POINTS[name]) for _ in range(repeat)]
+            timings = [ms for ms, _ in runs]
+            loaded = sorted({module for _, modules in runs for module in modules})
+            median = statistics.median(timings)
+            self.stdout.write(f"{name:<16}{min(timings):>10.1f}{median:>12.1f}  "
+                              f"{', '.join(loaded) or '-'}")
+            if loaded:
+                failures.append(f"{name} imports {', '.join(loaded)}")
+            if options['budget_ms'] is not None and median > options['budget_ms']:
+                failures.append(f"{name} took {median:.1f} ms")
+
+        if options['manage']:
+            timings = [time_manage_check() for _ in range(repeat)]
+            self.stdout.write(f"{'manage.py check':<16}{min(timings):>10.1f}"
+                              f"{statistics.median(timings):>12.1f}")
+
+        if failures:
+            raise CommandError("Start-up regressed: " + "; ".join(failures))
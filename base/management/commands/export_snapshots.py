@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from base.snapshots import export_snapshots
+
+
+class Command(BaseCommand):
+    help = ("Append the transactions and subscriptions settled since the last run "
+            "to the columnar analytics snapshots")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', default=None,
+                            help="Snapshot directory (defaults to SNAPSHOT_DIR)")
+
+    def handle(self, *args, **options):
+        appended = export_snapshots(options['directory'])
+        self.stdout.write(self.style.SUCCESS(', '.join(
+            f"{rows} rows appended to {table}" for table, rows in appended.items())))
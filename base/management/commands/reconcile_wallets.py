@@ -0,0 +1,62 @@
+import csv
+import multiprocessing
+import os
+
+from django.db import connections
+from django.core.management.base import BaseCommand
+
+from base.reconciliation import (reconcile_range, reconcile_range_job,
+                                 reconcile_worker_init, wallet_id_ranges)
+
+REPORT_FIELDS = ['wallet', 'user', 'balance', 'expected', 'diff']
+
+
+class Command(BaseCommand):
+    help = ("Recompute every wallet's balance from its transactions and subscriptions, "
+            "report the wallets that disagree and optionally correct them")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Processes checking wallet id ranges in parallel")
+        parser.add_argument('--partition-size', type=int, default=50000,
+                            help="Wallet ids per range")
+        parser.add_argument('--repair', action='store_true',
+                            help="Correct mismatched balances to the ledger's value")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Wallets corrected per transaction with --repair")
+        parser.add_argument('--report', help="Write every mismatch to this CSV file")
+
+    def handle(self, *args, **options):
+        jobs = [(start, stop, options['repair'], options['batch_size'])
+                for start, stop in wallet_id_ranges(options['partition_size'])]
+
+        if options['workers'] > 1 and len(jobs) > 1:
+            connections.close_all()
+            with multiprocessing.Pool(min(options['workers'], len(jobs)),
+                                      initializer=reconcile_worker_init) as pool:
+                results = list(pool.imap_unordered(reconcile_range_job, jobs))
+        else:
+            results = [reconcile_range(*job) for job in jobs]
+
+        checked = sum(result[0] for result in results)
+        mismatches = sorted((row for result in results for row in result[1]),
+                            key=lambda row: row['wallet'])
+        repaired = sum(result[2] for result in results)
+
+        if options['report']:
+            with open(options['report'], 'w', newline='') as report:
+                writer = csv.DictWriter(report, fieldnames=REPORT_FIELDS)
+                writer.writeheader()
+                writer.writerows(mismatches)
+        for row in mismatches[:20]:
+            self.stdout.write(
+                f"wallet {row['wallet']} (user {row['user']}): balance {row['balance']}, "
+                f"expected {row['expected']}, diff {row['diff']:+}")
+        if len(mismatches) > 20:
+            self.stdout.write(f"... and {len(mismatches) - 20} more")
+
+        summary = f"Checked {checked} wallets, {len(mismatches)} mismatched"
+        if options['repair']:
+            summary += f", {repaired} repaired"
+        style = self.style.SUCCESS if not mismatches or options['repair'] else self.style.WARNING
+        self.stdout.write(style(summary))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from base.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = "Run queued jobs; start several processes to work the queue in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once the queue is empty")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="Seconds to wait when no job is runnable")
+
+    def handle(self, *args, **options):
+        processed = run_worker(once=options['once'], idle_sleep=options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f"Ran {processed} jobs"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from base.apscheduler import start
+
+
+class Command(BaseCommand):
+    help = "Run the periodic jobs (accrual, settlement, archival, rollups) until interrupted"
+
+    def handle(self, *args, **options):
+        self.stdout.write("Scheduler running; press Ctrl+C to stop")
+        try:
+            start(blocking=True)
+        except (KeyboardInterrupt, SystemExit):
+            pass
@@ -0,0 +1,40 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.money import from_minor
+from base.snapshots import REPORTS, Snapshot
+
+
+def major_units(value):
+    # Reports total in minor units; show them the way the API does
+    if isinstance(value, dict):
+        return {key: major_units(item) if key != 'count' else item
+                for key, item in value.items()}
+    return str(from_minor(value))
+
+
+class Command(BaseCommand):
+    help = "Run a finance report on the analytics snapshots, without touching the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('report', choices=sorted(REPORTS))
+        parser.add_argument('--since', help="First day to include (YYYY-MM-DD)")
+        parser.add_argument('--until', help="Last day to include (YYYY-MM-DD)")
+        parser.add_argument('--directory', default=None,
+                            help="Snapshot directory (defaults to SNAPSHOT_DIR)")
+
+    def handle(self, *args, **options):
+        snapshot = Snapshot(options['directory'])
+        started = time.perf_counter()
+        result = REPORTS[options['report']](
+            snapshot, since=options['since'], until=options['until'])
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        self.stdout.write(json.dumps(
+            {str(key): major_units(value) for key, value in result.items()}, indent=2))
+        exported_at = snapshot.manifest['exported_at']
+        self.stderr.write(
+            f"{options['report']} in {elapsed_ms:.1f} ms, "
+            + (f"snapshot exported at {exported_at}" if exported_at else "no snapshot yet"))
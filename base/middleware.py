@@ -0,0 +1,222 @@
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.cache import patch_vary_headers
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .audit import audit_context
+from .compression import COMPRESSIBLE_TYPES, choose_encoding, compress
+from .db_routers import pin_to_primary, unpin
+from .models import CustomUser
+from .profiling import profile_request, profile_requested
+from .sharding import is_sharded, use_user_shard
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def lean_request(request):
+    # Requests to LEAN_API_PATHS authenticate with bearer tokens only
+    return request.path_info.startswith(tuple(settings.LEAN_API_PATHS))
+
+
+class LeanPathsMixin:
+    """
+    Skips the middleware it is mixed into for LEAN_API_PATHS, which need no
+    session, CSRF token, messages or frame options. The subclasses below
+    still count as the Django middleware they extend, so the admin's
+    checks for them pass.
+    """
+
+    def __call__(self, request):
+        if lean_request(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class LeanSessionMiddleware(LeanPathsMixin, SessionMiddleware):
+    pass
+
+
+class LeanCsrfViewMiddleware(LeanPathsMixin, CsrfViewMiddleware):
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        # Registered with the handler separately from __call__
+        if lean_request(request):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
+
+
+class LeanAuthenticationMiddleware(LeanPathsMixin, AuthenticationMiddleware):
+    pass
+
+
+class LeanMessageMiddleware(LeanPathsMixin, MessageMiddleware):
+    pass
+
+
+class LeanXFrameOptionsMiddleware(LeanPathsMixin, XFrameOptionsMiddleware):
+    pass
+
+
+def token_user_id(raw_token):
+    # Access tokens are validated without touching the database
+    try:
+        validated_token = JWTAuthentication().get_validated_token(raw_token)
+    except InvalidToken:
+        return None
+    return validated_token.get('user_id')
+
+
+def request_user_id(request):
+    # Session users are already known; API clients only carry a bearer token
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.pk
+
+    authenticator = JWTAuthentication()
+    header = authenticator.get_header(request)
+    if header is None:
+        return None
+    try:
+        raw_token = authenticator.get_raw_token(header)
+    except AuthenticationFailed:
+        return None
+    if raw_token is None:
+        return None
+    return token_user_id(raw_token)
+
+
+class ReplicaPinningMiddleware:
+    """
+    Routes a request's reads to the primary when the request writes, and for
+    REPLICA_PIN_SECONDS after its user last wrote, so a client always reads
+    back what it has just created. Goes after the authentication middleware,
+    which gives session requests their user.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'DATABASE_REPLICAS', []):
+            return self.get_response(request)
+
+        writes = request.method not in SAFE_METHODS
+        user_id = request_user_id(request)
+
+        token = None
+        if writes or (user_id is not None and cache.get(f'replica-pin:{user_id}')):
+            token = pin_to_primary()
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                unpin(token)
+
+        if writes:
+            # Views authenticate lazily, so a sign-up or sign-in only knows
+            # its user once the response has been produced.
+            user_id = user_id or request_user_id(request)
+            if user_id is not None:
+                cache.set(f'replica-pin:{user_id}', True,
+                          settings.REPLICA_PIN_SECONDS)
+        return response
+
+
+class ShardRoutingMiddleware:
+    """
+    Sends the request's ledger queries to the shard holding its user's
+    wallets, transactions and subscriptions (see base.sharding).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_sharded():
+            return self.get_response(request)
+        user_id = request_user_id(request)
+        if user_id is None:
+            return self.get_response(request)
+        with use_user_shard(user_id):
+            return self.get_response(request)
+
+
+class AuditContextMiddleware:
+    """
+    Attributes balance changes made while handling the request to its user
+    and view (see base.audit). Both are only worked out if a balance changes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        def source():
+            match = request.resolver_match
+            return f"{request.method} {match.view_name if match else request.path}"
+
+        with audit_context(source, actor=lambda: request_user_id(request)):
+            return self.get_response(request)
+
+
+class RequestProfilingMiddleware:
+    """
+    Profiles the request when a staff user asks for it with `X-Profile: 1`
+    or `?profile=1` (see base.profiling). Every other request only pays for
+    the header check.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profile_requested(request):
+            return self.get_response(request)
+
+        user_id = request_user_id(request)
+        if user_id is None or not CustomUser.objects.filter(
+                pk=user_id, is_staff=True).exists():
+            return self.get_response(request)
+        return profile_request(request, self.get_response, user_id)
+
+
+class CompressionMiddleware:
+    """
+    Brotli or gzip compression, negotiated through Accept-Encoding, for
+    JSON and JavaScript responses of at least RESPONSE_COMPRESSION_MIN_BYTES.
+    Streaming responses (event streams, static files) pass through as is.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if not response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < settings.RESPONSE_COMPRESSION_MIN_BYTES:
+            return response
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return response
+
+        compressed = compress(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response.headers['Content-Length'] = str(len(compressed))
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body differs byte-wise from the one the ETag names
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_archivedtransaction_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletDailyBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('inflow', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('outflow', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.wallet')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='walletdailybalance',
+            constraint=models.UniqueConstraint(fields=('wallet', 'day'), name='unique_wallet_daily_balance'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:12
+
+from django.db import migrations, models
+
+# Trigram indexes on the upper-cased columns serve the icontains and
+# istartswith lookups used by base.search. They only exist on PostgreSQL;
+# SQLite uses the in-process index instead.
+TRIGRAM_INDEXES = [
+    ('base_customuser_email_trgm', 'base_customuser', 'email'),
+    ('base_customuser_full_name_trgm', 'base_customuser', 'full_name'),
+    ('base_wallet_address_trgm', 'base_wallet', 'wallet_address'),
+    ('base_transaction_address_trgm', 'base_transaction', 'wallet_address'),
+]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} '
+            f'USING gin (UPPER({column}::text) gin_trgm_ops)')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_walletdailybalance_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['amount'], name='base_transa_amount_58648f_idx'),
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
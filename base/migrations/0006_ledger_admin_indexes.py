@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investmentsubscription',
+            index=models.Index(fields=['end_date'], name='base_invest_end_dat_e6d137_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_type', 'date'], name='base_transa_transac_bf168d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['date'], name='base_transa_date_0da476_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.0.6 on 2026-10-19 16:05
+
+from decimal import Decimal
+
+import base.money
+from django.db import migrations, models
+from django.db.models import F
+
+# (model, field, default) of every amount moving to integer minor units
+MONEY_FIELDS = [
+    ('wallet', 'balance', 0),
+    ('walletdailybalance', 'balance', None),
+    ('walletdailybalance', 'inflow', 0),
+    ('walletdailybalance', 'outflow', 0),
+    ('transaction', 'amount', None),
+    ('archivedtransaction', 'amount', None),
+    ('investmentsubscription', 'amount', None),
+    ('investmentsubscription', 'total_return', 0),
+]
+
+
+def field_kwargs(default):
+    return {} if default is None else {'default': default}
+
+
+def widened_decimal_fields():
+    # Room for the values once multiplied by 100, before the type change
+    return [
+        migrations.AlterField(
+            model_name=model, name=name,
+            field=models.DecimalField(max_digits=20, decimal_places=2, **field_kwargs(default)))
+        for model, name, default in MONEY_FIELDS
+    ]
+
+
+def scale_amounts(factor):
+    def scale(apps, schema_editor):
+        # Scale the rows of the database being migrated, which is not
+        # necessarily 'default' once there are several shards
+        alias = schema_editor.connection.alias
+        for model, name, default in MONEY_FIELDS:
+            apps.get_model('base', model).objects.using(alias).update(
+                **{name: F(name) * factor})
+    return scale
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_job_queue'),
+    ]
+
+    operations = widened_decimal_fields() + [
+        migrations.RunPython(scale_amounts(100), scale_amounts(Decimal('0.01'))),
+    ] + [
+        migrations.AlterField(
+            model_name=model, name=name,
+            field=base.money.MoneyField(**field_kwargs(default)))
+        for model, name, default in MONEY_FIELDS
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_money_minor_units'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investmentsubscription',
+            name='settled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='investmentsubscription',
+            index=models.Index(fields=['settled', 'end_date'], name='base_invest_settled_72a5a9_idx'),
+        ),
+    ]
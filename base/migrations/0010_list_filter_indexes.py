@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_subscription_settled'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investmentsubscription',
+            index=models.Index(fields=['subscription_date'], name='base_invest_subscri_cfae3e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='investmentsubscription',
+            index=models.Index(fields=['amount'], name='base_invest_amount_4571e0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', 'date'], name='base_transa_wallet__936d1b_idx'),
+        ),
+    ]
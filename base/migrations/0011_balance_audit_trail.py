@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:42
+
+import base.money
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0010_list_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceAuditEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance_before', base.money.MoneyField()),
+                ('balance_after', base.money.MoneyField()),
+                ('source', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actor', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('wallet', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='base.wallet')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['wallet', 'created_at'], name='base_balanc_wallet__b5ac87_idx'), models.Index(fields=['created_at'], name='base_balanc_created_77d15e_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def place_existing_users(apps, schema_editor):
+    # Everyone who signed up before sharding keeps their data on 'default'
+    if schema_editor.connection.alias != 'default':
+        return
+    CustomUser = apps.get_model('base', 'CustomUser')
+    UserShard = apps.get_model('base', 'UserShard')
+    UserShard.objects.using('default').bulk_create(
+        [UserShard(user_id=user_id, shard='default')
+         for user_id in CustomUser.objects.using('default').values_list('id', flat=True)],
+        batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0011_balance_audit_trail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('shard', models.CharField(max_length=64)),
+                ('assigned_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['shard'], name='base_usersh_shard_c7b277_idx')],
+            },
+        ),
+        migrations.RunPython(place_existing_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-19 15:01
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def mark_accrued_so_far(apps, schema_editor):
+    # The daily job has stored returns up to today on the open subscriptions
+    InvestmentSubscription = apps.get_model('base', 'InvestmentSubscription')
+    InvestmentSubscription.objects.using(schema_editor.connection.alias).filter(
+        settled=False).update(accrued_on=timezone.localdate())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0012_user_shard_directory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investmentsubscription',
+            name='accrued_on',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_accrued_so_far, migrations.RunPython.noop),
+    ]
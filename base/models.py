@@ -1,7 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin, Group, Permission
 
+from .accrual import accrual_day, accrued_minor, is_lazy
+from .money import MoneyField, from_minor, percent_of, to_minor
+
 
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -71,13 +74,39 @@ class Wallet(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     title = models.CharField(max_length=255)
     wallet_address = models.CharField(max_length=255)
-    balance = models.DecimalField(
-        max_digits=10, decimal_places=2, default=0.00)
+    balance = MoneyField(default=0)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored balance so post_save can tell how much it moved
+        instance._loaded_balance = instance.__dict__.get('balance')
+        return instance
 
     def __str__(self):
         return f"{self.user.email} - {self.title} Wallet"
 
 
+class WalletDailyBalance(models.Model):
+    # End-of-day balance and the day's inflows and outflows for a wallet,
+    # kept current for today by the Wallet post_save signal and carried
+    # forward for quiet days by the nightly rollup job.
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE)
+    day = models.DateField()
+    balance = MoneyField()
+    inflow = MoneyField(default=0)
+    outflow = MoneyField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['wallet', 'day'], name='unique_wallet_daily_balance'),
+        ]
+
+    def __str__(self):
+        return f"{self.wallet_id} - {self.day}: {self.balance}"
+
+
 class Transaction(models.Model):
     TRANSACTION_TYPES = [
         ('deposit', 'Deposit'),
@@ -93,12 +122,44 @@ class Transaction(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True)
     wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE)
     wallet_address = models.CharField(max_length=255, null=True, blank=True)
-    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    amount = MoneyField()
     status = models.CharField(max_length=20, choices=STATUS, default="pending")
     date = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'date']),
+            models.Index(fields=['amount']),
+            models.Index(fields=['transaction_type', 'date']),
+            models.Index(fields=['date']),
+            models.Index(fields=['wallet', 'date']),
+        ]
+
     def __str__(self):
-        return f"{self.user.first_name} {self.transaction_type}"
+        return f"Transaction {self.id} - {self.transaction_type}"
+
+
+class ArchivedTransaction(models.Model):
+    # Settled ('done' or 'declined') transactions moved out of the hot
+    # Transaction table by base.archive. Rows keep their original id.
+    id = models.BigIntegerField(primary_key=True)
+    transaction_type = models.CharField(
+        max_length=20, choices=Transaction.TRANSACTION_TYPES)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True)
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE)
+    wallet_address = models.CharField(max_length=255, null=True, blank=True)
+    amount = MoneyField()
+    status = models.CharField(max_length=20, choices=Transaction.STATUS)
+    date = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'date']),
+        ]
+
+    def __str__(self):
+        return f"Transaction {self.id} - {self.transaction_type} (archived)"
 
 
 class Investment(models.Model):
@@ -127,10 +188,21 @@ class InvestmentSubscription(models.Model):
     subscription_date = models.DateTimeField(default=timezone.now)
     wallet = models.ForeignKey(
         Wallet, on_delete=models.CASCADE, default=1, null=True)
-    amount = models.DecimalField(max_digits=10, decimal_places=2)
-    total_return = models.DecimalField(
-        max_digits=10, decimal_places=2, default=0)
+    amount = MoneyField()
+    total_return = MoneyField(default=0)
+    # Day total_return was accrued up to, see base.accrual
+    accrued_on = models.DateField(null=True, blank=True)
     end_date = models.DateTimeField(null=True, blank=True)
+    # Set once principal and return have been paid back into the wallet
+    settled = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['end_date']),
+            models.Index(fields=['settled', 'end_date']),
+            models.Index(fields=['subscription_date']),
+            models.Index(fields=['amount']),
+        ]
 
     def save(self, *args, **kwargs):
         # Calculate the end date based on subscription date and investment duration (30 days)
@@ -139,23 +211,140 @@ class InvestmentSubscription(models.Model):
 
     def calculate_daily_return(self):
         # Calculate the daily return based on the amount invested and the daily return rate
-        daily_return = (self.amount *
-                        self.investment_plan.daily_return_rate) / 100
-        return daily_return
+        daily_return = percent_of(
+            to_minor(self.amount), self.investment_plan.daily_return_rate)
+        return from_minor(daily_return)
+
+    def accrued_return(self, at=None):
+        # Return to date as of `at` (now by default); final once settled
+        if self.settled:
+            return self.total_return
+        return from_minor(accrued_minor(
+            self.amount, self.investment_plan.daily_return_rate, self.subscription_date,
+            self.investment_plan.duration_days, self.total_return, self.accrued_on, at))
+
+    @property
+    def current_return(self):
+        # What the API shows: computed on read in lazy accrual mode
+        return self.accrued_return() if is_lazy() else self.total_return
 
-    def update_total_return(self):
-        days_passed = (timezone.now() - self.subscription_date).days
+    def update_total_return(self, at=None):
+        at = at or timezone.now()
+        days_passed = (at - self.subscription_date).days
+        self.total_return = self.accrued_return(at)
+        self.accrued_on = accrual_day(at)
         if days_passed <= self.investment_plan.duration_days:
-            daily_return = self.calculate_daily_return()
-            self.total_return += daily_return
-            self.wallet.balance = self.total_return
-            self.wallet.save()
             self.save()
             return True
         else:
-            self.wallet.balance += self.total_return
-            self.wallet.save()
+            from .ledger import apply_balance_deltas
+
+            # Claim the subscription first so it can only ever be paid out
+            # once, and credit the wallet in SQL with the claim
+            with transaction.atomic(using=self._state.db):
+                claimed = InvestmentSubscription.objects.filter(
+                    pk=self.pk, settled=False).update(
+                        settled=True, total_return=self.total_return, accrued_on=self.accrued_on)
+                if claimed:
+                    self.settled = True
+                    if self.wallet_id:
+                        apply_balance_deltas({self.wallet_id: self.amount + self.total_return})
             return False
 
     def __str__(self):
         return f"{self.user.email} - {self.investment_plan.plan}"
+
+
+class Job(models.Model):
+    # Work queued by base.jobs.enqueue and run by `manage.py run_jobs`
+    STATUS = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    job_type = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS, default='queued')
+    priority = models.IntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    # Running jobs of one type each hold a distinct slot below that type's
+    # concurrency limit; the unique constraint makes the limit hard.
+    slot = models.PositiveIntegerField(null=True, blank=True)
+    locked_by = models.CharField(max_length=255, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_after']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['job_type', 'slot'], condition=models.Q(status='running'),
+                name='unique_running_job_slot'),
+        ]
+
+    def __str__(self):
+        return f"{self.job_type} #{self.id} ({self.status})"
+
+
+class BalanceAuditEntry(models.Model):
+    # Append-only record of every wallet balance change, written in batches
+    # by base.audit. No database-level foreign keys, so entries outlive the
+    # wallets and users they mention and inserts never wait on them.
+    wallet = models.ForeignKey(
+        Wallet, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, related_name='+')
+    actor = models.ForeignKey(
+        CustomUser, on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True, related_name='+')
+    balance_before = MoneyField()
+    balance_after = MoneyField()
+    source = models.CharField(max_length=255)
+    # When the change was committed, not when the entry was flushed
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['wallet', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Balance audit entries cannot be changed")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Balance audit entries cannot be deleted")
+
+    def __str__(self):
+        return f"Wallet {self.wallet_id}: {self.balance_before} -> {self.balance_after}"
+
+
+class UserShard(models.Model):
+    # Directory of which database in settings.DATABASE_SHARDS holds a user's
+    # wallets, transactions and subscriptions (see base.sharding). Always
+    # kept on 'default'.
+    user = models.OneToOneField(
+        CustomUser, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    shard = models.CharField(max_length=64)
+    assigned_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shard']),
+        ]
+
+    def __str__(self):
+        return f"User {self.user_id} -> {self.shard}"
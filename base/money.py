@@ -0,0 +1,112 @@
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from django.core import exceptions, validators
+from django.db import connection, models
+from django.db.models.lookups import GreaterThanOrEqual, IntegerFieldOverflow, LessThan
+from django.utils.functional import cached_property
+
+# Every wallet currency we hold (USDT(TRC20), BNB) is accounted in hundredths,
+# which is also the precision the API has always exposed.
+MONEY_SCALE = 2
+
+
+def to_minor(value, scale=MONEY_SCALE):
+    """
+    Decimal (or anything Decimal() accepts) in major units -> int minor units.
+    Raises ValueError for NaN and infinities; huge amounts are not bounded
+    here, see MoneyField.
+    """
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    if not value.is_finite():
+        raise ValueError(f"{value} is not a finite amount")
+    return int(value.scaleb(scale).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_minor(minor, scale=MONEY_SCALE):
+    """int minor units -> Decimal in major units with `scale` places."""
+    return Decimal(int(minor)).scaleb(-scale)
+
+
+def percent_of(minor, rate, scale=MONEY_SCALE):
+    """
+    `rate` percent of an amount in minor units, rounded half-even to a whole
+    minor unit. Rates carry two decimal places, so this is pure integer math.
+    """
+    rate_hundredths = to_minor(rate, 2)
+    quotient, remainder = divmod(minor * rate_hundredths, 10000)
+    if remainder * 2 > 10000 or (remainder * 2 == 10000 and quotient % 2):
+        quotient += 1
+    return quotient
+
+
+class MoneyField(models.BigIntegerField):
+    """
+    Amount stored as a 64-bit integer count of minor units (cents). Python
+    code and the API keep seeing Decimals in major units, while the database
+    sums and compares plain integers.
+    """
+
+    def __init__(self, *args, scale=MONEY_SCALE, **kwargs):
+        self.scale = scale
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.scale != MONEY_SCALE:
+            kwargs['scale'] = self.scale
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return from_minor(value, self.scale)
+
+    @cached_property
+    def validators(self):
+        # The column's integer range, in major units
+        min_value, max_value = connection.ops.integer_field_range(self.get_internal_type())
+        return [
+            *self.default_validators,
+            *self._validators,
+            validators.MinValueValidator(from_minor(min_value, self.scale)),
+            validators.MaxValueValidator(from_minor(max_value, self.scale)),
+        ]
+
+    def to_python(self, value):
+        if value is None:
+            return value
+        try:
+            return from_minor(to_minor(value, self.scale), self.scale)
+        except (ValueError, ArithmeticError):
+            raise exceptions.ValidationError(
+                self.error_messages['invalid'], code='invalid', params={'value': value})
+
+    def get_prep_value(self, value):
+        if value is None or hasattr(value, 'resolve_expression'):
+            return value
+        try:
+            # Out of range values stay ints, for the lookups below to handle
+            return to_minor(value, self.scale)
+        except (ValueError, ArithmeticError) as e:
+            raise ValueError(
+                f"Field '{self.name}' expected a finite amount but got {value!r}.") from e
+
+    def formfield(self, **kwargs):
+        return models.DecimalField(
+            max_digits=18, decimal_places=self.scale).formfield(**kwargs)
+
+
+# IntegerField's gte and lt round float values up to whole numbers, which
+# would be whole major units here; these convert them like any other amount
+# but keep the overflow handling, so amounts past the column's range match
+# everything or nothing rather than fail.
+@MoneyField.register_lookup
+class MoneyGreaterThanOrEqual(IntegerFieldOverflow, GreaterThanOrEqual):
+    underflow_exception = exceptions.FullResultSet
+
+
+@MoneyField.register_lookup
+class MoneyLessThan(IntegerFieldOverflow, LessThan):
+    overflow_exception = exceptions.FullResultSet
+
@@ -0,0 +1,119 @@
+"""
+USD prices for the assets our wallets hold.
+
+Prices come from the provider named by PRICE_FEED_PROVIDER and are kept in
+memory for PRICE_FEED_TTL_SECONDS. Once they are stale the next lookup
+starts a background refresh and still answers with the last known prices,
+so request threads never wait on the provider; if the provider fails the
+last known prices keep being served. Only the first lookup in a process,
+with no prices to fall back on, waits for the provider.
+"""
+import logging
+import threading
+import time
+from decimal import ROUND_HALF_EVEN, Decimal
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .money import MONEY_SCALE
+
+logger = logging.getLogger(__name__)
+
+# Wallet title (see signals.create_user_wallets) -> asset symbol
+WALLET_ASSETS = {
+    'USDT(TRC20)': 'USDT',
+    'BNB': 'BNB',
+}
+
+
+class StubPriceProvider:
+    # Fixed prices from PRICE_FEED_STUB_PRICES, for development and tests
+    def fetch(self, assets):
+        prices = settings.PRICE_FEED_STUB_PRICES
+        return {asset: Decimal(prices[asset]) for asset in assets if asset in prices}
+
+
+class CoinGeckoPriceProvider:
+    URL = 'https://api.coingecko.com/api/v3/simple/price'
+    COIN_IDS = {
+        'USDT': 'tether',
+        'BNB': 'binancecoin',
+    }
+
+    def fetch(self, assets):
+        import requests
+
+        ids = {self.COIN_IDS[asset]: asset for asset in assets if asset in self.COIN_IDS}
+        response = requests.get(
+            self.URL, params={'ids': ','.join(ids), 'vs_currencies': 'usd'},
+            timeout=settings.PRICE_FEED_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        return {ids[coin]: Decimal(str(quote['usd']))
+                for coin, quote in response.json().items() if coin in ids}
+
+
+class PriceFeed:
+    def __init__(self, provider, assets):
+        self.provider = provider
+        self.assets = tuple(assets)
+        self._prices = {}
+        self._next_refresh = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._cold = True
+        self._cold_lock = threading.Lock()
+
+    def prices(self):
+        """Last known asset -> USD price; refreshes in the background when stale."""
+        if self._cold:
+            with self._cold_lock:
+                if self._cold:
+                    with self._lock:
+                        self._refreshing = True
+                    self.refresh()
+                    self._cold = False
+        with self._lock:
+            start = not self._refreshing and time.monotonic() >= self._next_refresh
+            if start:
+                self._refreshing = True
+        if start:
+            threading.Thread(target=self.refresh, name='price-feed', daemon=True).start()
+        return self._prices
+
+    def refresh(self):
+        try:
+            fetched = self.provider.fetch(self.assets)
+        except Exception:
+            logger.warning("Price provider failed; serving last known prices",
+                           exc_info=True)
+            delay = settings.PRICE_FEED_RETRY_SECONDS
+        else:
+            # Swap in a new dict so readers never see a half-updated one
+            self._prices = {**self._prices, **fetched}
+            delay = settings.PRICE_FEED_TTL_SECONDS
+        with self._lock:
+            self._next_refresh = time.monotonic() + delay
+            self._refreshing = False
+
+
+@lru_cache(maxsize=None)
+def get_price_feed():
+    provider = import_string(settings.PRICE_FEED_PROVIDER)()
+    return PriceFeed(provider, set(WALLET_ASSETS.values()))
+
+
+def price_snapshot(context):
+    # One set of prices per response, so every row is valued consistently
+    if 'prices' not in context:
+        context['prices'] = get_price_feed().prices()
+    return context['prices']
+
+
+def usd_value(title, balance, prices):
+    # None when the wallet's asset has no known price yet
+    price = prices.get(WALLET_ASSETS.get(title))
+    if price is None or balance is None:
+        return None
+    return (balance * price).quantize(Decimal(1).scaleb(-MONEY_SCALE), ROUND_HALF_EVEN)
@@ -0,0 +1,140 @@
+"""
+On-demand profiling of single requests for staff. A request carrying an
+`X-Profile: 1` header (or `?profile=1`) runs under cProfile with every SQL
+statement timed; the report lands in PROFILE_DIR, which keeps only the
+newest PROFILE_KEEP reports.
+"""
+import cProfile
+import json
+import pstats
+import re
+import time
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+PROFILE_ID = re.compile(r'^[0-9]{20}-[0-9a-f]{32}$')
+HOTSPOT_LIMIT = 40
+
+
+def profile_requested(request):
+    return (request.headers.get('X-Profile') == '1'
+            or request.GET.get('profile') == '1')
+
+
+def profile_dir():
+    path = Path(settings.PROFILE_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+class QueryRecorder:
+    # Installed with connection.execute_wrapper() on every database alias
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'alias': context['connection'].alias,
+                'sql': sql,
+                'many': many,
+                'ms': round((time.perf_counter() - start) * 1000, 3),
+            })
+
+
+def hotspots(profiler, limit=HOTSPOT_LIMIT):
+    rows = []
+    stats = pstats.Stats(profiler)
+    for (filename, line, function), (calls, _, own, cumulative, _) in stats.stats.items():
+        rows.append({
+            'function': f'{filename}:{line}({function})',
+            'calls': calls,
+            'own_ms': round(own * 1000, 3),
+            'cumulative_ms': round(cumulative * 1000, 3),
+        })
+    rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+    return rows[:limit]
+
+
+def profile_request(request, get_response, user_id):
+    """
+    Run `get_response(request)` under the profiler and save its report.
+    Returns the response with an X-Profile-Id header naming the report.
+    """
+    recorder = QueryRecorder()
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        profiler.enable()
+        try:
+            response = get_response(request)
+        finally:
+            profiler.disable()
+    elapsed = time.perf_counter() - started
+
+    profile_id = f"{timezone.now():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex}"
+    report = {
+        'id': profile_id,
+        'method': request.method,
+        'path': request.get_full_path(),
+        'user': user_id,
+        'status': response.status_code,
+        'ms': round(elapsed * 1000, 3),
+        'sql_ms': round(sum(query['ms'] for query in recorder.queries), 3),
+        'queries': recorder.queries,
+        'hotspots': hotspots(profiler),
+    }
+    save_profile(profile_id, report, profiler)
+    response['X-Profile-Id'] = profile_id
+    return response
+
+
+def save_profile(profile_id, report, profiler):
+    directory = profile_dir()
+    # The raw stats load straight into pstats, snakeviz and friends
+    profiler.dump_stats(directory / f'{profile_id}.prof')
+    # Listings only read finished reports
+    partial = directory / f'{profile_id}.tmp'
+    partial.write_text(json.dumps(report, default=str))
+    partial.replace(directory / f'{profile_id}.json')
+    trim_profiles(directory)
+
+
+def trim_profiles(directory):
+    # Ids start with a timestamp, so name order is age order
+    reports = sorted(directory.glob('*.json'))
+    for stale in reports[:max(len(reports) - settings.PROFILE_KEEP, 0)]:
+        stale.unlink(missing_ok=True)
+        stale.with_suffix('.prof').unlink(missing_ok=True)
+
+
+def list_profiles():
+    summaries = []
+    for path in sorted(profile_dir().glob('*.json'), reverse=True):
+        try:
+            report = json.loads(path.read_text())
+        except OSError:
+            # Trimmed by another process in the meantime
+            continue
+        summaries.append({key: report[key] for key in (
+            'id', 'method', 'path', 'user', 'status', 'ms', 'sql_ms')}
+            | {'queries': len(report['queries'])})
+    return summaries
+
+
+def profile_path(profile_id, suffix='.json'):
+    # Returns None for ids that were never issued or have been trimmed
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = profile_dir() / f'{profile_id}{suffix}'
+    return path if path.exists() else None
@@ -0,0 +1,118 @@
+"""
+Wallet balance reconciliation against the ledger.
+
+A wallet's expected balance is what its history implies: done deposits
+minus done withdrawals (hot and archived), minus the principal of every
+subscription paid from it, plus principal and return of the subscriptions
+already settled back into it. Wallets are checked in id ranges so the
+ranges can be spread across processes.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connections, transaction
+from django.db.models import Case, F, Max, Min, Sum, When
+
+from .audit import audit_context
+from .db_routers import use_primary
+from .ledger import apply_balance_deltas, net_amounts_by_wallet
+from .models import ArchivedTransaction, InvestmentSubscription, Transaction, Wallet
+from .money import MoneyField
+from .sharding import fan_out, ledger_db, shard_for_id, use_shard
+
+
+def wallet_id_ranges(partition_size):
+    # Half-open [start, stop) ranges of wallet ids covering every wallet;
+    # each range lies within one shard's ids
+    ranges = []
+    for bounds in fan_out(
+            lambda shard: Wallet.objects.aggregate(first=Min('id'), last=Max('id'))):
+        if bounds['first'] is not None:
+            ranges += [(start, min(start + partition_size, bounds['last'] + 1))
+                       for start in range(bounds['first'], bounds['last'] + 1, partition_size)]
+    return ranges
+
+
+def expected_balances(start, stop, wallet_ids=None):
+    """
+    Expected balance of every wallet with an id in [start, stop), or only
+    of those in `wallet_ids`.
+    """
+    in_range = {'wallet_id__gte': start, 'wallet_id__lt': stop}
+    if wallet_ids is not None:
+        in_range['wallet_id__in'] = wallet_ids
+    expected = defaultdict(Decimal)
+    for model in (Transaction, ArchivedTransaction):
+        for wallet_id, net in net_amounts_by_wallet(
+                model.objects.filter(status='done', **in_range)).items():
+            expected[wallet_id] += net
+
+    money = MoneyField()
+    subscriptions = (
+        InvestmentSubscription.objects.filter(**in_range)
+        .order_by()
+        .values('wallet')
+        .annotate(
+            invested=Sum('amount'),
+            paid_out=Sum(Case(
+                When(settled=True, then=F('amount') + F('total_return')),
+                default=0, output_field=money)),
+        )
+        .values_list('wallet', 'invested', 'paid_out')
+    )
+    for wallet_id, invested, paid_out in subscriptions:
+        expected[wallet_id] += (paid_out or 0) - invested
+    return expected
+
+
+def reconcile_range(start, stop, repair=False, batch_size=1000):
+    """
+    Compare the wallets with ids in [start, stop) with their ledger.
+    Returns (wallets checked, mismatches, wallets repaired); each mismatch
+    is a dict with the wallet, its user, balance, expected balance and diff.
+    """
+    with use_primary(), use_shard(shard_for_id(start)):
+        expected = expected_balances(start, stop)
+        mismatches = []
+        checked = 0
+        for wallet_id, user_id, balance in Wallet.objects.filter(
+                id__gte=start, id__lt=stop).values_list('id', 'user_id', 'balance'):
+            checked += 1
+            should_be = expected.get(wallet_id, Decimal(0))
+            if balance != should_be:
+                mismatches.append({
+                    'wallet': wallet_id,
+                    'user': user_id,
+                    'balance': balance,
+                    'expected': should_be,
+                    'diff': balance - should_be,
+                })
+
+        repaired = 0
+        if repair:
+            # The check reads balances and ledger in separate statements, so
+            # money that moved in between looks like a mismatch. Each batch
+            # locks its wallets, which holds off further moves, and compares
+            # them with their ledger again before anything is corrected.
+            for offset in range(0, len(mismatches), batch_size):
+                wallet_ids = [row['wallet'] for row in mismatches[offset:offset + batch_size]]
+                with transaction.atomic(using=ledger_db()), \
+                        audit_context('command:reconcile_wallets'):
+                    balances = Wallet.objects.select_for_update().filter(
+                        id__in=wallet_ids).order_by('id').values_list('id', 'balance')
+                    expected = expected_balances(start, stop, wallet_ids)
+                    repaired += apply_balance_deltas({
+                        wallet_id: expected.get(wallet_id, Decimal(0)) - balance
+                        for wallet_id, balance in balances})
+    return checked, mismatches, repaired
+
+
+def reconcile_worker_init():
+    # Forked workers must not share the parent's database connections
+    import django
+    django.setup()
+    connections.close_all()
+
+
+def reconcile_range_job(args):
+    return reconcile_range(*args)
@@ -0,0 +1,160 @@
+import logging
+from decimal import Decimal
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import (Case, Exists, F, OuterRef, Subquery, Sum,
+                              Value, When)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Wallet, WalletDailyBalance
+from .money import MoneyField
+
+logger = logging.getLogger(__name__)
+
+
+def as_decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def record_balance_change(wallet, previous_balance):
+    """
+    Fold a change of `wallet.balance` from `previous_balance` into today's
+    rollup row, creating the row on the wallet's first change of the day.
+    """
+    balance = as_decimal(wallet.balance)
+    delta = balance - as_decimal(previous_balance)
+    inflow = max(delta, Decimal(0))
+    outflow = max(-delta, Decimal(0))
+    today = timezone.localdate()
+    money = MoneyField()
+    # The rows live on the wallet's own shard
+    rollups = WalletDailyBalance.objects.db_manager(hints={'instance': wallet})
+
+    def update_today():
+        return rollups.filter(wallet_id=wallet.id, day=today).update(
+            balance=balance,
+            inflow=F('inflow') + Value(inflow, output_field=money),
+            outflow=F('outflow') + Value(outflow, output_field=money),
+        )
+
+    if update_today():
+        return
+    try:
+        with transaction.atomic(using=router.db_for_write(WalletDailyBalance, instance=wallet)):
+            rollups.create(
+                wallet_id=wallet.id, day=today, balance=balance,
+                inflow=inflow, outflow=outflow)
+    except IntegrityError:
+        # Another request created today's row first
+        update_today()
+
+
+def record_balance_deltas(deltas):
+    """
+    Set-based counterpart of record_balance_change for bulk updates that
+    bypass Wallet.save(): `deltas` maps wallet ids to the amount their
+    balance has just moved by.
+    """
+    deltas = {wallet_id: as_decimal(delta)
+              for wallet_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    today = timezone.localdate()
+    money = MoneyField()
+    balances = dict(Wallet.objects.filter(
+        id__in=deltas).values_list('id', 'balance'))
+
+    def per_wallet(values):
+        return Case(
+            *(When(wallet_id=wallet_id, then=Value(value, output_field=money))
+              for wallet_id, value in values.items()),
+            default=Value(Decimal(0), output_field=money), output_field=money)
+
+    pending = {wallet_id for wallet_id in deltas if wallet_id in balances}
+    while pending:
+        existing = set(WalletDailyBalance.objects.filter(
+            wallet_id__in=pending, day=today).values_list('wallet_id', flat=True))
+        if existing:
+            WalletDailyBalance.objects.filter(wallet_id__in=existing, day=today).update(
+                balance=per_wallet({wallet_id: balances[wallet_id] for wallet_id in existing}),
+                inflow=F('inflow') + per_wallet(
+                    {wallet_id: max(deltas[wallet_id], Decimal(0)) for wallet_id in existing}),
+                outflow=F('outflow') + per_wallet(
+                    {wallet_id: max(-deltas[wallet_id], Decimal(0)) for wallet_id in existing}),
+            )
+        pending -= existing
+        try:
+            with transaction.atomic(using=router.db_for_write(WalletDailyBalance)):
+                WalletDailyBalance.objects.bulk_create([
+                    WalletDailyBalance(
+                        wallet_id=wallet_id, day=today, balance=balances[wallet_id],
+                        inflow=max(deltas[wallet_id], Decimal(0)),
+                        outflow=max(-deltas[wallet_id], Decimal(0)))
+                    for wallet_id in pending
+                ])
+        except IntegrityError:
+            # Another transaction created some of today's rows after they
+            # were looked up; add to those rather than drop the moves
+            continue
+        break
+
+
+def roll_up_wallet_balances(day=None, batch_size=1000):
+    """
+    Write a rollup row for `day` (yesterday by default) for every wallet
+    that did not change that day, carrying its previous end-of-day balance
+    forward. Returns the number of rows created.
+    """
+    if day is None:
+        day = timezone.localdate() - timezone.timedelta(days=1)
+    money = MoneyField()
+
+    previous_balance = WalletDailyBalance.objects.filter(
+        wallet=OuterRef('pk'), day__lt=day).order_by('-day').values('balance')[:1]
+    # Wallets without history: undo whatever moved after `day`
+    later_net_flow = (
+        WalletDailyBalance.objects
+        .filter(wallet=OuterRef('pk'), day__gt=day)
+        .values('wallet')
+        .annotate(net=Sum(F('inflow') - F('outflow')))
+        .values('net')
+    )
+    wallets = (
+        Wallet.objects
+        .exclude(Exists(WalletDailyBalance.objects.filter(
+            wallet=OuterRef('pk'), day=day)))
+        .annotate(closing_balance=Coalesce(
+            Subquery(previous_balance, output_field=money),
+            F('balance') - Coalesce(
+                Subquery(later_net_flow, output_field=money),
+                Value(Decimal(0), output_field=money), output_field=money),
+            output_field=money,
+        ))
+        .values_list('id', 'closing_balance')
+    )
+
+    created = 0
+    batch = []
+    for wallet_id, closing_balance in wallets.iterator(chunk_size=batch_size):
+        batch.append(WalletDailyBalance(
+            wallet_id=wallet_id, day=day, balance=closing_balance))
+        if len(batch) >= batch_size:
+            created += len(WalletDailyBalance.objects.bulk_create(
+                batch, ignore_conflicts=True))
+            batch = []
+    if batch:
+        created += len(WalletDailyBalance.objects.bulk_create(
+            batch, ignore_conflicts=True))
+    logger.info(f"Rolled up {created} wallet balances for {day}")
+    return created
+
+
+def balance_history(wallet, days):
+    start = timezone.localdate() - timezone.timedelta(days=days - 1)
+    return (
+        WalletDailyBalance.objects
+        .filter(wallet=wallet, day__gte=start)
+        .order_by('day')
+        .values('day', 'balance', 'inflow', 'outflow')
+    )
@@ -0,0 +1,224 @@
+import re
+import threading
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection
+from django.db.models import Case, FloatField, Q, Value, When
+from django.db.models.functions import Greatest
+
+from .models import CustomUser, Transaction, Wallet
+from .money import to_minor
+from .sharding import fan_out, shards, use_shard
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+MIN_QUERY_LENGTH = 2
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+def parse_amount(query):
+    # Only amounts a money column can hold; "nan", "inf" or "1e40" are text
+    try:
+        amount = Decimal(query.replace(',', ''))
+    except InvalidOperation:
+        return None
+    if not amount.is_finite():
+        return None
+    min_value, max_value = connection.ops.integer_field_range('BigIntegerField')
+    if not min_value <= to_minor(amount) <= max_value:
+        return None
+    return amount
+
+
+def result(kind, obj_id, label, score):
+    return {'type': kind, 'id': obj_id, 'label': label, 'score': round(score, 3)}
+
+
+class InvertedIndex:
+    """
+    In-process prefix index over the searchable text columns, standing in
+    for the PostgreSQL trigram indexes when running on SQLite. Every prefix
+    of every token is a posting key, so type-ahead lookups are one dict hit
+    per query term.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = defaultdict(set)
+        self.documents = {}
+        self.built = False
+
+    def build(self):
+        with self.lock:
+            if self.built:
+                return
+            for user_id, email, full_name in CustomUser.objects.values_list(
+                    'id', 'email', 'full_name').iterator():
+                self._add(('user', user_id), email, f'{email} {full_name or ""}')
+            for shard in shards():
+                with use_shard(shard):
+                    for wallet_id, title, address in Wallet.objects.values_list(
+                            'id', 'title', 'wallet_address').iterator():
+                        self._add(('wallet', wallet_id), f'{title} {address}', address)
+                    for transaction_id, address in Transaction.objects.exclude(
+                            wallet_address=None).values_list('id', 'wallet_address').iterator():
+                        self._add(('transaction', transaction_id), address, address)
+            self.built = True
+
+    def _add(self, key, label, text):
+        self._remove(key)
+        tokens = set(tokenize(text))
+        self.documents[key] = (label, tokens)
+        for token in tokens:
+            for end in range(1, len(token) + 1):
+                self.postings[token[:end]].add(key)
+
+    def _remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        for token in document[1]:
+            for end in range(1, len(token) + 1):
+                keys = self.postings.get(token[:end])
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.postings[token[:end]]
+
+    def clear(self):
+        # Forget every document; the next search builds the index again
+        with self.lock:
+            self.postings.clear()
+            self.documents.clear()
+            self.built = False
+
+    def update(self, key, label, text):
+        with self.lock:
+            if self.built:
+                self._add(key, label, text)
+
+    def remove(self, key):
+        with self.lock:
+            if self.built:
+                self._remove(key)
+
+    def search(self, query, limit):
+        self.build()
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self.lock:
+            matches = set.intersection(
+                *(self.postings.get(term, set()) for term in terms))
+            results = []
+            for key in matches:
+                label, tokens = self.documents[key]
+                # Each term scores by how much of the token it covers, so
+                # exact tokens rank above mere prefixes.
+                score = sum(
+                    max(len(term) / len(token)
+                        for token in tokens if token.startswith(term))
+                    for term in terms
+                ) / len(terms)
+                results.append(result(key[0], key[1], label, score))
+        results.sort(key=lambda row: (-row['score'], row['type'], row['id']))
+        return results[:limit]
+
+
+local_index = InvertedIndex()
+
+
+def similarity_rank(query, *fields):
+    from django.contrib.postgres.search import TrigramSimilarity
+
+    similarities = [TrigramSimilarity(field, query) for field in fields]
+    similarity = Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+    # Prefix matches always outrank fuzzy substring matches
+    return Case(
+        *(When(**{f'{field}__istartswith': query}, then=Value(1.0)) for field in fields),
+        default=similarity,
+        output_field=FloatField(),
+    )
+
+
+def contains_any(query, *fields):
+    condition = Q()
+    for field in fields:
+        condition |= Q(**{f'{field}__icontains': query})
+    return condition
+
+
+def postgres_search(query, limit):
+    results = []
+    users = (
+        CustomUser.objects
+        .filter(contains_any(query, 'email', 'full_name'))
+        .annotate(score=similarity_rank(query, 'email', 'full_name'))
+        .order_by('-score')
+        .values_list('id', 'email', 'full_name', 'score')[:limit]
+    )
+    results += [result('user', user_id, email, score)
+                for user_id, email, full_name, score in users]
+
+    def ledger_matches(shard):
+        wallets = (
+            Wallet.objects
+            .filter(contains_any(query, 'wallet_address'))
+            .annotate(score=similarity_rank(query, 'wallet_address'))
+            .order_by('-score')
+            .values_list('id', 'title', 'wallet_address', 'score')[:limit]
+        )
+        matches = [result('wallet', wallet_id, f'{title} {address}', score)
+                   for wallet_id, title, address, score in wallets]
+
+        transactions = (
+            Transaction.objects
+            .filter(contains_any(query, 'wallet_address'))
+            .annotate(score=similarity_rank(query, 'wallet_address'))
+            .order_by('-score')
+            .values_list('id', 'wallet_address', 'score')[:limit]
+        )
+        return matches + [result('transaction', transaction_id, address, score)
+                          for transaction_id, address, score in transactions]
+
+    for matches in fan_out(ledger_matches):
+        results += matches
+
+    results.sort(key=lambda row: (-row['score'], row['type'], row['id']))
+    return results[:limit]
+
+
+def amount_search(query, limit):
+    amount = parse_amount(query)
+    if amount is None:
+        return []
+    transactions = []
+    for rows in fan_out(lambda shard: list(Transaction.objects.filter(amount=amount).order_by(
+            '-id').values_list('id', 'transaction_type', 'amount')[:limit])):
+        transactions += rows
+    transactions.sort(reverse=True)
+    return [result('transaction', transaction_id, f'{transaction_type} {amount}', 1.0)
+            for transaction_id, transaction_type, amount in transactions[:limit]]
+
+
+def search(query, limit=20):
+    """
+    Ranked matches for `query` across users (email, full name), wallet
+    addresses and transactions (address or exact amount).
+    """
+    query = query.strip()
+    if len(query) < MIN_QUERY_LENGTH:
+        return []
+    if connection.vendor == 'postgresql':
+        results = postgres_search(query, limit)
+    else:
+        results = local_index.search(query, limit)
+    ranked, seen = [], set()
+    for row in amount_search(query, limit) + results:
+        if (row['type'], row['id']) not in seen:
+            seen.add((row['type'], row['id']))
+            ranked.append(row)
+    return ranked[:limit]
@@ -1,11 +1,37 @@
 from decimal import Decimal
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db.models import Sum
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.templatetags.static import static
 from django.utils.dateformat import DateFormat
 
+from .archive import full_transaction_history, wants_full_history
+from .fast_serializers import serialize_rows
+from .jobs import check_payload
 from .models import *
+from .money import MONEY_SCALE
+from .prices import price_snapshot, usd_value
+from .sharding import use_user_shard
+
+
+class MoneySerializerField(serializers.DecimalField):
+    # Renders MoneyField values exactly like the former DecimalField columns
+    def __init__(self, **kwargs):
+        kwargs.setdefault('max_digits', 18)
+        kwargs.setdefault('decimal_places', MONEY_SCALE)
+        super().__init__(**kwargs)
+
+
+class SparseFieldsMixin:
+    # Renders only the fields listed in context['fields'] (from ?fields=),
+    # ignoring names the serializer does not have
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        wanted = set(self.context.get('fields') or ()) & set(self.fields)
+        for name in set(self.fields) - wanted if wanted else ():
+            self.fields.pop(name)
 
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
@@ -58,6 +84,9 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class WalletSerializer(serializers.ModelSerializer):
+    balance = MoneySerializerField(required=False)
+    usd_value = serializers.SerializerMethodField()
+
     class Meta:
         model = Wallet
         fields = [
@@ -65,7 +94,26 @@ class WalletSerializer(serializers.ModelSerializer):
             'user',
             'title',
             'wallet_address',
-            'balance'
+            'balance',
+            'usd_value'
+        ]
+
+    def get_usd_value(self, wallet):
+        return usd_value(wallet.title, wallet.balance, price_snapshot(self.context))
+
+
+class WalletDailyBalanceSerializer(serializers.ModelSerializer):
+    balance = MoneySerializerField()
+    inflow = MoneySerializerField()
+    outflow = MoneySerializerField()
+
+    class Meta:
+        model = WalletDailyBalance
+        fields = [
+            'day',
+            'balance',
+            'inflow',
+            'outflow'
         ]
 
 
@@ -82,7 +130,9 @@ class InvestmentSerializer(serializers.ModelSerializer):
         ]
 
 
-class InvestmentSubscriptionSerializer(serializers.ModelSerializer):
+class InvestmentSubscriptionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    amount = MoneySerializerField()
+    total_return = MoneySerializerField(source='current_return', read_only=True)
     subscription_date = serializers.SerializerMethodField()
     end_date = serializers.SerializerMethodField()
     wallet_title = serializers.SerializerMethodField()
@@ -100,8 +150,10 @@ class InvestmentSubscriptionSerializer(serializers.ModelSerializer):
             'amount',
             'subscription_date',
             'end_date',
-            'total_return'
+            'total_return',
+            'settled',
         ]
+        read_only_fields = ['settled']
 
     def validate(self, data):
         # Retrieve the investment plan and amount from the validated data
@@ -139,7 +191,8 @@ class InvestmentSubscriptionSerializer(serializers.ModelSerializer):
         return DateFormat(obj.end_date).format('F j, Y')
 
 
-class TransactionSerializer(serializers.ModelSerializer):
+class TransactionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    amount = MoneySerializerField()
     date = serializers.SerializerMethodField()
     wallet_title = serializers.SerializerMethodField()
     user_name = serializers.SerializerMethodField()
@@ -177,6 +230,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
     transactions = serializers.SerializerMethodField()
     investment = serializers.SerializerMethodField()
     total_wallet_balance = serializers.SerializerMethodField()
+    total_usd_value = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfile
@@ -186,26 +240,94 @@ class UserProfileSerializer(serializers.ModelSerializer):
             'wallets',
             'transactions',
             'investment',
-            'total_wallet_balance'
+            'total_wallet_balance',
+            'total_usd_value'
         ]
 
+    def to_representation(self, instance):
+        # Everything below comes from the user's own shard
+        with use_user_shard(instance.user_id):
+            return super().to_representation(instance)
+
     def get_total_wallet_balance(self, user_profile):
-        # Get all wallets belonging to the user profile
-        wallets = Wallet.objects.filter(user=user_profile.user)
-        # Calculate the total balance by summing the balances of all wallets
-        total_balance = sum(wallet.balance for wallet in wallets)
+        # Sum the balances of all the user's wallets in the database
+        total_balance = Wallet.objects.filter(
+            user=user_profile.user).aggregate(total=Sum('balance'))['total']
         # Return the total balance as a Decimal
-        return Decimal(total_balance)
+        return Decimal(total_balance or 0)
+
+    def get_total_usd_value(self, user_profile):
+        # Unlike total_wallet_balance this adds up like-for-like amounts;
+        # None until every wallet's asset has a price
+        prices = price_snapshot(self.context)
+        total = Decimal(0)
+        for title, balance in Wallet.objects.filter(
+                user=user_profile.user).values_list('title', 'balance'):
+            value = usd_value(title, balance, prices)
+            if value is None:
+                return None
+            total += value
+        return total
 
     def get_wallets(self, wallet):
         wallets = Wallet.objects.filter(user=wallet.user)
-        return WalletSerializer(wallets, many=True, context=self.context).data
+        return serialize_rows(WalletSerializer, wallets, self.context)
 
     def get_transactions(self, transactions):
-        transactions = Transaction.objects.filter(user=transactions.user)
-        return TransactionSerializer(transactions, many=True, context=self.context).data
+        user = transactions.user
+        transactions = Transaction.objects.filter(user=user)
+        if wants_full_history(self.context.get('request')):
+            transactions = full_transaction_history(
+                transactions.select_related('wallet', 'user'),
+                ArchivedTransaction.objects.filter(user=user).select_related('wallet', 'user'))
+            return TransactionSerializer(transactions, many=True, context=self.context).data
+        return serialize_rows(TransactionSerializer, transactions, self.context)
 
     def get_investment(self, investment_subscription):
         investment_subscription = InvestmentSubscription.objects.filter(
             user=investment_subscription.user)
-        return InvestmentSubscriptionSerializer(investment_subscription, many=True, context=self.context).data
+        return serialize_rows(InvestmentSubscriptionSerializer, investment_subscription, self.context)
+
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = [
+            'id',
+            'job_type',
+            'payload',
+            'priority',
+            'status',
+            'attempts',
+            'max_attempts',
+            'run_after',
+            'result',
+            'error',
+            'created_at',
+            'finished_at'
+        ]
+        read_only_fields = [
+            'status',
+            'attempts',
+            'run_after',
+            'result',
+            'error',
+            'created_at',
+            'finished_at'
+        ]
+
+    def validate(self, attrs):
+        # Workers call the handler with the payload as keyword arguments
+        if 'job_type' in attrs:
+            try:
+                check_payload(attrs['job_type'], attrs.get('payload', {}))
+            except ValueError as error:
+                raise serializers.ValidationError({'payload': str(error)})
+        return attrs
+
+
+class TransactionSettleSerializer(serializers.Serializer):
+    transaction_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False,
+        max_length=settings.TRANSACTION_SETTLE_MAX_IDS)
+    status = serializers.ChoiceField(choices=['done', 'declined'])
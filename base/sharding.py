@@ -0,0 +1,290 @@
+"""
+Horizontal sharding of the ledger (wallets, their daily balances,
+transactions and subscriptions) by user.
+
+Every alias in settings.DATABASE_SHARDS holds the ledger rows of the users
+the UserShard directory places on it; 'default' is always the first shard
+and keeps every other table, the directory included. Ledger ids are unique
+across shards because shard number n hands out ids from
+n * SHARD_ID_SPAN upwards, so an id alone says where its row lives.
+
+Queries go to the shard pinned with use_shard() (the request's user, see
+ShardRoutingMiddleware), or to the shard of the instance they are made
+through. Users and investment plans are copied onto the shards that
+reference them, so foreign keys hold within each database. Staff views
+and jobs that span users run on every shard with fan_out().
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connections, router
+
+from .models import (ArchivedTransaction, CustomUser, Investment, InvestmentSubscription,
+                     Transaction, UserShard, Wallet, WalletDailyBalance)
+
+LEDGER_MODELS = (Wallet, WalletDailyBalance, Transaction, ArchivedTransaction,
+                 InvestmentSubscription)
+
+# Ledger tables with their own id sequence (archived rows keep the id they
+# had as transactions)
+SEQUENCED_MODELS = (Wallet, WalletDailyBalance, Transaction, InvestmentSubscription)
+
+# Tables on the shards other than 'default': the ledger, the copies of the
+# users and plans it points at, and what the users' permission tables
+# point at in turn
+SHARD_TABLES = {model._meta.label_lower for model in (
+    *LEDGER_MODELS, CustomUser, Investment, Group, Permission, ContentType)}
+
+# Shard the current request or job works on; None leaves it to the hints
+_current_shard = ContextVar('current_shard', default=None)
+
+
+def shards():
+    return getattr(settings, 'DATABASE_SHARDS', ['default'])
+
+
+def is_sharded():
+    return len(shards()) > 1
+
+
+@contextmanager
+def use_shard(alias):
+    # Route ledger queries without a more specific hint to `alias`
+    token = _current_shard.set(alias)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+
+def current_shard():
+    return _current_shard.get()
+
+
+def place_user(user_id):
+    # Where a user without a directory entry goes
+    return shards()[user_id % len(shards())]
+
+
+def shard_cache_key(user_id):
+    return f'user-shard:{user_id}'
+
+
+def shard_for_user(user_id):
+    """The shard holding `user_id`'s ledger, placing the user on first use."""
+    if not is_sharded():
+        return 'default'
+    alias = cache.get(shard_cache_key(user_id))
+    if alias is None:
+        entry, _ = UserShard.objects.using('default').get_or_create(
+            user_id=user_id, defaults={'shard': place_user(user_id)})
+        alias = entry.shard
+        # Dropped when the directory entry changes, see forget_user_shard()
+        cache.set(shard_cache_key(user_id), alias, settings.USER_SHARD_CACHE_SECONDS)
+    return alias
+
+
+def forget_user_shard(user_id):
+    cache.delete(shard_cache_key(user_id))
+
+
+def use_user_shard(user_id):
+    return use_shard(shard_for_user(user_id))
+
+
+def shard_for_id(object_id):
+    # Ledger ids carry their shard, see reserve_id_range()
+    try:
+        index = int(object_id) // settings.SHARD_ID_SPAN
+    except (TypeError, ValueError):
+        return 'default'
+    return shards()[index] if 0 <= index < len(shards()) else 'default'
+
+
+def group_by_shard(object_ids):
+    groups = {}
+    for object_id in object_ids:
+        groups.setdefault(shard_for_id(object_id), []).append(object_id)
+    return groups
+
+
+def ledger_db():
+    # The database ledger writes in the current context go to
+    return router.db_for_write(Wallet)
+
+
+def shard_of(instance):
+    if instance is None:
+        return None
+    if isinstance(instance, LEDGER_MODELS):
+        if instance._state.db is not None:
+            # Rows read from a replica still belong to 'default'
+            return instance._state.db if instance._state.db in shards() else 'default'
+        return shard_for_user(instance.user_id) if getattr(instance, 'user_id', None) else None
+    if isinstance(instance, CustomUser) and instance.pk is not None:
+        return shard_for_user(instance.pk)
+    return None
+
+
+class ShardRouter:
+    """
+    Sends ledger queries to their shard. Queries bound for 'default' are
+    left to the next router, so reads there still use the replicas.
+    """
+
+    def ledger_shard(self, model, hints):
+        if model not in LEDGER_MODELS or not is_sharded():
+            return None
+        alias = shard_of(hints.get('instance')) or current_shard()
+        return None if alias == 'default' else alias
+
+    def db_for_read(self, model, **hints):
+        return self.ledger_shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.ledger_shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Ledger rows point at users and plans kept on 'default' and copied
+        # to their shard
+        if isinstance(obj1, LEDGER_MODELS) or isinstance(obj2, LEDGER_MODELS):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in shards()[1:]:
+            return None
+        if model_name is None:
+            # Data migrations: only this app's know which tables a shard has
+            return app_label == 'base'
+        return f'{app_label}.{model_name}' in SHARD_TABLES
+
+
+def fan_out(func, aliases=None):
+    """
+    Call func(alias) for every shard, in parallel and each inside
+    use_shard(alias), and return the results in shard order.
+    """
+    aliases = list(aliases or shards())
+    context = copy_context()
+
+    def run(alias):
+        try:
+            with use_shard(alias):
+                return func(alias)
+        finally:
+            connections.close_all()
+
+    if len(aliases) == 1 or any(connections[alias].in_atomic_block for alias in aliases):
+        # Inside a transaction the shards are visited in turn in this thread,
+        # whose connections see the transaction's uncommitted writes
+        results = []
+        for alias in aliases:
+            with use_shard(alias):
+                results.append(func(alias))
+        return results
+    with ThreadPoolExecutor(max_workers=len(aliases)) as pool:
+        # Each call runs in a copy of the caller's context, so primary pins
+        # and audit sources carry over into the worker threads
+        return list(pool.map(lambda alias: context.copy().run(run, alias), aliases))
+
+
+def fan_out_rows(queryset, render):
+    """
+    Rows of `queryset` from every shard, rendered per shard by
+    render(shard_queryset), in the order the queryset asks for.
+    """
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering or ['pk'])
+    if not {'pk', 'id', '-pk', '-id'} & set(ordering):
+        # A unique last key keeps both queries below in the same order
+        ordering.append('pk')
+    keys = [field.lstrip('-') for field in ordering]
+
+    def shard_rows(alias):
+        shard_queryset = queryset.using(alias).order_by(*ordering)
+        return list(zip(shard_queryset.values_list(*keys), render(shard_queryset)))
+
+    rows = [row for shard in fan_out(shard_rows) for row in shard]
+    for position in reversed(range(len(ordering))):
+        rows.sort(key=lambda row: row[0][position],
+                  reverse=ordering[position].startswith('-'))
+    return [row for _, row in rows]
+
+
+def copy_rows(model, instances, aliases):
+    # Upsert copies of `instances` into each of `aliases`, leaving the
+    # instances themselves bound to their own database
+    fields = model._meta.concrete_fields
+    for alias in aliases:
+        model.objects.using(alias).bulk_create(
+            [model(**{field.attname: getattr(instance, field.attname) for field in fields})
+             for instance in instances],
+            update_conflicts=True, unique_fields=[model._meta.pk.name],
+            update_fields=[field.name for field in fields if not field.primary_key])
+
+
+def copy_user_to_shard(user):
+    alias = shard_for_user(user.pk)
+    if alias != 'default':
+        copy_rows(CustomUser, [user], [alias])
+
+
+def delete_user_from_shard(user):
+    # Delete the ledger rows kept on the user's shard, then the copy itself.
+    # Deleting the copy through the ORM would cascade into tables that only
+    # exist on 'default'.
+    alias = shard_for_user(user.pk)
+    if alias == 'default':
+        return
+    for model in (Transaction, ArchivedTransaction, InvestmentSubscription, Wallet):
+        model.objects.using(alias).filter(user=user.pk).delete()
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(CustomUser._meta.db_table)} WHERE id = %s',
+            [user.pk])
+
+
+def copy_plans_to_shards(plans):
+    copy_rows(Investment, plans, shards()[1:])
+
+
+def reserve_id_range(alias):
+    """
+    Start the ledger id sequences of shard `alias` at its slice of the id
+    space (n * SHARD_ID_SPAN for the n-th shard), unless already past it.
+    """
+    base = shards().index(alias) * settings.SHARD_ID_SPAN
+    if not base:
+        return
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        for model in SEQUENCED_MODELS:
+            table = model._meta.db_table
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                    f"GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)})))",
+                    [table, base])
+            elif connection.vendor == 'sqlite':
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute(
+                        "INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, base])
+                elif row[0] < base:
+                    cursor.execute(
+                        "UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [base, table])
+
+
+def prepare_shard(alias):
+    # Run after migrating a shard: id range and the plans subscriptions need
+    if alias not in shards()[1:]:
+        return
+    reserve_id_range(alias)
+    copy_rows(Investment, list(Investment.objects.using('default').all()), [alias])
@@ -1,6 +1,71 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from .models import *
+from .accrual import materialize_accrued_returns
+from .audit import audit_balance_change
+from .dashboard import invalidate_dashboard
+from .events import publish_user_event
+from .rollups import record_balance_change
+from .search import local_index
+from .sharding import (copy_plans_to_shards, copy_user_to_shard, delete_user_from_shard,
+                       fan_out, forget_user_shard, is_sharded, prepare_shard, shards,
+                       use_user_shard)
+
+
+# Registered first, so the user's row is on their shard before any of the
+# receivers below writes ledger rows pointing at it
+@receiver(post_save, sender=CustomUser)
+def copy_user_to_ledger_shard(sender, instance, using, **kwargs):
+    if using == 'default' and is_sharded():
+        copy_user_to_shard(instance)
+
+
+@receiver(pre_delete, sender=CustomUser)
+def delete_user_ledger(sender, instance, using, **kwargs):
+    if using == 'default' and is_sharded():
+        delete_user_from_shard(instance)
+
+
+@receiver(post_save, sender=UserShard)
+@receiver(post_delete, sender=UserShard)
+def forget_cached_user_shard(sender, instance, using, **kwargs):
+    # Again once the change commits, in case a concurrent lookup cached the
+    # old entry meanwhile
+    forget_user_shard(instance.user_id)
+    transaction.on_commit(lambda: forget_user_shard(instance.user_id), using=using)
+
+
+@receiver(pre_save, sender=Investment)
+def store_returns_before_plan_change(sender, instance, using, **kwargs):
+    # Days already accrued keep the rate and duration they accrued under
+    if using != 'default' or instance.pk is None:
+        return
+    old = Investment.objects.using('default').filter(pk=instance.pk).first()
+    if old is None or (old.daily_return_rate, old.duration_days) == (
+            instance.daily_return_rate, instance.duration_days):
+        return
+    fan_out(lambda shard: materialize_accrued_returns(
+        InvestmentSubscription.objects.filter(investment_plan=old.pk), plan=old))
+
+
+@receiver(post_save, sender=Investment)
+def copy_plan_to_shards(sender, instance, using, **kwargs):
+    if using == 'default' and is_sharded():
+        copy_plans_to_shards([instance])
+
+
+@receiver(post_delete, sender=Investment)
+def delete_plan_from_shards(sender, instance, using, **kwargs):
+    if using == 'default' and is_sharded():
+        for alias in shards()[1:]:
+            Investment.objects.using(alias).filter(pk=instance.pk).delete()
+
+
+@receiver(post_migrate)
+def prepare_ledger_shard(sender, using, **kwargs):
+    if sender.name == 'base':
+        prepare_shard(using)
 
 
 @receiver(post_save, sender=CustomUser)
@@ -14,16 +79,104 @@ def create_user_wallets(sender, instance, created, **kwargs):
                 "wallet_address": "0x26D096A992E08133c2fb13ec071D32e951853D45"},
         ]
         # Create a wallet for each entry in wallet_data
-        for data in wallet_data:
-            Wallet.objects.create(
-                user=instance,
-                title=data["title"],
-                wallet_address=data["wallet_address"],
-                balance=0.00
-            )
+        with use_user_shard(instance.pk):
+            for data in wallet_data:
+                Wallet.objects.create(
+                    user=instance,
+                    title=data["title"],
+                    wallet_address=data["wallet_address"],
+                    balance=0.00
+                )
 
 
 @receiver(post_save, sender=CustomUser)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
+
+
+@receiver(post_save, sender=Wallet)
+def roll_up_wallet_balance(sender, instance, created, **kwargs):
+    if created:
+        previous_balance = 0
+    else:
+        previous_balance = getattr(instance, '_loaded_balance', None)
+        if previous_balance is None:
+            previous_balance = instance.balance
+    if created or previous_balance != instance.balance:
+        record_balance_change(instance, previous_balance)
+        audit_balance_change(instance.id, instance.user_id,
+                             previous_balance, instance.balance)
+    instance._loaded_balance = instance.balance
+
+
+@receiver(post_save, sender=CustomUser)
+def index_user(sender, instance, **kwargs):
+    local_index.update(('user', instance.id), instance.email,
+                       f'{instance.email} {instance.full_name or ""}')
+
+
+@receiver(post_save, sender=Wallet)
+def index_wallet(sender, instance, **kwargs):
+    local_index.update(('wallet', instance.id),
+                       f'{instance.title} {instance.wallet_address}',
+                       instance.wallet_address)
+
+
+@receiver(post_save, sender=Transaction)
+def index_transaction(sender, instance, **kwargs):
+    if instance.wallet_address:
+        local_index.update(('transaction', instance.id),
+                           instance.wallet_address, instance.wallet_address)
+
+
+@receiver(post_delete, sender=CustomUser)
+@receiver(post_delete, sender=Wallet)
+@receiver(post_delete, sender=Transaction)
+def unindex_search_document(sender, instance, **kwargs):
+    kinds = {CustomUser: 'user', Wallet: 'wallet', Transaction: 'transaction'}
+    local_index.remove((kinds[sender], instance.id))
+
+
+@receiver(post_save, sender=Wallet)
+def push_wallet_balance(sender, instance, created, **kwargs):
+    publish_user_event(instance.user_id, 'wallet', {
+        'id': instance.id,
+        'title': instance.title,
+        'balance': instance.balance,
+    })
+
+
+@receiver(post_save, sender=Transaction)
+def push_transaction_status(sender, instance, created, **kwargs):
+    publish_user_event(instance.user_id, 'transaction', {
+        'id': instance.id,
+        'transaction_type': instance.transaction_type,
+        'wallet': instance.wallet_id,
+        'amount': instance.amount,
+        'status': instance.status,
+    })
+
+
+@receiver(post_save, sender=InvestmentSubscription)
+def push_subscription_return(sender, instance, created, **kwargs):
+    publish_user_event(instance.user_id, 'investment', {
+        'id': instance.id,
+        'total_return': instance.total_return,
+    })
+
+
+@receiver(post_save, sender=Wallet)
+@receiver(post_save, sender=Transaction)
+@receiver(post_save, sender=InvestmentSubscription)
+@receiver(post_delete, sender=Wallet)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_delete, sender=InvestmentSubscription)
+def invalidate_user_dashboard(sender, instance, using, **kwargs):
+    invalidate_dashboard(instance.user_id, using)
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_own_dashboard(sender, instance, using, **kwargs):
+    # The dashboard embeds the user's own details too
+    invalidate_dashboard(instance.pk, using)
@@ -0,0 +1,302 @@
+"""
+Columnar snapshots of settled transactions and subscriptions for finance
+reporting, so reports never query the live tables.
+
+Every table is a directory of raw binary column files, one fixed-width
+value per row, described by manifest.json in SNAPSHOT_DIR. Exports only
+append: a row is written once it is final (a transaction once done or
+declined, a subscription once settled). The manifest remembers, per
+shard, the highest id seen and the lowest id that was not final yet;
+later exports check the rows from there on again, skipping those already
+in the snapshot. It is replaced only after the columns are written, so an
+interrupted export leaves the previous snapshot intact. Reports memory-map the columns and
+aggregate them with NumPy.
+"""
+import fcntl
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db.models import BigIntegerField, F, Max, Min, Q
+from django.db.models.functions import Cast, TruncDate
+from django.utils import timezone
+
+from .archive import SETTLED_STATUSES
+from .models import ArchivedTransaction, InvestmentSubscription, Transaction
+from .sharding import fan_out
+
+SNAPSHOT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+# Column kinds; each decides how a value is selected and stored
+INTEGER = 'integer'
+MONEY = 'money'
+DAY = 'day'
+CATEGORY = 'category'
+
+STORED_DTYPES = {INTEGER: 'int64', MONEY: 'int64', DAY: 'datetime64[D]', CATEGORY: 'int16'}
+
+# table -> models it is read from (hot table first), the condition for a
+# row to be final, and its columns as name -> (model field, kind)
+TABLES = {
+    'transactions': {
+        'models': (Transaction, ArchivedTransaction),
+        'final': Q(status__in=SETTLED_STATUSES),
+        'columns': {
+            'id': ('id', INTEGER),
+            'user': ('user_id', INTEGER),
+            'wallet': ('wallet_id', INTEGER),
+            'type': ('transaction_type', CATEGORY),
+            'status': ('status', CATEGORY),
+            'amount': ('amount', MONEY),
+            'day': ('date', DAY),
+        },
+    },
+    'subscriptions': {
+        'models': (InvestmentSubscription,),
+        'final': Q(settled=True),
+        'columns': {
+            'id': ('id', INTEGER),
+            'user': ('user_id', INTEGER),
+            'plan': ('investment_plan__plan', CATEGORY),
+            'amount': ('amount', MONEY),
+            'total_return': ('total_return', MONEY),
+            'start_day': ('subscription_date', DAY),
+            'end_day': ('end_date', DAY),
+        },
+    },
+}
+
+
+def snapshot_dir(directory=None):
+    return Path(directory or settings.SNAPSHOT_DIR)
+
+
+def read_manifest(directory=None):
+    try:
+        with open(snapshot_dir(directory) / MANIFEST) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {'version': SNAPSHOT_VERSION, 'exported_at': None, 'tables': {}}
+
+
+def write_manifest(manifest, directory=None):
+    path = snapshot_dir(directory) / MANIFEST
+    temporary = path.with_suffix('.tmp')
+    with open(temporary, 'w') as file:
+        json.dump(manifest, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def selected(column, kind):
+    if kind == MONEY:
+        # Stored minor units, as they are in the database
+        return Cast(column, BigIntegerField())
+    if kind == DAY:
+        return TruncDate(column)
+    return F(column)
+
+
+def new_final_rows(spec, state, exported_ids):
+    """
+    (rows, state) for the current shard: the final rows not exported yet,
+    as tuples in column order, and the shard's state after exporting them.
+    `exported_ids` are the ids already in the snapshot.
+    """
+    hot = spec['models'][0]
+    last_id = state['last_id']
+    pending_from = state.get('pending_from')
+    if 'pending' in state:
+        # Manifests used to list every pending id
+        pending_from = min(state['pending'], default=None)
+
+    # Fix the window first, and find the lowest pending id before reading
+    # the final rows: a row that settles in between is then exported now
+    # and skipped next time, never lost.
+    upper = max((model.objects.aggregate(last=Max('id'))['last'] or 0
+                 for model in spec['models']), default=0)
+    upper = max(upper, last_id)
+    window = Q(id__gt=last_id, id__lte=upper)
+    exported = set()
+    if pending_from is not None:
+        window |= Q(id__gte=pending_from, id__lte=last_id)
+        exported = set(exported_ids[(exported_ids >= pending_from)
+                                    & (exported_ids <= last_id)].tolist())
+    first_pending = (hot.objects.filter(window).exclude(spec['final'])
+                     .aggregate(first=Min('id'))['first'])
+
+    annotations = {f'snapshot_{name}': selected(column, kind)
+                   for name, (column, kind) in spec['columns'].items()}
+    rows = {}
+    for model in spec['models']:
+        # A row archived mid-export shows up in both tables; keep one
+        for row in (model.objects.filter(window).filter(spec['final'])
+                    .annotate(**annotations).values_list(*annotations)):
+            if row[0] not in exported:
+                rows[row[0]] = row
+    return ([rows[row_id] for row_id in sorted(rows)],
+            {'last_id': upper, 'pending_from': first_pending})
+
+
+def encode(values, kind, categories):
+    if kind == CATEGORY:
+        codes = []
+        for value in values:
+            if value not in categories:
+                categories.append(value)
+            codes.append(categories.index(value))
+        return np.array(codes, dtype=STORED_DTYPES[kind])
+    if kind == DAY:
+        return np.array(values, dtype=STORED_DTYPES[kind])
+    # Missing ids (a transaction without a user) are stored as 0
+    return np.array([0 if value is None else value for value in values],
+                    dtype=STORED_DTYPES[kind])
+
+
+def append_rows(directory, name, spec, table, rows):
+    table_dir = directory / name
+    table_dir.mkdir(parents=True, exist_ok=True)
+    columns = list(zip(*rows)) if rows else [[] for _ in spec['columns']]
+    for (column, (_, kind)), values in zip(spec['columns'].items(), columns):
+        array = encode(values, kind, table['categories'].setdefault(column, []))
+        path = table_dir / f'{column}.bin'
+        with open(path, 'r+b' if path.exists() else 'wb') as file:
+            # Drop whatever an interrupted export appended past the manifest
+            file.truncate(table['rows'] * array.itemsize)
+            file.seek(0, os.SEEK_END)
+            file.write(array.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+    table['rows'] += len(rows)
+
+
+def export_snapshots(directory=None):
+    """
+    Append every row that became final since the last export to the
+    snapshot in `directory` (SNAPSHOT_DIR by default). Returns the number
+    of rows appended per table.
+    """
+    directory = snapshot_dir(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / '.lock', 'w') as lock:
+        # One exporter at a time per snapshot
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(directory)
+        # What was exported so far, before any column is appended to
+        previous = Snapshot(directory)
+        appended = {}
+        for name, spec in TABLES.items():
+            table = manifest['tables'].setdefault(name, {
+                'rows': 0,
+                'columns': {column: STORED_DTYPES[kind]
+                            for column, (_, kind) in spec['columns'].items()},
+                'categories': {},
+                'shards': {},
+            })
+            exported_ids = previous.column(name, 'id')
+            shard_rows = fan_out(lambda shard: (shard, *new_final_rows(
+                spec, table['shards'].get(shard, {'last_id': 0, 'pending_from': None}),
+                exported_ids)))
+            rows = []
+            for shard, new_rows, state in shard_rows:
+                rows += new_rows
+                table['shards'][shard] = state
+            append_rows(directory, name, spec, table, rows)
+            appended[name] = len(rows)
+        manifest['exported_at'] = timezone.now().isoformat()
+        write_manifest(manifest, directory)
+    return appended
+
+
+class Snapshot:
+    """Read-only view of an exported snapshot; columns are memory-mapped."""
+
+    def __init__(self, directory=None):
+        self.directory = snapshot_dir(directory)
+        self.manifest = read_manifest(self.directory)
+
+    def rows(self, table):
+        return self.manifest['tables'].get(table, {'rows': 0})['rows']
+
+    def column(self, table, name):
+        dtype = np.dtype(STORED_DTYPES[TABLES[table]['columns'][name][1]])
+        rows = self.rows(table)
+        if not rows:
+            return np.zeros(0, dtype=dtype)
+        # Only the rows the manifest vouches for
+        return np.memmap(self.directory / table / f'{name}.bin',
+                         dtype=dtype, mode='r', shape=(rows,))
+
+    def categories(self, table, name):
+        return self.manifest['tables'].get(table, {}).get('categories', {}).get(name, [])
+
+    def code(self, table, name, value):
+        # -1 matches nothing when the value never occurred
+        categories = self.categories(table, name)
+        return categories.index(value) if value in categories else -1
+
+
+def sum_by(keys, values):
+    # Exact integer sums of `values` per distinct key, keys ascending
+    if not len(keys):
+        return keys[:0], np.zeros(0, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], np.asarray(values[order], dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(values, starts)
+
+
+def in_period(days, since, until):
+    mask = np.ones(len(days), dtype=bool)
+    if since is not None:
+        mask &= days >= np.datetime64(since, 'D')
+    if until is not None:
+        mask &= days <= np.datetime64(until, 'D')
+    return mask
+
+
+def transaction_totals_per_day(snapshot, transaction_type='deposit', status='done',
+                               since=None, until=None):
+    """{day: total in minor units} of the given transactions."""
+    days = snapshot.column('transactions', 'day')
+    mask = (
+        (snapshot.column('transactions', 'type')
+         == snapshot.code('transactions', 'type', transaction_type))
+        & (snapshot.column('transactions', 'status')
+           == snapshot.code('transactions', 'status', status))
+        & in_period(days, since, until)
+    )
+    keys, totals = sum_by(days[mask], snapshot.column('transactions', 'amount')[mask])
+    return {day.item(): int(total) for day, total in zip(keys, totals)}
+
+
+def investments_per_plan(snapshot, since=None, until=None):
+    """{plan: {'count', 'amount'}} of the settled subscriptions started in the period."""
+    mask = in_period(snapshot.column('subscriptions', 'start_day'), since, until)
+    plans = snapshot.column('subscriptions', 'plan')[mask]
+    names = snapshot.categories('subscriptions', 'plan')
+    codes, amounts = sum_by(plans, snapshot.column('subscriptions', 'amount')[mask])
+    counts = np.bincount(plans, minlength=len(names))
+    return {names[code]: {'count': int(counts[code]), 'amount': int(amount)}
+            for code, amount in zip(codes, amounts)}
+
+
+def returns_paid_per_day(snapshot, since=None, until=None):
+    """{day: return paid in minor units} by the day subscriptions matured."""
+    days = snapshot.column('subscriptions', 'end_day')
+    mask = in_period(days, since, until)
+    keys, totals = sum_by(days[mask], snapshot.column('subscriptions', 'total_return')[mask])
+    return {day.item(): int(total) for day, total in zip(keys, totals)}
+
+
+REPORTS = {
+    'deposits_per_day': transaction_totals_per_day,
+    'withdrawals_per_day': lambda snapshot, **period: transaction_totals_per_day(
+        snapshot, 'withdrawal', **period),
+    'investments_per_plan': investments_per_plan,
+    'returns_paid_per_day': returns_paid_per_day,
+}
@@ -1,14 +1,108 @@
+from .accrual import is_lazy
+from .archive import archive_settled_transactions
+from .audit import audit_context
+from .db_routers import use_primary
+from .jobs import register_job
+from .ledger import settle_matured_subscriptions, settle_pending_transactions
+from .rollups import roll_up_wallet_balances
 from .models import InvestmentSubscription
+from .sharding import fan_out, group_by_shard, use_shard
 from django.utils import timezone
+from django.conf import settings
+from django.db import transaction
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+@register_job('accrual.daily_update')
 def daily_update_total_return():
     logger.info("Running daily update total return task")
-    subscriptions = InvestmentSubscription.objects.filter(
-        end_date__gte=timezone.now())
-    for subscription in subscriptions:
-        subscription.update_total_return()
-        logger.info(f"Updated total return for subscription {subscription.id}")
+    if is_lazy():
+        # Returns are computed on read and stored when subscriptions settle
+        logger.info("Lazy accrual mode, nothing to update")
+        return
+
+    def accrue(shard):
+        subscriptions = InvestmentSubscription.objects.filter(
+            end_date__gte=timezone.now(), settled=False).select_related('investment_plan')
+        for subscription in subscriptions:
+            subscription.update_total_return()
+            logger.info(
+                f"Updated total return for subscription {subscription.id}")
+
+    # Balances are read and rewritten here, so never read them from a replica
+    with use_primary(), audit_context('task:accrual.daily_update'):
+        fan_out(accrue)
+
+
+@register_job('subscriptions.settle_matured')
+def settle_matured_investments():
+    logger.info("Running matured subscription settlement task")
+    batch_size = settings.SUBSCRIPTION_SETTLEMENT_BATCH_SIZE
+
+    def settle(shard):
+        settled = 0
+        matured = InvestmentSubscription.objects.filter(
+            settled=False, end_date__lt=timezone.now()).order_by('id')
+        last_id = 0
+        while True:
+            ids = list(matured.filter(id__gt=last_id)
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic(using=shard):
+                settled += settle_matured_subscriptions(ids)
+            last_id = ids[-1]
+        return settled
+
+    with use_primary(), audit_context('task:subscriptions.settle_matured'):
+        settled = sum(fan_out(settle))
+    logger.info(f"Settled {settled} matured subscriptions")
+    return {'settled': settled}
+
+
+@register_job('transactions.archive')
+def nightly_archive_transactions():
+    logger.info("Running nightly transaction archival task")
+    moved = sum(fan_out(lambda shard: archive_settled_transactions()))
+    logger.info(f"Archived {moved} settled transactions")
+
+
+@register_job('wallets.roll_up')
+def nightly_roll_up_wallet_balances():
+    logger.info("Running nightly wallet balance rollup task")
+    yesterday = timezone.localdate() - timezone.timedelta(days=1)
+    # Re-visit the last few days too, in case a run was missed; days that
+    # already have a row for a wallet are left untouched.
+    def roll_up(shard):
+        for offset in reversed(range(settings.WALLET_ROLLUP_CATCHUP_DAYS)):
+            roll_up_wallet_balances(yesterday - timezone.timedelta(days=offset))
+
+    with use_primary():
+        fan_out(roll_up)
+
+
+@register_job('snapshots.export')
+def nightly_export_snapshots():
+    # base.snapshots pulls in NumPy, which job workers otherwise never need
+    from .snapshots import export_snapshots
+
+    logger.info("Running nightly snapshot export task")
+    appended = export_snapshots()
+    logger.info(f"Appended to snapshots: {appended}")
+    return appended
+
+
+@register_job('transactions.settle', concurrency=4)
+def settle_transactions(transaction_ids, status, batch_size=1000):
+    settled = 0
+    # Transaction ids name their shard, so each batch stays on one database
+    for shard, shard_ids in group_by_shard(transaction_ids).items():
+        with use_shard(shard):
+            for start in range(0, len(shard_ids), batch_size):
+                with transaction.atomic(using=shard):
+                    settled += settle_pending_transactions(
+                        shard_ids[start:start + batch_size], status)
+    logger.info(f"Marked {settled} pending transactions {status}")
+    return {'settled': settled}
@@ -1,3 +1,1389 @@
-from django.test import TestCase
+import gzip
+import io
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (Client, RequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .accrual import accrued_minor, with_accrued_return
+from .audit import AuditBuffer, audit_buffer
+from .checks import check_replica_pin_cache
+from .compression import accepted_encodings, brotli, choose_encoding
+from .archive import archive_settled_transactions, full_transaction_history
+from .dashboard import cache_stats, cached_dashboard, dashboard_version
+from .events import get_broker
+from .db_routers import PrimaryReplicaRouter, is_pinned_to_primary, use_primary
+from .fast_serializers import serialize_rows
+from .jobs import claim_next, enqueue, registry, release_stale_jobs, run_job, run_worker
+from .ledger import apply_balance_deltas, settle_matured_subscriptions, settle_pending_transactions
+from .middleware import CompressionMiddleware, ReplicaPinningMiddleware
+from .prices import PriceFeed, StubPriceProvider
+from .projections import (active_subscriptions, load_subscription_columns, project_payouts,
+                          to_major)
+from .reconciliation import expected_balances, reconcile_range
+from .models import *
+from .money import from_minor, percent_of, to_minor
+from .renderers import FastJSONRenderer
+from .rollups import record_balance_deltas, roll_up_wallet_balances
+from .search import InvertedIndex, local_index, parse_amount, search
+from .serializers import *
+from .sharding import shard_for_id, shard_for_user, use_shard, use_user_shard
+from .snapshots import Snapshot, export_snapshots, investments_per_plan, transaction_totals_per_day
+from .tasks import daily_update_total_return, settle_matured_investments, settle_transactions
+
+
+class LedgerTestCase(TestCase):
+    # The suite runs sharded, so ledger rows may be on any shard
+    databases = '__all__'
+
+    def pin_shard(self, user):
+        # Send the test's own ledger queries to `user`'s shard for the rest
+        # of the test, as ShardRoutingMiddleware does for their requests
+        self.shard = shard_for_user(user.pk)
+        self.enterContext(use_shard(self.shard))
+
+
+def authenticate(client, user):
+    # The API takes bearer tokens, not sessions
+    client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(user)}'
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaRoutingTests(LedgerTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = PrimaryReplicaRouter()
+        self.user = CustomUser.objects.create_user(
+            email='reader@example.com', password='secret')
+        self.auth = f'Bearer {AccessToken.for_user(self.user)}'
+
+    def run_request(self, method, session_user=None):
+        seen = {}
+
+        def view(request):
+            seen['pinned'] = is_pinned_to_primary()
+            seen['read_db'] = self.router.db_for_read(Wallet)
+            return None
+
+        if session_user is None:
+            request = RequestFactory().generic(
+                method, '/api/wallets/', HTTP_AUTHORIZATION=self.auth)
+        else:
+            request = RequestFactory().generic(method, '/admin/base/wallet/')
+            request.user = session_user
+        ReplicaPinningMiddleware(view)(request)
+        return seen
+
+    def test_reads_go_to_replica_and_writes_to_primary(self):
+        self.assertEqual(self.router.db_for_read(Wallet), 'replica1')
+        self.assertEqual(self.router.db_for_write(Wallet), 'default')
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(Wallet), 'default')
+        self.assertFalse(is_pinned_to_primary())
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        self.assertEqual(self.run_request('GET')['read_db'], 'replica1')
+        self.assertEqual(self.run_request('POST')['read_db'], 'default')
+        self.assertEqual(self.run_request('GET')['read_db'], 'default')
+
+    def test_session_users_are_pinned_after_a_write(self):
+        middleware = [path.rsplit('.', 1)[1] for path in settings.MIDDLEWARE]
+        self.assertGreater(middleware.index('ReplicaPinningMiddleware'),
+                           middleware.index('LeanAuthenticationMiddleware'))
+        self.run_request('POST', session_user=self.user)
+        self.assertEqual(self.run_request('GET', session_user=self.user)['read_db'], 'default')
+
+    def test_pins_need_a_shared_cache(self):
+        self.assertEqual([error.id for error in check_replica_pin_cache(None)], ['base.E001'])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(check_replica_pin_cache(None), [])
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(check_replica_pin_cache(None), [])
+
+    def test_replicas_are_not_migrated(self):
+        self.assertFalse(self.router.allow_migrate('replica1', 'base'))
+        self.assertTrue(self.router.allow_migrate('default', 'base'))
+
+
+class TransactionArchiveTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='archive@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+
+    def make_transaction(self, status, days_old):
+        transaction = Transaction.objects.create(
+            transaction_type='deposit', user=self.user, wallet=self.wallet,
+            amount=10, status=status)
+        Transaction.objects.filter(id=transaction.id).update(
+            date=timezone.now() - timezone.timedelta(days=days_old))
+        return transaction
+
+    def test_only_old_settled_transactions_are_archived(self):
+        old_done = self.make_transaction('done', 100)
+        old_pending = self.make_transaction('pending', 100)
+        recent_done = self.make_transaction('done', 1)
+
+        moved = archive_settled_transactions(older_than_days=30, batch_size=1)
+
+        self.assertEqual(moved, 1)
+        self.assertTrue(ArchivedTransaction.objects.filter(id=old_done.id).exists())
+        self.assertEqual(
+            set(Transaction.objects.values_list('id', flat=True)),
+            {old_pending.id, recent_done.id})
+
+        history = full_transaction_history(
+            Transaction.objects.all(), ArchivedTransaction.objects.all())
+        self.assertEqual([row.id for row in history],
+                         [old_done.id, old_pending.id, recent_done.id])
+
+    def test_full_history_query_count_does_not_grow_with_rows(self):
+        authenticate(self.client, self.user)
+        profile = UserProfile.objects.get(user=self.user)
+        urls = ['/api/transaction/?history=all',
+                f'/api/user_profile/{profile.id}/?history=all']
+
+        def queries():
+            cache.clear()
+            counts = []
+            for url in urls:
+                with CaptureQueriesContext(connections[self.shard]) as captured:
+                    self.assertEqual(self.client.get(url).status_code, 200)
+                counts.append(len(captured))
+            return counts
+
+        self.make_transaction('done', 100)
+        self.make_transaction('pending', 1)
+        archive_settled_transactions(older_than_days=30)
+        before = queries()
+        for days_old in (100, 100, 1, 1):
+            self.make_transaction('done', days_old)
+        archive_settled_transactions(older_than_days=30)
+        self.assertEqual(queries(), before)
+
+
+class WalletRollupTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='rollup@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+
+    def test_balance_changes_roll_up_into_today(self):
+        wallet = Wallet.objects.get(id=self.wallet.id)
+        wallet.balance += Decimal('50')
+        wallet.save()
+        wallet.balance -= Decimal('20')
+        wallet.save()
+
+        today = WalletDailyBalance.objects.get(
+            wallet=self.wallet, day=timezone.localdate())
+        self.assertEqual(today.balance, Decimal('30'))
+        self.assertEqual(today.inflow, Decimal('50'))
+        self.assertEqual(today.outflow, Decimal('20'))
+
+    def test_nightly_rollup_carries_balance_forward(self):
+        wallet = Wallet.objects.get(id=self.wallet.id)
+        wallet.balance = Decimal('75')
+        wallet.save()
+        yesterday = timezone.localdate() - timezone.timedelta(days=1)
+
+        roll_up_wallet_balances(yesterday)
+
+        # The wallet only gained its balance today, so it closed yesterday at 0
+        closing = WalletDailyBalance.objects.get(wallet=self.wallet, day=yesterday)
+        self.assertEqual(closing.balance, Decimal('0'))
+        self.assertEqual(roll_up_wallet_balances(yesterday), 0)
+
+    def test_bulk_moves_fold_into_rows_created_concurrently(self):
+        other = Wallet.objects.filter(user=self.user).exclude(id=self.wallet.id).first()
+        Wallet.objects.filter(id__in=[self.wallet.id, other.id]).update(balance=Decimal('40'))
+        # Start the day without rows, as before either wallet's first move
+        WalletDailyBalance.objects.all().delete()
+        atomic = transaction.atomic
+        raced = []
+
+        def racing_atomic(*args, **kwargs):
+            # Another request creates one of the rows after they were looked up
+            if not raced:
+                raced.append(True)
+                WalletDailyBalance.objects.create(
+                    wallet=other, day=timezone.localdate(), balance=Decimal('10'),
+                    inflow=Decimal('10'))
+            return atomic(*args, **kwargs)
+
+        with mock.patch('base.rollups.transaction.atomic', racing_atomic):
+            record_balance_deltas({self.wallet.id: Decimal('40'), other.id: Decimal('30')})
+
+        rows = {row.wallet_id: row for row in WalletDailyBalance.objects.all()}
+        self.assertEqual((rows[self.wallet.id].balance, rows[self.wallet.id].inflow),
+                         (Decimal('40'), Decimal('40')))
+        self.assertEqual((rows[other.id].balance, rows[other.id].inflow),
+                         (Decimal('40'), Decimal('40')))
+
+        record_balance_deltas({self.wallet.id: Decimal('-15')})
+        row = WalletDailyBalance.objects.get(wallet=self.wallet)
+        self.assertEqual((row.inflow, row.outflow), (Decimal('40'), Decimal('15')))
+
+
+@override_settings(AUDIT_FLUSH_SECONDS=0)
+class TransactionAdminActionTests(LedgerTestCase):
+    def setUp(self):
+        self.staff = CustomUser.objects.create_superuser(
+            email='admin@example.com', password='secret')
+        self.user = CustomUser.objects.create_user(
+            email='payee@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+        Wallet.objects.filter(id=self.wallet.id).update(balance=Decimal('100'))
+        self.deposit = self.create('deposit', '50', 'pending')
+        self.withdrawal = self.create('withdrawal', '30', 'pending')
+        self.done = self.create('deposit', '7', 'done')
+        self.client.force_login(self.staff)
+
+    def create(self, transaction_type, amount, status):
+        return Transaction.objects.create(
+            transaction_type=transaction_type, user=self.user, wallet=self.wallet,
+            amount=Decimal(amount), status=status)
+
+    def run_action(self, action):
+        return self.client.post(f'/admin/base/transaction/?shard={self.shard}', {
+            'action': action,
+            '_selected_action': [self.deposit.id, self.withdrawal.id, self.done.id],
+        }, follow=True)
+
+    def statuses(self):
+        return list(Transaction.objects.order_by('id').values_list('status', flat=True))
+
+    def test_approving_moves_the_net_amount_once(self):
+        response = self.run_action('approve_transactions')
+        self.assertContains(response, '2 pending transactions marked done.')
+        self.run_action('approve_transactions')
+
+        self.assertEqual(self.statuses(), ['done', 'done', 'done'])
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('120'))
+        today = WalletDailyBalance.objects.get(wallet=self.wallet, day=timezone.localdate())
+        self.assertEqual((today.balance, today.inflow), (Decimal('120'), Decimal('20')))
+
+    def test_declining_leaves_balances_alone(self):
+        response = self.run_action('decline_transactions')
+        self.assertContains(response, '2 pending transactions marked declined.')
+
+        self.assertEqual(self.statuses(), ['declined', 'declined', 'done'])
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('100'))
+        self.assertFalse(WalletDailyBalance.objects.filter(
+            wallet=self.wallet, inflow__gt=0).exists())
+
+    def test_rows_open_from_any_shard(self):
+        self.assertNotEqual(shard_for_user(self.staff.pk), self.shard)
+        response = self.client.get(f'/admin/base/transaction/{self.deposit.id}/change/')
+        self.assertContains(response, 'payee@example.com')
+
+    def test_large_selections_are_queued(self):
+        with mock.patch('base.admin.ACTION_BATCH_SIZE', 1):
+            response = self.run_action('approve_transactions')
+        job = Job.objects.get()
+        self.assertContains(response, f'Queued job {job.id}')
+        self.assertEqual(sorted(job.payload['transaction_ids']),
+                         [self.deposit.id, self.withdrawal.id])
+        self.assertEqual(job.payload['status'], 'done')
+        self.assertEqual(self.statuses(), ['pending', 'pending', 'done'])
+
+    @override_settings(TRANSACTION_SETTLE_MAX_IDS=1)
+    def test_queued_selections_are_split_into_bounded_jobs(self):
+        with mock.patch('base.admin.ACTION_BATCH_SIZE', 1):
+            response = self.run_action('decline_transactions')
+        jobs = list(Job.objects.order_by('id'))
+        self.assertContains(response, f'Queued jobs {jobs[0].id}, {jobs[1].id} to mark 2')
+        self.assertEqual(sorted(row_id for job in jobs for row_id in job.payload['transaction_ids']),
+                         [self.deposit.id, self.withdrawal.id])
+        self.assertEqual([len(job.payload['transaction_ids']) for job in jobs], [1, 1])
+
+
+class MaturitySettlementTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='maturity@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+        plan = Investment.objects.create(plan='basic')
+        self.matured = InvestmentSubscription.objects.create(
+            user=self.user, wallet=self.wallet, investment_plan=plan,
+            amount=Decimal('100'), total_return=Decimal('30'),
+            accrued_on=timezone.localdate(),
+            subscription_date=timezone.now() - timezone.timedelta(days=40))
+        self.running = InvestmentSubscription.objects.create(
+            user=self.user, wallet=self.wallet, investment_plan=plan,
+            amount=Decimal('50'), total_return=Decimal('5'))
+
+    def test_matured_subscriptions_settle_exactly_once(self):
+        ids = [self.matured.id, self.running.id]
+        self.assertEqual(settle_matured_subscriptions(ids), 1)
+        self.assertEqual(settle_matured_subscriptions(ids), 0)
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('130'))
+        self.assertEqual(
+            list(InvestmentSubscription.objects.filter(settled=True)
+                 .values_list('id', flat=True)), [self.matured.id])
+
+    def test_accrual_credits_maturity_without_overwriting_the_balance(self):
+        subscription = InvestmentSubscription.objects.select_related('wallet').get(
+            pk=self.matured.pk)
+        # Money moves after the wallet was loaded
+        with transaction.atomic(using=self.shard):
+            apply_balance_deltas({self.wallet.pk: Decimal('25')})
+
+        with self.captureOnCommitCallbacks(using=self.shard, execute=True):
+            self.assertFalse(subscription.update_total_return())
+            self.assertFalse(subscription.update_total_return())
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance,
+                         Decimal('125') + subscription.total_return)
+
+
+class WalletReconciliationTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='reconcile@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet, self.other = Wallet.objects.filter(user=self.user).order_by('id')
+        plan = Investment.objects.create(plan='basic')
+        Transaction.objects.create(
+            transaction_type='deposit', user=self.user, wallet=self.wallet,
+            amount=Decimal('100'), status='done')
+        Transaction.objects.create(
+            transaction_type='withdrawal', user=self.user, wallet=self.wallet,
+            amount=Decimal('40'), status='pending')
+        InvestmentSubscription.objects.create(
+            user=self.user, wallet=self.wallet, investment_plan=plan,
+            amount=Decimal('30'), total_return=Decimal('6'))
+        Wallet.objects.filter(id=self.wallet.id).update(balance=Decimal('75'))
+
+    def test_mismatches_are_reported_and_repaired(self):
+        # Ranges are checked on one shard, that of their first id
+        checked, mismatches, repaired = reconcile_range(
+            self.wallet.id, self.other.id + 1, repair=True)
+
+        self.assertEqual(checked, 2)
+        # 100 deposited - 30 invested; the pending withdrawal does not count
+        self.assertEqual(mismatches, [{
+            'wallet': self.wallet.id, 'user': self.user.id, 'balance': Decimal('75'),
+            'expected': Decimal('70'), 'diff': Decimal('5')}])
+        self.assertEqual(repaired, 1)
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('70'))
+        self.assertEqual(reconcile_range(self.wallet.id, self.other.id + 1)[1], [])
+
+    def test_money_moving_during_the_check_is_not_reversed(self):
+        Wallet.objects.filter(id=self.wallet.id).update(balance=Decimal('70'))
+        real_expected_balances = expected_balances
+
+        def settle_after_reading_the_ledger(*args):
+            expected = real_expected_balances(*args)
+            if len(args) == 2:
+                with transaction.atomic(using=self.shard):
+                    settle_pending_transactions(
+                        Transaction.objects.filter(status='pending').values_list('id', flat=True),
+                        'done')
+            return expected
+
+        with mock.patch('base.reconciliation.expected_balances',
+                        settle_after_reading_the_ledger):
+            checked, mismatches, repaired = reconcile_range(
+                self.wallet.id, self.other.id + 1, repair=True)
+
+        # The withdrawal looks like a mismatch, but is not corrected
+        self.assertEqual([row['diff'] for row in mismatches], [Decimal('-40')])
+        self.assertEqual(repaired, 0)
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal('30'))
+
+
+@override_settings(PROFILE_KEEP=2)
+class RequestProfilingTests(LedgerTestCase):
+    def setUp(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        self.enterContext(override_settings(PROFILE_DIR=profile_dir))
+        self.staff = CustomUser.objects.create_superuser(
+            email='staff@example.com', password='secret')
+        self.user = CustomUser.objects.create_user(
+            email='customer@example.com', password='secret')
+        self.client = Client()
+
+    def test_only_staff_requests_are_profiled(self):
+        authenticate(self.client, self.user)
+        response = self.client.get('/api/wallets/', HTTP_X_PROFILE='1')
+        self.assertFalse(response.has_header('X-Profile-Id'))
+
+        authenticate(self.client, self.staff)
+        ids = [self.client.get('/api/wallets/?profile=1')['X-Profile-Id']
+               for _ in range(3)]
+        listed = [profile['id'] for profile in self.client.get('/api/profiles/').json()]
+        # Only the newest PROFILE_KEEP reports are kept
+        self.assertEqual(listed, ids[:0:-1])
+
+        report = self.client.get(f'/api/profiles/{ids[-1]}/')
+        self.assertEqual(report.status_code, 200)
+        self.assertIn('hotspots', b''.join(report.streaming_content).decode())
+        self.assertEqual(self.client.get(f'/api/profiles/{ids[0]}/').status_code, 404)
+
+
+@override_settings(AUDIT_FLUSH_SECONDS=0)
+class DashboardCacheTests(LedgerTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            email='dashboard@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.profile = UserProfile.objects.get(user=self.user)
+        self.url = f'/api/user_profile/{self.profile.id}/'
+
+    def test_dashboard_is_cached_until_the_user_writes(self):
+        first = self.client.get(self.url).json()
+        # Only the profile lookup itself reaches the database
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url).json(), first)
+
+        wallet = Wallet.objects.filter(user=self.user).first()
+        with self.captureOnCommitCallbacks(using=self.shard, execute=True):
+            wallet.balance = Decimal('12.50')
+            wallet.save()
+        balances = [row['balance'] for row in self.client.get(self.url).json()['wallets']]
+        self.assertIn('12.50', balances)
+        self.assertEqual(cache_stats(), {'hits': 1, 'misses': 2, 'hit_ratio': 0.3333})
+
+    def test_saving_the_user_invalidates_once_its_own_database_commits(self):
+        version = dashboard_version(self.user.pk)
+        with self.captureOnCommitCallbacks(using='default', execute=True):
+            self.user.full_name = 'Renamed'
+            self.user.save()
+        self.assertNotEqual(dashboard_version(self.user.pk), version)
+
+    @override_settings(DASHBOARD_CACHE_WAIT_SECONDS=0.1)
+    def test_a_held_lock_is_waited_on_only_briefly(self):
+        key = f'dashboard:{self.user.pk}:{dashboard_version(self.user.pk)}:plain'
+        cache.add(f'{key}:lock', True, 60)
+        started = time.monotonic()
+        self.assertEqual(cached_dashboard(self.user.pk, 'plain', lambda: {'fresh': True}),
+                         {'fresh': True})
+        self.assertLess(time.monotonic() - started, 5)
+        # The lock holder caches the result and releases its own lock
+        self.assertIsNone(cache.get(key))
+        self.assertTrue(cache.get(f'{key}:lock'))
+
+    def test_valuations_without_prices_are_not_cached(self):
+        provider = FailingPriceProvider()
+        provider.failing = True
+        feed = PriceFeed(provider, ['USDT', 'BNB'])
+        with mock.patch('base.prices.get_price_feed', return_value=feed):
+            with self.assertLogs('base.prices', 'WARNING'):
+                self.assertIsNone(self.client.get(self.url).json()['total_usd_value'])
+
+            provider.failing = False
+            feed.refresh()
+            self.assertEqual(self.client.get(self.url).json()['total_usd_value'], 0)
+        self.assertEqual(cache_stats()['misses'], 2)
+
+
+class FailingPriceProvider(StubPriceProvider):
+    failing = False
+
+    def fetch(self, assets):
+        if self.failing:
+            raise ConnectionError("provider down")
+        return super().fetch(assets)
+
+
+class PriceFeedTests(LedgerTestCase):
+    def test_last_known_prices_survive_provider_failures(self):
+        provider = FailingPriceProvider()
+        feed = PriceFeed(provider, ['USDT', 'BNB'])
+        feed.refresh()
+        self.assertEqual(feed.prices(), {'USDT': Decimal('1.00'), 'BNB': Decimal('600.00')})
+
+        provider.failing = True
+        with self.assertLogs('base.prices', 'WARNING'):
+            feed.refresh()
+        self.assertEqual(feed.prices()['BNB'], Decimal('600.00'))
+
+    def test_a_cold_feed_fetches_before_answering(self):
+        feed = PriceFeed(StubPriceProvider(), ['BNB'])
+        with mock.patch('base.prices.threading.Thread') as thread:
+            self.assertEqual(feed.prices(), {'BNB': Decimal('600.00')})
+            self.assertEqual(feed.prices(), {'BNB': Decimal('600.00')})
+        # Fresh prices, so no background refresh either
+        thread.assert_not_called()
+
+    def test_tests_never_reach_a_real_provider(self):
+        self.assertEqual(settings.PRICE_FEED_PROVIDER, 'base.prices.StubPriceProvider')
+
+    def test_wallets_are_valued_in_usd(self):
+        user = CustomUser.objects.create_user(email='usd@example.com', password='secret')
+        self.pin_shard(user)
+        Wallet.objects.filter(user=user, title='BNB').update(balance=Decimal('0.5'))
+        Wallet.objects.filter(user=user, title='USDT(TRC20)').update(balance=Decimal('10'))
+        context = {'prices': {'USDT': Decimal('1.00'), 'BNB': Decimal('600.00')}}
+
+        profile = UserProfile.objects.get(user=user)
+        data = UserProfileSerializer(profile, context=context).data
+        self.assertEqual(sorted(row['usd_value'] for row in data['wallets']),
+                         [Decimal('10.00'), Decimal('300.00')])
+        self.assertEqual(data['total_usd_value'], Decimal('310.00'))
+
+
+class TransactionListFilterTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='filters@example.com', password='secret')
+        self.pin_shard(self.user)
+        wallet = Wallet.objects.filter(user=self.user).first()
+        for amount, status in (('5', 'done'), ('50', 'done'), ('500', 'pending')):
+            Transaction.objects.create(
+                transaction_type='deposit', user=self.user, wallet=wallet,
+                amount=Decimal(amount), status=status)
+        authenticate(self.client, self.user)
+
+    def test_filters_ordering_and_fields(self):
+        rows = self.client.get('/api/transaction/', {
+            'status': 'done', 'amount__gte': '10', 'fields': 'id,amount'}).json()
+        self.assertEqual([list(row) for row in rows], [['id', 'amount']])
+        self.assertEqual(rows[0]['amount'], '50.00')
+
+        amounts = [row['amount'] for row in self.client.get(
+            '/api/transaction/', {'ordering': '-amount', 'fields': 'amount'}).json()]
+        self.assertEqual(amounts, ['500.00', '50.00', '5.00'])
+        # Sorts without a supporting index are ignored
+        ids = [row['id'] for row in self.client.get(
+            '/api/transaction/', {'ordering': 'wallet_address', 'fields': 'id'}).json()]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_invalid_amounts_are_rejected(self):
+        for value in ('1e40', '99999999999999999999', 'nan', 'inf', '1.005', 'abc'):
+            for path in ('/api/transaction/', '/api/investment_sub/'):
+                for lookup in ('amount__gte', 'amount__lte'):
+                    response = self.client.get(path, {lookup: value})
+                    self.assertEqual(response.status_code, 400, (path, lookup, value))
+                    self.assertIn(lookup, response.json())
+        self.assertEqual(len(self.client.get(
+            '/api/transaction/', {'amount__lte': '9999999999999999.99'}).json()), 3)
+
+
+@override_settings(AUDIT_FLUSH_SECONDS=0)
+class BalanceAuditTests(LedgerTestCase):
+    def setUp(self):
+        audit_buffer.flush()
+        self.user = CustomUser.objects.create_user(
+            email='audit@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+
+    def test_api_changes_are_attributed_to_user_and_view(self):
+        authenticate(self.client, self.user)
+        with self.captureOnCommitCallbacks(using=self.shard, execute=True):
+            self.client.post('/api/transaction/', {
+                'wallet': self.wallet.id, 'amount': '25', 'transaction_type': 'deposit',
+                'status': 'done', 'wallet_address': 'TXaudit'})
+        self.assertFalse(BalanceAuditEntry.objects.filter(wallet=self.wallet).exists())
+
+        audit_buffer.flush()
+        entry = BalanceAuditEntry.objects.get(wallet=self.wallet, balance_after=Decimal('25'))
+        self.assertEqual(entry.balance_before, Decimal('0'))
+        self.assertEqual(entry.actor_id, self.user.id)
+        self.assertEqual(entry.source, 'POST transaction')
+
+    def test_full_buffer_is_written_synchronously(self):
+        buffer = AuditBuffer(max_size=2, flush_size=2, interval=0)
+        entries = [{'wallet_id': self.wallet.id, 'user_id': self.user.id,
+                    'balance_before': Decimal(n), 'balance_after': Decimal(n + 1),
+                    'source': 'test'} for n in range(3)]
+        for entry in entries[:2]:
+            buffer.add(entry)
+        self.assertEqual(BalanceAuditEntry.objects.filter(source='test').count(), 0)
+        buffer.add(entries[2])
+        self.assertEqual(BalanceAuditEntry.objects.filter(source='test').count(), 3)
+        self.assertEqual(buffer.flush(), 0)
+
+
+class LeanApiMiddlewareTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='lean@example.com', password='secret', is_staff=True)
+
+    def test_api_skips_sessions_and_admin_keeps_them(self):
+        self.client.force_login(self.user)
+        # A session alone no longer authenticates API calls
+        self.assertEqual(self.client.get('/api/jobs/').status_code, 403)
+
+        authenticate(self.client, self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/')
+        self.assertNotIn('X-Frame-Options', response)
+        with override_settings(LEAN_API_PATHS=[]), self.assertNumQueries(2):
+            # Session and user lookups for SessionAuthentication
+            self.assertIn('X-Frame-Options', self.client.get('/api/'))
+
+        self.assertEqual(self.client.get('/admin/').status_code, 200)
+
+
+class SnapshotExportTests(LedgerTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.user = CustomUser.objects.create_user(
+            email='snapshots@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+        plan = Investment.objects.create(plan='premium')
+        InvestmentSubscription.objects.create(
+            user=self.user, wallet=self.wallet, investment_plan=plan,
+            amount=Decimal('100'), total_return=Decimal('12.50'), settled=True)
+        InvestmentSubscription.objects.create(
+            user=self.user, wallet=self.wallet, investment_plan=plan, amount=Decimal('40'))
+
+    def deposit(self, amount, status):
+        return Transaction.objects.create(
+            transaction_type='deposit', user=self.user, wallet=self.wallet,
+            amount=Decimal(amount), status=status)
+
+    def test_exports_append_rows_once_they_are_final(self):
+        self.deposit('10', 'done')
+        pending = self.deposit('5', 'pending')
+        self.assertEqual(export_snapshots(self.directory),
+                         {'transactions': 1, 'subscriptions': 1})
+        state = Snapshot(self.directory).manifest['tables']['transactions']['shards'][self.shard]
+        self.assertEqual(state['pending_from'], pending.pk)
+
+        Transaction.objects.filter(pk=pending.pk).update(status='done')
+        self.deposit('2.50', 'declined')
+        self.assertEqual(export_snapshots(self.directory),
+                         {'transactions': 2, 'subscriptions': 0})
+        self.assertEqual(export_snapshots(self.directory),
+                         {'transactions': 0, 'subscriptions': 0})
+
+        snapshot = Snapshot(self.directory)
+        self.assertEqual(transaction_totals_per_day(snapshot),
+                         {timezone.localdate(): 1500})
+        self.assertEqual(investments_per_plan(snapshot),
+                         {'premium': {'count': 1, 'amount': 10000}})
+
+    def test_rows_settled_after_the_low_water_mark_are_exported_once(self):
+        first = self.deposit('5', 'pending')
+        self.deposit('10', 'done')
+        later = self.deposit('1', 'pending')
+        self.assertEqual(export_snapshots(self.directory)['transactions'], 1)
+
+        # The done row between the two is already in the snapshot
+        Transaction.objects.filter(pk=later.pk).update(status='done')
+        self.assertEqual(export_snapshots(self.directory)['transactions'], 1)
+        Transaction.objects.filter(pk=first.pk).update(status='declined')
+        self.assertEqual(export_snapshots(self.directory)['transactions'], 1)
+
+        snapshot = Snapshot(self.directory)
+        self.assertEqual(sorted(snapshot.column('transactions', 'id')),
+                         sorted(Transaction.objects.values_list('id', flat=True)))
+        state = snapshot.manifest['tables']['transactions']['shards'][self.shard]
+        self.assertIsNone(state['pending_from'])
+
+
+@override_settings(AUDIT_FLUSH_SECONDS=0)
+class ShardRoutingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        # One user per shard, since placement goes round the shards by id
+        self.users = [CustomUser.objects.create_user(
+            email=f'shard{n}@example.com', password='secret')
+            for n in range(len(settings.DATABASE_SHARDS))]
+        self.staff = CustomUser.objects.create_user(
+            email='staff@example.com', password='secret', is_staff=True)
+
+    def test_ledger_rows_live_on_their_users_shard(self):
+        self.assertEqual({shard_for_user(user.pk) for user in self.users},
+                         set(settings.DATABASE_SHARDS))
+        for user in self.users:
+            shard = shard_for_user(user.pk)
+            wallets = Wallet.objects.using(shard).filter(user=user)
+            self.assertEqual(wallets.count(), 2)
+            self.assertTrue(all(shard_for_id(wallet.pk) == shard for wallet in wallets))
+
+    def test_users_see_their_shard_and_staff_see_every_shard(self):
+        wallets = {}
+        for n, user in enumerate(self.users, start=1):
+            wallet = Wallet.objects.using(shard_for_user(user.pk)).filter(user=user).first()
+            wallets[wallet.pk] = Decimal(n * 10)
+            authenticate(self.client, user)
+            self.client.post('/api/transaction/', {
+                'wallet': wallet.pk, 'amount': str(n * 10),
+                'transaction_type': 'deposit', 'status': 'pending'})
+            rows = self.client.get('/api/transaction/').json()
+            self.assertEqual([row['wallet'] for row in rows], [wallet.pk])
+
+        authenticate(self.client, self.staff)
+        pending = self.client.get('/api/transaction/', {
+            'status': 'pending', 'ordering': '-amount'}).json()
+        self.assertEqual([Decimal(row['amount']) for row in pending],
+                         sorted(wallets.values(), reverse=True))
+
+        settle_transactions([row['id'] for row in pending], 'done')
+        for wallet_id, amount in wallets.items():
+            wallet = Wallet.objects.using(shard_for_id(wallet_id)).get(pk=wallet_id)
+            self.assertEqual(wallet.balance, amount)
+
+    def test_shards_only_hold_the_ledger_and_what_it_points_at(self):
+        tables = connections[settings.DATABASE_SHARDS[1]].introspection.table_names()
+        self.assertIn(Wallet._meta.db_table, tables)
+        self.assertIn(CustomUser._meta.db_table, tables)
+        self.assertNotIn(Job._meta.db_table, tables)
+        self.assertNotIn(UserProfile._meta.db_table, tables)
+
+    def test_deleting_a_user_removes_their_ledger_from_the_shard(self):
+        user = next(user for user in self.users if shard_for_user(user.pk) != 'default')
+        shard = shard_for_user(user.pk)
+        user.delete()
+        self.assertFalse(Wallet.objects.using(shard).filter(user=user.pk).exists())
+        self.assertFalse(CustomUser.objects.using(shard).filter(pk=user.pk).exists())
+
+    def test_directory_changes_reach_the_cached_lookup(self):
+        user = self.users[0]
+        old = shard_for_user(user.pk)
+        new = next(shard for shard in settings.DATABASE_SHARDS if shard != old)
+        entry = UserShard.objects.get(user=user)
+        entry.shard = new
+        entry.save()
+        self.assertEqual(shard_for_user(user.pk), new)
+
+
+class FastSerializationParityTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='parity@example.com', password='secret', full_name='Parity User')
+        # No full name, so user_name renders as "None"
+        other = CustomUser.objects.create_user(email='other@example.com', password='secret')
+        plan = Investment.objects.create(
+            plan='premium', daily_return_rate=Decimal('2.50'),
+            minimum_amount=Decimal('10'), maximum_amount=Decimal('5000'))
+        self.owners = [self.user, other]
+        for owner in self.owners:
+            with use_user_shard(owner.pk):
+                for index, wallet in enumerate(Wallet.objects.filter(user=owner)):
+                    Wallet.objects.filter(id=wallet.id).update(balance=Decimal('1234.5') * index)
+                    Transaction.objects.create(
+                        transaction_type='deposit', user=owner, wallet=wallet,
+                        amount=Decimal('99.9'), status='done', wallet_address='TXabc')
+                    Transaction.objects.create(
+                        transaction_type='withdrawal', user=owner, wallet=wallet,
+                        amount=Decimal('5'), wallet_address=None)
+                    InvestmentSubscription.objects.create(
+                        user=owner, wallet=wallet, investment_plan=plan,
+                        amount=Decimal('100.25'), total_return=Decimal('7.1'))
+        self.context = {'request': Request(RequestFactory().get('/api/')),
+                        'prices': {'USDT': Decimal('1'), 'BNB': Decimal('612.37')}}
+
+    def assertSameBytes(self, serializer_class, queryset):
+        expected = JSONRenderer().render(
+            serializer_class(queryset, many=True, context=self.context).data)
+        actual = JSONRenderer().render(
+            serialize_rows(serializer_class, queryset, self.context))
+        self.assertEqual(actual, expected)
+
+    def test_list_serializers_match_model_serializers(self):
+        self.assertSameBytes(UserSerializer, CustomUser.objects.all())
+        for owner in self.owners:
+            with use_user_shard(owner.pk):
+                self.assertSameBytes(WalletSerializer, Wallet.objects.all())
+                self.assertSameBytes(InvestmentSubscriptionSerializer,
+                                     InvestmentSubscription.objects.all())
+                self.assertSameBytes(TransactionSerializer, Transaction.objects.all())
+
+
+class AccrualModeParityTests(LedgerTestCase):
+    def setUp(self):
+        self.start = timezone.now()
+        user = CustomUser.objects.create_user(email='accrual@example.com', password='secret')
+        self.pin_shard(user)
+        self.wallet = Wallet.objects.filter(user=user).first()
+        self.plan = Investment.objects.create(
+            plan='standard', daily_return_rate=Decimal('2.55'),
+            minimum_amount=Decimal('1'), maximum_amount=Decimal('5000'))
+        for amount, days_ago in (('100.25', 0), ('33.33', 12), ('2500', 29)):
+            InvestmentSubscription.objects.create(
+                user=user, wallet=self.wallet, investment_plan=self.plan, amount=Decimal(amount),
+                subscription_date=self.start - timezone.timedelta(days=days_ago))
+
+    def run_days(self, mode, days=32):
+        """
+        Run the daily jobs in `mode` for `days` days, changing the plan's
+        rate on day 10. Returns the returns shown each day and the wallet's
+        final balance; the database is left as it was.
+        """
+        shown = []
+        # Plans are kept on 'default' and copied to the shards
+        with transaction.atomic(), transaction.atomic(using=self.shard), \
+                override_settings(ACCRUAL_MODE=mode):
+            for day in range(days):
+                at = self.start + timezone.timedelta(days=day)
+                with mock.patch('django.utils.timezone.now', return_value=at):
+                    if day == 10:
+                        self.plan.daily_return_rate = Decimal('3.10')
+                        self.plan.save()
+                    subscriptions = InvestmentSubscription.objects.order_by('id')
+                    stored = list(subscriptions.values_list('total_return', 'accrued_on'))
+                    daily_update_total_return()
+                    if mode == 'lazy':
+                        self.assertEqual(
+                            list(subscriptions.values_list('total_return', 'accrued_on')),
+                            stored)
+                    settle_matured_investments()
+                    rows = serialize_rows(InvestmentSubscriptionSerializer, subscriptions)
+                    self.assertEqual(
+                        [row['total_return'] for row in rows],
+                        [InvestmentSubscriptionSerializer(subscription).data['total_return']
+                         for subscription in subscriptions])
+                    self.assertEqual(
+                        [Decimal(row['total_return']) for row in rows],
+                        list(with_accrued_return(subscriptions, at)
+                             .values_list('accrued_return', flat=True)))
+                    shown.append([row['total_return'] for row in rows])
+            self.wallet.refresh_from_db()
+            balance = self.wallet.balance
+            transaction.set_rollback(True)
+            transaction.set_rollback(True, using=self.shard)
+        return shown, balance
+
+    def test_lazy_returns_match_eager_returns(self):
+        eager_shown, eager_balance = self.run_days('eager')
+        lazy_shown, lazy_balance = self.run_days('lazy')
+        self.assertEqual(lazy_shown, eager_shown)
+        self.assertEqual(lazy_balance, eager_balance)
+        # 30 days of returns each, those after day 10 at the new rate
+        self.assertEqual(lazy_shown[-1], ['87.80', '26.94', '1912.50'])
+        self.assertEqual(lazy_balance, Decimal('4660.82'))
+
+
+class FastJSONRendererTests(TestCase):
+    def test_output_matches_stdlib_renderer(self):
+        data = {
+            'amount': Decimal('12.50'),
+            'date': timezone.now(),
+            'day': timezone.localdate(),
+            'name': 'José  ',
+            'rows': [{'id': 1, 'balance': '0.00', 'title': None}],
+            7: True,
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+
+class MoneyTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='money@example.com', password='secret')
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+
+    def test_conversions_round_half_even(self):
+        self.assertEqual(to_minor(Decimal('12.345')), 1234)
+        self.assertEqual(to_minor(Decimal('12.355')), 1236)
+        self.assertEqual(to_minor('-0.005'), 0)
+        self.assertEqual(to_minor(Decimal('1e40')), 10 ** 42)
+        self.assertEqual(from_minor(1234), Decimal('12.34'))
+        self.assertEqual(from_minor(-5), Decimal('-0.05'))
+        # 2.5% of 1.00, 0.30 and 0.10 is 2.5, 0.75 and 0.25 minor units
+        self.assertEqual(percent_of(100, Decimal('2.50')), 2)
+        self.assertEqual(percent_of(30, Decimal('2.50')), 1)
+        self.assertEqual(percent_of(10, Decimal('2.50')), 0)
+        for value in ('nan', 'inf', '-Infinity', 'snan'):
+            with self.assertRaises(ValueError):
+                to_minor(Decimal(value))
+
+    def test_values_round_trip_through_the_column(self):
+        for amount in ('0', '12.34', '-7.05', '92233720368547758.07'):
+            Wallet.objects.filter(pk=self.wallet.pk).update(balance=Decimal(amount))
+            self.wallet.refresh_from_db()
+            self.assertEqual(self.wallet.balance, Decimal(amount))
+        with connections[self.wallet._state.db].cursor() as cursor:
+            cursor.execute('SELECT balance FROM base_wallet WHERE id = %s', [self.wallet.pk])
+            self.assertEqual(cursor.fetchone()[0], 9223372036854775807)
+
+    def test_lookups_convert_and_bound_amounts(self):
+        Wallet.objects.filter(pk=self.wallet.pk).update(balance=Decimal('12.50'))
+        mine = Wallet.objects.filter(pk=self.wallet.pk)
+        # Floats are amounts too, not rounded up to whole units
+        self.assertTrue(mine.filter(balance__gte=12.5).exists())
+        self.assertTrue(mine.filter(balance__lt=12.51).exists())
+        self.assertTrue(mine.filter(balance=Decimal('12.5')).exists())
+        # Past the column's range: everything or nothing, without a query error
+        self.assertFalse(mine.filter(balance__gte=Decimal('1e40')).exists())
+        self.assertTrue(mine.filter(balance__lt=Decimal('1e40')).exists())
+        self.assertTrue(mine.filter(balance__gte=Decimal('-1e40')).exists())
+        self.assertFalse(mine.filter(balance=Decimal('1e40')).exists())
+        with self.assertRaises(ValueError):
+            mine.filter(balance__gte=Decimal('nan')).exists()
+
+    def test_validation_rejects_non_finite_and_oversized_amounts(self):
+        field = Wallet._meta.get_field('balance')
+        self.assertEqual(field.clean('1.005', self.wallet), Decimal('1.00'))
+        for value in ('inf', 'nan', 'abc', '1e40'):
+            with self.assertRaises(ValidationError):
+                field.clean(value, self.wallet)
+
+
+class MoneyMigrationTests(TransactionTestCase):
+    before = [('base', '0007_job_queue')]
+    after = [('base', '0008_money_minor_units')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def raw_amounts(self):
+        with connection.cursor() as cursor:
+            # SQLite hands decimal columns back as floats
+            cursor.execute('SELECT balance FROM base_wallet')
+            balances = [Decimal(str(row[0])) for row in cursor.fetchall()]
+            cursor.execute('SELECT amount FROM base_transaction')
+            return balances, [Decimal(str(row[0])) for row in cursor.fetchall()]
+
+    def test_amounts_scale_to_minor_units_and_back(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        user = apps.get_model('base', 'CustomUser').objects.create(
+            email='migrated@example.com', password='!')
+        wallet = apps.get_model('base', 'Wallet').objects.create(
+            user=user, title='USDT(TRC20)', wallet_address='TX', balance=Decimal('12.34'))
+        apps.get_model('base', 'Transaction').objects.create(
+            user=user, wallet=wallet, transaction_type='deposit',
+            amount=Decimal('0.05'), status='done')
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        self.assertEqual(self.raw_amounts(), ([Decimal(1234)], [Decimal(5)]))
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        self.assertEqual(self.raw_amounts(), ([Decimal('12.34')], [Decimal('0.05')]))
+
+
+class StaffSearchTests(LedgerTestCase):
+    def setUp(self):
+        local_index.clear()
+        self.user = CustomUser.objects.create_user(
+            email='carol.finance@example.com', password='secret', full_name='Carol Jones')
+        self.staff = CustomUser.objects.create_user(
+            email='staff@example.com', password='secret', is_staff=True)
+        self.pin_shard(self.user)
+        self.wallet = Wallet.objects.filter(user=self.user).first()
+        self.deposit = Transaction.objects.create(
+            transaction_type='deposit', user=self.user, wallet=self.wallet,
+            amount=Decimal('125.50'), status='done', wallet_address='TXsearchable9')
+
+    def tearDown(self):
+        local_index.clear()
+
+    def found(self, query):
+        return [(row['type'], row['id']) for row in search(query)]
+
+    def test_index_ranks_exact_tokens_above_prefixes(self):
+        index = InvertedIndex()
+        index.update(('user', 1), 'a', 'anna')
+        index.build()
+        index.update(('user', 1), 'a', 'anna')
+        index.update(('user', 2), 'b', 'annabel')
+        index.update(('user', 3), 'c', 'bob anna')
+        self.assertEqual([row['id'] for row in index.search('anna', 10)], [1, 3, 2])
+        self.assertEqual([row['id'] for row in index.search('bob ann', 10)], [3])
+        index.remove(('user', 3))
+        self.assertEqual([row['id'] for row in index.search('bob', 10)], [])
+        self.assertNotIn('bo', index.postings)
+
+    def test_search_matches_people_addresses_and_amounts(self):
+        self.assertIn(('user', self.user.id), self.found('carol'))
+        self.assertIn(('user', self.user.id), self.found('jon'))
+        self.assertEqual(self.found('TXsearch'), [('transaction', self.deposit.id)])
+        self.assertEqual(self.found('125.50')[0], ('transaction', self.deposit.id))
+        self.assertEqual(self.found('1,25.5')[0], ('transaction', self.deposit.id))
+        self.assertEqual(self.found('c'), [])
+
+    def test_number_like_text_is_not_an_amount(self):
+        for query in ('nan', 'NaN', 'inf', 'Infinity', '-inf', 'snan', '1e40',
+                      '-99999999999999999999', 'info@example.com'):
+            self.assertEqual(parse_amount(query), None, query)
+            search(query)
+        self.assertEqual(parse_amount('92233720368547758.07'), Decimal('92233720368547758.07'))
+        self.assertEqual(parse_amount('92233720368547758.08'), None)
+
+    def test_signals_keep_the_index_current(self):
+        self.assertEqual(self.found('dora'), [])
+        self.user.full_name = 'Dora Jones'
+        self.user.save()
+        self.assertEqual(self.found('dora'), [('user', self.user.id)])
+        self.deposit.wallet_address = 'TXrenamed'
+        self.deposit.save()
+        self.assertEqual(self.found('TXsearch'), [])
+        self.assertEqual(self.found('TXrenamed'), [('transaction', self.deposit.id)])
+        self.deposit.delete()
+        self.assertEqual(self.found('TXrenamed'), [])
+
+    def test_endpoint_is_staff_only_and_clamps_the_limit(self):
+        authenticate(self.client, self.user)
+        self.assertEqual(self.client.get('/api/search/', {'q': 'carol'}).status_code, 403)
+
+        authenticate(self.client, self.staff)
+        response = self.client.get('/api/search/', {'q': 'example', 'limit': 'x'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({row['id'] for row in response.json()}, {self.user.id, self.staff.id})
+        response = self.client.get('/api/search/', {'q': 'example', 'limit': '0'})
+        self.assertEqual(len(response.json()), 1)
+        for query in ('inf', 'nan', '1e40'):
+            self.assertEqual(self.client.get('/api/search/', {'q': query}).status_code, 200)
+
+
+class EventStreamTests(LedgerTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='events@example.com', password='secret')
+        authenticate(self.client, self.user)
+        response = self.client.post('/api/events/ticket/')
+        self.assertEqual(response.status_code, 201)
+        self.ticket = response.json()['ticket']
+
+    async def test_a_ticket_opens_one_stream(self):
+        response = await self.async_client.get('/api/events/', {'ticket': self.ticket})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = aiter(response.streaming_content)
+        self.assertEqual(await anext(content), b'retry: 5000\n\n')
+        get_broker().publish(self.user.pk, {'type': 'wallet', 'data': {'balance': Decimal('5')}})
+        self.assertEqual(await anext(content), b'event: wallet\ndata: {"balance": "5"}\n\n')
+        await content.aclose()
+
+        # Used tickets and access tokens in the URL are refused
+        for params in ({'ticket': self.ticket}, {'token': str(AccessToken.for_user(self.user))},
+                       {'ticket': 'made-up'}):
+            response = await self.async_client.get('/api/events/', params)
+            self.assertEqual(response.status_code, 401, params)
+
+    def test_tickets_need_a_user_and_streams_need_asgi(self):
+        self.assertEqual(Client().post('/api/events/ticket/').status_code, 403)
+        response = self.client.get('/api/events/', {'ticket': self.ticket})
+        self.assertEqual(response.status_code, 501)
+        self.assertEqual(cache.get(f'event-ticket:{self.ticket}'), self.user.pk)
+
+
+class JobQueueTests(LedgerTestCase):
+    def setUp(self):
+        self.calls = []
+
+        def flaky(fail=False):
+            self.calls.append(fail)
+            if fail:
+                raise RuntimeError('boom')
+            return {'ok': True}
+
+        self.enterContext(mock.patch.dict(registry, {'test.flaky': (flaky, 2)}))
+
+    def test_claims_respect_concurrency_slots(self):
+        jobs = [enqueue('test.flaky') for _ in range(3)]
+        first, second = claim_next('a'), claim_next('b')
+        self.assertEqual({first.slot, second.slot}, {0, 1})
+        self.assertIsNone(claim_next('c'))
+
+        self.assertTrue(run_job(first))
+        third = claim_next('c')
+        self.assertEqual((third.id, third.slot), (jobs[2].id, first.slot))
+        self.assertEqual(Job.objects.get(id=first.id).result, {'ok': True})
+
+    @override_settings(JOB_RETRY_BACKOFF_SECONDS=10)
+    def test_failures_back_off_then_fail(self):
+        job = enqueue('test.flaky', {'fail': True}, max_attempts=2)
+        started = timezone.now()
+        with self.assertLogs('base.jobs', 'ERROR'):
+            self.assertFalse(run_job(claim_next('a')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.slot), ('queued', 1, None))
+        self.assertGreaterEqual(job.run_after, started + timezone.timedelta(seconds=10))
+        self.assertIsNone(claim_next('a'))
+
+        Job.objects.filter(id=job.id).update(run_after=timezone.now())
+        with self.assertLogs('base.jobs', 'ERROR'):
+            self.assertFalse(run_job(claim_next('a')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertIn('RuntimeError: boom', job.error)
+        self.assertEqual(self.calls, [True, True])
+
+    def test_jobs_of_dead_workers_are_requeued(self):
+        job = enqueue('test.flaky')
+        claim_next('dead')
+        self.assertEqual(release_stale_jobs(), 0)
+        Job.objects.filter(id=job.id).update(
+            locked_at=timezone.now() - timezone.timedelta(
+                seconds=settings.JOB_LOCK_TIMEOUT_SECONDS + 1))
+        # Workers release stale jobs on a timer, busy or not
+        self.assertEqual(run_worker(once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+
+    def test_a_run_that_lost_its_claim_does_not_record_an_outcome(self):
+        def stolen():
+            # Released as stale meanwhile and claimed by another worker
+            Job.objects.filter(job_type='test.stolen').update(locked_by='other')
+
+        with mock.patch.dict(registry, {'test.stolen': (stolen, 1)}):
+            job = enqueue('test.stolen')
+            with self.assertLogs('base.jobs', 'WARNING'):
+                run_job(claim_next('a'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by), ('running', 'other'))
+
+    def test_payloads_must_match_the_handler(self):
+        for payload in (['x'], 'x', {'fail': True, 'extra': 1}):
+            with self.assertRaises(ValueError):
+                enqueue('test.flaky', payload)
+
+        staff = CustomUser.objects.create_user(
+            email='queuer@example.com', password='secret', is_staff=True)
+        authenticate(self.client, staff)
+        for payload in ([1, 2], 7, {'status': 'done'},
+                        {'transaction_ids': [1], 'status': 'done', 'batch': 1, 'x': 2}):
+            response = self.client.post('/api/jobs/', {
+                'job_type': 'transactions.settle', 'payload': payload},
+                content_type='application/json')
+            self.assertEqual(response.status_code, 400, payload)
+            self.assertIn('payload', response.json())
+        self.assertFalse(Job.objects.exists())
+        response = self.client.post('/api/jobs/', {
+            'job_type': 'transactions.settle',
+            'payload': {'transaction_ids': [1], 'status': 'done'}},
+            content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+
+    def test_settle_endpoint_validates_its_payload(self):
+        staff = CustomUser.objects.create_user(
+            email='settler@example.com', password='secret', is_staff=True)
+        authenticate(self.client, staff)
+        too_many = list(range(1, settings.TRANSACTION_SETTLE_MAX_IDS + 2))
+        for payload in ({'transaction_ids': [1, 'x'], 'status': 'done'},
+                        {'transaction_ids': 5, 'status': 'done'},
+                        {'transaction_ids': [], 'status': 'done'},
+                        {'transaction_ids': [0], 'status': 'done'},
+                        {'transaction_ids': too_many, 'status': 'done'},
+                        {'transaction_ids': [1], 'status': 'pending'}):
+            response = self.client.post('/api/transaction/settle/', payload,
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400, payload)
+        self.assertFalse(Job.objects.exists())
+
+        response = self.client.post('/api/transaction/settle/', {
+            'transaction_ids': [3, '4'], 'status': 'declined'}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Job.objects.get().payload,
+                         {'transaction_ids': [3, 4], 'status': 'declined'})
+
+
+class PayoutProjectionTests(LedgerTestCase):
+    horizon = 40
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.today = timezone.localdate(self.now)
+        # Premium stops accruing after 10 days, long before it is paid out
+        plans = [Investment.objects.create(plan='basic', daily_return_rate=Decimal('2.55')),
+                 Investment.objects.create(plan='premium', daily_return_rate=Decimal('3.10'),
+                                           duration_days=10)]
+        self.user = CustomUser.objects.create_user(
+            email='projection@example.com', password='secret')
+        self.staff = CustomUser.objects.create_user(
+            email='forecast@example.com', password='secret', is_staff=True)
+        self.subscriptions = []
+        # The staff member's subscription is on another shard
+        for owner, rows in ((self.user, (('100.25', 29), ('33.33', 12), ('0.30', 0))),
+                            (self.staff, (('2500', 3), ('19.99', -2)))):
+            with use_user_shard(owner.pk):
+                wallet = Wallet.objects.filter(user=owner).first()
+                for n, (amount, days_ago) in enumerate(rows):
+                    self.subscriptions.append(InvestmentSubscription.objects.create(
+                        user=owner, wallet=wallet, investment_plan=plans[n % 2],
+                        amount=Decimal(amount),
+                        subscription_date=self.now - timezone.timedelta(days=days_ago)))
+
+    def accrued(self, subscription, day):
+        # Return to date at the end of the window's `day`-th day
+        return accrued_minor(
+            subscription.amount, subscription.investment_plan.daily_return_rate,
+            subscription.subscription_date, subscription.investment_plan.duration_days,
+            at=self.now + timezone.timedelta(days=day))
+
+    def expected(self, subscriptions, plans):
+        returns = np.zeros((len(plans), self.horizon), dtype=np.int64)
+        principal = np.zeros((len(plans), self.horizon), dtype=np.int64)
+        for subscription in subscriptions:
+            group = plans.index(subscription.investment_plan.plan)
+            daily = to_minor(subscription.calculate_daily_return())
+            for day in range(self.horizon):
+                earned = self.accrued(subscription, day) - self.accrued(subscription, day - 1)
+                self.assertIn(earned, (0, daily))
+                returns[group, day] += earned
+            end = (timezone.localdate(subscription.end_date) - self.today).days
+            if 0 <= end < self.horizon:
+                principal[group, end] += to_minor(subscription.amount)
+        return returns, principal
+
+    def test_projection_matches_daily_accrual(self):
+        columns = {}
+        for owner in (self.user, self.staff):
+            with use_user_shard(owner.pk):
+                shard_columns = load_subscription_columns(active_subscriptions())
+            for name, values in shard_columns.items():
+                columns[name] = np.concatenate([columns.get(name, values[:0]), values])
+
+        days, plans, returns, principal = project_payouts(
+            columns, self.today, self.horizon, group_by_plan=True)
+        self.assertEqual(list(plans), ['basic', 'premium'])
+        self.assertEqual(str(days[0]), str(self.today))
+        expected_returns, expected_principal = self.expected(self.subscriptions, list(plans))
+        self.assertEqual(returns.tolist(), expected_returns.tolist())
+        self.assertEqual(principal.tolist(), expected_principal.tolist())
+
+        _, groups, total_returns, total_principal = project_payouts(
+            columns, self.today, self.horizon)
+        self.assertEqual(list(groups), ['all'])
+        self.assertEqual(total_returns[0].tolist(), expected_returns.sum(axis=0).tolist())
+        self.assertEqual(total_principal[0].tolist(), expected_principal.sum(axis=0).tolist())
+
+    def test_projection_endpoints(self):
+        authenticate(self.client, self.user)
+        url = '/api/investment_sub/projection/'
+        for days, rows in (('7', 7), ('0', 1), ('-3', 1), ('9999', 365), ('x', 30)):
+            self.assertEqual(len(self.client.get(url, {'days': days}).json()['days']), rows)
+
+        mine = [subscription for subscription in self.subscriptions
+                if subscription.user_id == self.user.pk]
+        returns, principal = self.expected(mine, ['basic', 'premium'])
+        body = self.client.get(url, {'days': self.horizon}).json()
+        self.assertEqual(body['days'][0]['date'], str(self.today))
+        self.assertEqual([row['returns'] for row in body['days']],
+                         [to_major(value) for value in returns.sum(axis=0)])
+        self.assertEqual(body['total_principal'], to_major(principal.sum()))
+        # Amounts are rendered like every other amount, not as floats
+        self.assertEqual(body['total_principal'], '133.88')
+        self.assertEqual(self.client.get(
+            '/api/investment_sub/liability_forecast/').status_code, 403)
+
+        authenticate(self.client, self.staff)
+        url = '/api/investment_sub/liability_forecast/'
+        self.assertEqual(len(self.client.get(url, {'days': '9999'}).json()['totals']), 365)
+        returns, principal = self.expected(self.subscriptions, ['basic', 'premium'])
+        body = self.client.get(url, {'days': self.horizon}).json()
+        self.assertEqual(body['total_returns'], to_major(returns.sum()))
+        self.assertEqual(body['total_principal'], '2653.87')
+        self.assertEqual(sorted(body['plans']), ['basic', 'premium'])
+        self.assertEqual([row['principal'] for row in body['plans']['premium']],
+                         [to_major(value) for value in principal[1]])
+
+
+class CompressionTests(TestCase):
+    body = b'{"rows": [%s]}' % b', '.join(b'{"id": %d, "balance": "0.00"}' % n for n in range(200))
+
+    def respond(self, response, accept='gzip, deflate, br'):
+        request = RequestFactory().get('/api/wallets/', HTTP_ACCEPT_ENCODING=accept)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def json_response(self, body=None):
+        response = HttpResponse(body or self.body, content_type='application/json')
+        response['ETag'] = '"abc"'
+        return response
+
+    def test_negotiation_prefers_brotli_then_gzip(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip;q=0.5, BR, identity;q=x')
+        self.assertEqual(accepted_encodings(request), {'gzip': 0.5, 'br': 1.0, 'identity': 0.0})
+        with mock.patch('base.compression.brotli', mock.Mock()):
+            self.assertEqual(choose_encoding(request), 'br')
+        with mock.patch('base.compression.brotli', None):
+            self.assertEqual(choose_encoding(request), 'gzip')
+        for accept in ('br;q=0, gzip;q=0', 'deflate', ''):
+            request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept)
+            with mock.patch('base.compression.brotli', None):
+                self.assertIsNone(choose_encoding(request), accept)
+
+    @skipUnless(brotli, "brotli is not installed")
+    def test_json_is_compressed_with_brotli(self):
+        response = self.respond(self.json_response())
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), self.body)
+
+    def test_json_is_compressed_with_gzip(self):
+        with mock.patch('base.compression.brotli', None):
+            response = self.respond(self.json_response())
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), self.body)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(response['ETag'], 'W/"abc"')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_small_streaming_and_html_bodies_are_left_alone(self):
+        response = self.respond(self.json_response(b'{"id": 1}'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.content, b'{"id": 1}')
+
+        response = self.respond(self.json_response(), accept='identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        streaming = StreamingHttpResponse(iter([self.body]), content_type='application/json')
+        self.assertFalse(self.respond(streaming).has_header('Content-Encoding'))
+
+        # Admin pages carry CSRF tokens, so they are never compressed (BREACH)
+        html = HttpResponse(b'<p>%s</p>' % self.body, content_type='text/html; charset=utf-8')
+        response = self.respond(html)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertFalse(response.has_header('Vary'))
+
+
+@override_settings(JOB_HEARTBEAT_SECONDS=0.01)
+class JobHeartbeatTests(TransactionTestCase):
+    def test_running_jobs_keep_their_claim_fresh(self):
+        def waits_for_a_heartbeat():
+            locked_at = Job.objects.get(status='running').locked_at
+            deadline = time.monotonic() + 5
+            while Job.objects.get(status='running').locked_at == locked_at:
+                self.assertLess(time.monotonic(), deadline, "no heartbeat")
+                time.sleep(0.01)
+
+        with mock.patch.dict(registry, {'test.slow': (waits_for_a_heartbeat, 1)}):
+            job = enqueue('test.slow')
+            self.assertTrue(run_job(claim_next('a')))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+
+class StartupTests(TestCase):
+    def test_entry_points_do_not_import_lazy_dependencies(self):
+        # Raises CommandError if setup or a web worker boot eagerly imports
+        # the scheduler, SQLAlchemy, NumPy or Cloudinary
+        call_command('benchmark_startup', '--repeat', '1',
+                     '--entry', 'setup', '--entry', 'web', stdout=io.StringIO())
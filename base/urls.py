@@ -9,6 +9,8 @@ from . import views
 
 urlpatterns = [
     path('', views.endpoints),
+    path('events/', views.event_stream, name='events'),
+    path('events/ticket/', views.EventStreamTicketApiView.as_view(), name='events-ticket'),
 
     path('signup/', views.UserCreateApiView.as_view(), name='signup'),
     path('signin/', views.CustomTokenObtainPairView.as_view(),
@@ -16,6 +18,7 @@ urlpatterns = [
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 
     path('users/', views.UserListApiView.as_view(), name='user'),
+    path('search/', views.StaffSearchApiView.as_view(), name='staff-search'),
     path('users/<str:pk>/',
          views.UserRetrieveUpdateDestroyApiView.as_view(), name='user-crud'),
     path('user_profile/', views.UserProfileListApiView.as_view(), name="user-profile"),
@@ -25,11 +28,28 @@ urlpatterns = [
     path('wallets/', views.WalletListApiView.as_view(), name='wallets'),
     path('wallets/<str:pk>/',
          views.WalletRetriveUpdateDestroyApiView.as_view(), name='wallets-details'),
+    path('wallets/<str:pk>/balance_history/',
+         views.WalletBalanceHistoryApiView.as_view(), name='wallets-balance-history'),
     path('investment/', views.InvestmentListCreateApiView.as_view(), name='investment'),
     path('investment_sub/', views.InvestmentSubscriptionListCreateApiView.as_view(),
          name='investment_sub'),
+    path('investment_sub/projection/', views.PortfolioProjectionApiView.as_view(),
+         name='investment_sub-projection'),
+    path('investment_sub/liability_forecast/', views.LiabilityForecastApiView.as_view(),
+         name='investment_sub-liability-forecast'),
     path('transaction/', views.TransactionListCreateApiView.as_view(),
          name="transaction"),
+    path('transaction/settle/', views.TransactionSettleApiView.as_view(),
+         name="transaction-settle"),
     path('transaction/<str:pk>/',
-         views.TransactionRetrieveUpdateDestroyApiView.as_view(), name="transaction-crud")
+         views.TransactionRetrieveUpdateDestroyApiView.as_view(), name="transaction-crud"),
+
+    path('jobs/', views.JobListCreateApiView.as_view(), name='jobs'),
+    path('jobs/<str:pk>/', views.JobRetrieveApiView.as_view(), name='jobs-detail'),
+
+    path('metrics/dashboard_cache/', views.DashboardCacheStatsApiView.as_view(),
+         name='dashboard-cache-stats'),
+    path('profiles/', views.ProfileListApiView.as_view(), name='profiles'),
+    path('profiles/<str:profile_id>/', views.ProfileDownloadApiView.as_view(),
+         name='profiles-download'),
 ]
@@ -1,16 +1,79 @@
+import asyncio
+from itertools import chain
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils import timezone
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import generics, status
+from rest_framework.filters import OrderingFilter
+from rest_framework.views import APIView
 from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework.permissions import IsAuthenticated
-
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+
+from .archive import full_transaction_history, wants_full_history
+from .dashboard import cache_stats, cached_dashboard, dashboard_variant
+from .events import encode_event, get_broker, issue_stream_ticket, redeem_stream_ticket
+from .fast_serializers import serialize_rows
+from .filters import (SUBSCRIPTION_ORDERING, TRANSACTION_ORDERING,
+                      InvestmentSubscriptionFilter, TransactionFilter)
+from .jobs import enqueue
+from .middleware import request_user_id
+from .profiling import list_profiles, profile_path
 from .models import *
+from .rollups import balance_history
+from .search import search
 from .serializers import *
+from .sharding import (LEDGER_MODELS, fan_out, fan_out_rows, is_sharded, shard_for_id,
+                       use_shard)
 
 # Create your views here.
 
 
+def spans_shards(request, model):
+    # Staff lists of ledger rows cover every user, hence every shard
+    return request.user.is_staff and is_sharded() and model in LEDGER_MODELS
+
+
+class FastListMixin:
+    # Serve unpaginated list responses through the values_list() fast path
+    def list(self, request, *args, **kwargs):
+        if self.paginator is not None:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer_class = self.get_serializer_class()
+        context = self.get_serializer_context()
+        if spans_shards(request, queryset.model):
+            return Response(fan_out_rows(
+                queryset, lambda rows: serialize_rows(serializer_class, rows, context)))
+        return Response(serialize_rows(serializer_class, queryset, context))
+
+
+class ShardedObjectMixin:
+    # Ledger ids name their shard, so look the object up there rather than
+    # on the requesting user's shard
+    def dispatch(self, request, *args, **kwargs):
+        with use_shard(shard_for_id(kwargs.get(self.lookup_url_kwarg or self.lookup_field))):
+            return super().dispatch(request, *args, **kwargs)
+
+
+class FilteredListMixin:
+    # Query parameter filters, ?ordering= and ?fields=a,b to trim each row
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        fields = self.request.query_params.get('fields') if self.request else None
+        if fields and self.request.method == 'GET':
+            context['fields'] = fields.split(',')
+        return context
+
+
 @api_view(['Get'])
 def endpoints(request):
     data = [
@@ -34,12 +97,24 @@ class UserCreateApiView(generics.CreateAPIView):
     serializer_class = UserSerializer
 
 
-class UserListApiView(generics.ListAPIView):
+class UserListApiView(FastListMixin, generics.ListAPIView):
     queryset = CustomUser.objects.all()
     serializer_class = UserSerializer
 
 
 
+class StaffSearchApiView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            limit = 20
+        query = request.query_params.get('q', '')
+        return Response(search(query, max(1, min(limit, 100))))
+
+
 class UserRetrieveUpdateDestroyApiView(generics.RetrieveUpdateDestroyAPIView):
     queryset = CustomUser.objects.all()
     serializer_class = UserSerializer
@@ -88,28 +163,65 @@ class UserProfileRetriveUpdateDestroyApiView(generics.RetrieveUpdateDestroyAPIVi
     serializer_class = UserProfileSerializer
     lookup_field = 'pk'
 
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        context = self.get_serializer_context()
+        data = cached_dashboard(
+            instance.user_id, dashboard_variant(request, instance.pk),
+            lambda: self.get_serializer(instance, context=context).data,
+            # A valuation made before any price was known is not kept
+            cacheable=lambda: bool(context.get('prices')))
+        return Response(data)
+
+
+class DashboardCacheStatsApiView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(cache_stats())
 
-class WalletListApiView(generics.ListAPIView):
+
+class WalletListApiView(FastListMixin, generics.ListAPIView):
     queryset = Wallet.objects.all()
     serializer_class = WalletSerializer
 
 
-class WalletRetriveUpdateDestroyApiView(generics.RetrieveUpdateDestroyAPIView):
+class WalletRetriveUpdateDestroyApiView(ShardedObjectMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Wallet.objects.all()
     serializer_class = WalletSerializer
     lookup_field = 'pk'
 
 
 
+class WalletBalanceHistoryApiView(ShardedObjectMixin, generics.ListAPIView):
+    serializer_class = WalletDailyBalanceSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        wallets = Wallet.objects.all()
+        if not self.request.user.is_staff:
+            wallets = wallets.filter(user=self.request.user)
+        wallet = generics.get_object_or_404(wallets, pk=self.kwargs['pk'])
+
+        try:
+            days = int(self.request.query_params.get('days', 365))
+        except ValueError:
+            days = 365
+        return balance_history(wallet, max(1, min(days, 366)))
+
+
 class InvestmentListCreateApiView(generics.ListCreateAPIView):
     queryset = Investment.objects.all()
     serializer_class = InvestmentSerializer
 
 
-class InvestmentSubscriptionListCreateApiView(generics.ListCreateAPIView):
+class InvestmentSubscriptionListCreateApiView(FilteredListMixin, FastListMixin,
+                                              generics.ListCreateAPIView):
     queryset = InvestmentSubscription.objects.all()
     serializer_class = InvestmentSubscriptionSerializer
     permission_classes = [IsAuthenticated]
+    filterset_class = InvestmentSubscriptionFilter
+    ordering_fields = SUBSCRIPTION_ORDERING
 
     def post(self, request, *args, **kwargs):
         data = request.data
@@ -147,10 +259,34 @@ class InvestmentSubscriptionListCreateApiView(generics.ListCreateAPIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class TransactionListCreateApiView(generics.ListCreateAPIView):
+class TransactionListCreateApiView(FilteredListMixin, FastListMixin,
+                                   generics.ListCreateAPIView):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
     permission_classes = [IsAuthenticated]
+    filterset_class = TransactionFilter
+    ordering_fields = TRANSACTION_ORDERING
+
+    def list(self, request, *args, **kwargs):
+        if not wants_full_history(request):
+            return super().list(request, *args, **kwargs)
+
+        # ?history=all also returns settled transactions that were archived,
+        # filtered the same way; the merged list is always in id order. The
+        # rows are serialized as instances, so fetch wallet and user along.
+        archived = TransactionFilter(
+            request.query_params,
+            queryset=ArchivedTransaction.objects.select_related('wallet', 'user'),
+            request=request).qs
+        hot = self.filter_queryset(self.get_queryset()).select_related('wallet', 'user')
+        if spans_shards(request, Transaction):
+            transactions = sorted(chain.from_iterable(fan_out(
+                lambda shard: full_transaction_history(hot.using(shard), archived.using(shard))
+            )), key=lambda row: row.id)
+        else:
+            transactions = full_transaction_history(hot, archived)
+        serializer = self.get_serializer(transactions, many=True)
+        return Response(serializer.data)
 
     def post(self, request, *args, **kwargs):
         data = request.data
@@ -194,7 +330,19 @@ class TransactionListCreateApiView(generics.ListCreateAPIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class TransactionRetrieveUpdateDestroyApiView(generics.RetrieveUpdateDestroyAPIView):
+class TransactionSettleApiView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        serializer = TransactionSettleSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        job = enqueue('transactions.settle', serializer.validated_data, user=request.user)
+        return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class TransactionRetrieveUpdateDestroyApiView(ShardedObjectMixin,
+                                              generics.RetrieveUpdateDestroyAPIView):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
     lookup_field = "pk"
@@ -222,3 +370,169 @@ class TransactionRetrieveUpdateDestroyApiView(generics.RetrieveUpdateDestroyAPIV
 
         self.perform_update(serializer)
         return Response(serializer.data)
+
+
+def projection_window(request):
+    # base.projections pulls in NumPy, so only the projection views import it
+    from .projections import MAX_PROJECTION_DAYS
+    try:
+        days = int(request.query_params.get('days', 30))
+    except ValueError:
+        days = 30
+    return timezone.localdate(), max(1, min(days, MAX_PROJECTION_DAYS))
+
+
+class PortfolioProjectionApiView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        from .projections import (active_subscriptions, load_subscription_columns,
+                                  project_payouts, schedule_rows, to_major)
+        first_day, horizon_days = projection_window(request)
+        columns = load_subscription_columns(
+            active_subscriptions().filter(user=request.user))
+        days, groups, returns, principal = project_payouts(
+            columns, first_day, horizon_days)
+
+        return Response({
+            'total_returns': to_major(returns.sum()),
+            'total_principal': to_major(principal.sum()),
+            'days': schedule_rows(days, returns[0], principal[0]),
+        })
+
+
+class LiabilityForecastApiView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        import numpy as np
+        from .projections import (active_subscriptions, load_subscription_columns,
+                                  project_payouts, schedule_rows, to_major)
+        first_day, horizon_days = projection_window(request)
+        # Every shard's subscriptions, loaded in parallel, as one set of columns
+        shard_columns = fan_out(
+            lambda shard: load_subscription_columns(active_subscriptions()))
+        columns = {name: np.concatenate([part[name] for part in shard_columns])
+                   for name in shard_columns[0]}
+        days, plans, returns, principal = project_payouts(
+            columns, first_day, horizon_days, group_by_plan=True)
+
+        return Response({
+            'total_returns': to_major(returns.sum()),
+            'total_principal': to_major(principal.sum()),
+            'totals': schedule_rows(
+                days, returns.sum(axis=0), principal.sum(axis=0)),
+            'plans': {
+                plan: schedule_rows(days, returns[index], principal[index])
+                for index, plan in enumerate(plans)
+            },
+        })
+
+
+class EventStreamTicketApiView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        return Response({
+            'ticket': issue_stream_ticket(request.user.pk),
+            'expires_in': settings.EVENT_STREAM_TICKET_SECONDS,
+        }, status=status.HTTP_201_CREATED)
+
+
+async def event_stream(request):
+    # A WSGI server would hold a worker for as long as each client stays
+    # connected, so streams are only served through asgi.py
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse('Event streams are only served over ASGI.',
+                            status=status.HTTP_501_NOT_IMPLEMENTED, content_type='text/plain')
+    # EventSource cannot send headers, so it may authenticate with a
+    # single-use ?ticket= from POST /api/events/ticket/ instead
+    ticket = request.GET.get('ticket')
+    if ticket:
+        user_id = await redeem_stream_ticket(ticket)
+    else:
+        user_id = await sync_to_async(request_user_id)(request)
+    if user_id is None:
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+
+    async def stream():
+        # Subscribe from inside the generator so events are delivered to
+        # the event loop that actually streams the response.
+        subscription = get_broker().subscribe(user_id)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.get(), settings.EVENT_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield encode_event(event)
+        finally:
+            get_broker().unsubscribe(subscription)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class JobListCreateApiView(generics.ListCreateAPIView):
+    serializer_class = JobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        jobs = Job.objects.order_by('-id')
+        if not self.request.user.is_staff:
+            jobs = jobs.filter(user=self.request.user)
+        return jobs
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            return Response({"error": "Only staff can queue jobs"}, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            job = enqueue(
+                serializer.validated_data['job_type'],
+                serializer.validated_data.get('payload'),
+                user=request.user,
+                priority=serializer.validated_data.get('priority', 0),
+                max_attempts=serializer.validated_data.get('max_attempts', 3),
+            )
+        except ValueError as error:
+            return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class JobRetrieveApiView(generics.RetrieveAPIView):
+    serializer_class = JobSerializer
+    permission_classes = [IsAuthenticated]
+    lookup_field = 'pk'
+
+    def get_queryset(self):
+        jobs = Job.objects.all()
+        if not self.request.user.is_staff:
+            jobs = jobs.filter(user=self.request.user)
+        return jobs
+
+
+class ProfileListApiView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(list_profiles())
+
+
+class ProfileDownloadApiView(APIView):
+    # ?raw=1 downloads the cProfile dump instead of the JSON report
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, profile_id, *args, **kwargs):
+        raw = request.GET.get('raw') == '1'
+        path = profile_path(profile_id, '.prof' if raw else '.json')
+        if path is None:
+            raise Http404
+        return FileResponse(path.open('rb'), as_attachment=True, filename=path.name)
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dynamic_clay_trading_backend.settings')
 
 application = get_asgi_application()
+
+# Periodic jobs only run here when SCHEDULER_AUTOSTART is set
+from base.apscheduler import autostart  # noqa: E402
+
+autostart()
@@ -15,6 +15,7 @@ import dj_database_url
 from environ import Env
 from pathlib import Path
 import os
+import tempfile
 
 env = Env()
 Env.read_env()
@@ -61,9 +62,8 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt.token_blacklist',
     'captcha',
     'cloudinary_storage',
-    'cloudinary',
     'corsheaders',
-    'django_apscheduler',
+    'django_filters',
 
     # apps
     'base',
@@ -73,18 +73,31 @@ AUTH_USER_MODEL = 'base.CustomUser'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'base.middleware.CompressionMiddleware',
 
     "whitenoise.middleware.WhiteNoiseMiddleware",
     'corsheaders.middleware.CorsMiddleware',
 
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    # The stock session, CSRF, auth, message and frame-option middleware,
+    # except for LEAN_API_PATHS
+    'base.middleware.LeanSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'base.middleware.LeanCsrfViewMiddleware',
+    'base.middleware.LeanAuthenticationMiddleware',
+    'base.middleware.LeanMessageMiddleware',
+    'base.middleware.LeanXFrameOptionsMiddleware',
+    # After authentication, so session users are pinned too
+    'base.middleware.ReplicaPinningMiddleware',
+    'base.middleware.ShardRoutingMiddleware',
+    'base.middleware.AuditContextMiddleware',
+    'base.middleware.RequestProfilingMiddleware',
 ]
 
+# Path prefixes the SPA calls with bearer tokens only. They skip the session,
+# CSRF, message and frame-option middleware and session authentication;
+# everything else (the admin) keeps them.
+LEAN_API_PATHS = env.list('LEAN_API_PATHS', default=['/api/'])
+
 ROOT_URLCONF = 'dynamic_clay_trading_backend.urls'
 
 TEMPLATES = [
@@ -128,6 +141,117 @@ if ENVIRONMENT == 'production' or POSTGRES_LOCALLY == True:
         }
     }
 
+# Read replicas, given as database URLs (e.g. postgres://... or
+# sqlite:////path/to/replica.sqlite3). Reads are spread across them while
+# writes, and reads for REPLICA_PIN_SECONDS after a user's write, go to the
+# primary. Those pins are kept in the cache, which must then be shared by
+# every process (checked as base.E001).
+DATABASE_REPLICAS = []
+for index, replica_url in enumerate(env.list('DB_REPLICA_URLS', default=[]), start=1):
+    alias = f'replica{index}'
+    DATABASES[alias] = dj_database_url.parse(replica_url)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+REPLICA_PIN_SECONDS = env.int('REPLICA_PIN_SECONDS', default=5)
+
+# Extra shards for user-owned ledger data (wallets, transactions and
+# subscriptions), as database URLs (e.g. sqlite:////path/to/shard1.sqlite3).
+# 'default' is always the first shard and keeps everything else, including
+# the directory of which shard each user is on; see base.sharding. Shard n
+# hands out ledger ids from n * SHARD_ID_SPAN on. The test suite always runs
+# sharded, see test_settings.
+DATABASE_SHARDS = ['default']
+SHARD_URLS = env.list('DB_SHARD_URLS', default=[])
+for index, shard_url in enumerate(SHARD_URLS, start=1):
+    alias = f'shard{index}'
+    DATABASES[alias] = dj_database_url.parse(shard_url)
+    DATABASE_SHARDS.append(alias)
+SHARD_ID_SPAN = env.int('SHARD_ID_SPAN', default=10 ** 12)
+# How long shard_for_user() trusts its cached directory lookups; changes to
+# the directory drop them straight away
+USER_SHARD_CACHE_SECONDS = env.int('USER_SHARD_CACHE_SECONDS', default=3600)
+
+DATABASE_ROUTERS = ['base.sharding.ShardRouter', 'base.db_routers.PrimaryReplicaRouter']
+
+# Settled transactions older than this move to the archive table
+TRANSACTION_ARCHIVE_AFTER_DAYS = env.int(
+    'TRANSACTION_ARCHIVE_AFTER_DAYS', default=90)
+TRANSACTION_ARCHIVE_BATCH_SIZE = env.int(
+    'TRANSACTION_ARCHIVE_BATCH_SIZE', default=1000)
+
+# Matured subscriptions paid back into wallets per settlement transaction
+SUBSCRIPTION_SETTLEMENT_BATCH_SIZE = env.int(
+    'SUBSCRIPTION_SETTLEMENT_BATCH_SIZE', default=500)
+
+# 'lazy' computes subscription returns on read and stores them at settlement;
+# 'eager' has the daily accrual job store them on every active subscription
+ACCRUAL_MODE = env('ACCRUAL_MODE', default='lazy')
+
+# Server-sent events (/api/events/, only served through asgi.py; WSGI
+# requests get a 501). The local broker only reaches clients connected to
+# the publishing process. Browsers connect with a single-use ticket from
+# POST /api/events/ticket/, kept in the cache for EVENT_STREAM_TICKET_SECONDS.
+EVENT_BROKER = env('EVENT_BROKER', default='base.events.LocalBroker')
+EVENT_STREAM_KEEPALIVE_SECONDS = 15
+EVENT_STREAM_MAX_QUEUED = 100
+EVENT_STREAM_TICKET_SECONDS = env.int('EVENT_STREAM_TICKET_SECONDS', default=30)
+
+# Database-backed job queue, worked by `manage.py run_jobs`
+JOB_RETRY_BACKOFF_SECONDS = env.int('JOB_RETRY_BACKOFF_SECONDS', default=10)
+JOB_LOCK_TIMEOUT_SECONDS = env.int('JOB_LOCK_TIMEOUT_SECONDS', default=3600)
+# How often a running job refreshes its lock; well below the timeout above
+JOB_HEARTBEAT_SECONDS = env.int('JOB_HEARTBEAT_SECONDS', default=60)
+JOB_CLAIM_CANDIDATES = 10
+# How often each worker requeues the jobs of workers that died mid-run
+JOB_RELEASE_STALE_SECONDS = env.int('JOB_RELEASE_STALE_SECONDS', default=60)
+# Most transactions one POST /api/transaction/settle/ may queue
+TRANSACTION_SETTLE_MAX_IDS = env.int('TRANSACTION_SETTLE_MAX_IDS', default=10000)
+
+# How many past days the nightly wallet balance rollup fills in
+WALLET_ROLLUP_CATCHUP_DAYS = env.int('WALLET_ROLLUP_CATCHUP_DAYS', default=3)
+
+# Run the periodic jobs inside each web server process instead of a separate
+# `manage.py run_scheduler` process
+SCHEDULER_AUTOSTART = env.bool('SCHEDULER_AUTOSTART', default=False)
+
+# Shared by every process when set (e.g. CACHE_URL=pymemcache://127.0.0.1:11211);
+# the per-process default is only right for a single process.
+CACHES = {'default': env.cache('CACHE_URL', default='locmemcache://')}
+
+# Per-user dashboard (GET /api/user_profile/<pk>/) cache
+DASHBOARD_CACHE_SECONDS = env.int('DASHBOARD_CACHE_SECONDS', default=300)
+DASHBOARD_CACHE_LOCK_SECONDS = 10
+# How long a miss waits for another request's render before doing its own
+DASHBOARD_CACHE_WAIT_SECONDS = 0.5
+
+# USD prices for wallet valuations (base.prices). Stale prices are refreshed
+# in the background; the last known prices are served meanwhile. Outside
+# production, and always in tests, the stub provider serves
+# PRICE_FEED_STUB_PRICES.
+PRICE_FEED_PROVIDER = env('PRICE_FEED_PROVIDER', default=(
+    'base.prices.CoinGeckoPriceProvider' if ENVIRONMENT == 'production'
+    else 'base.prices.StubPriceProvider'))
+PRICE_FEED_TTL_SECONDS = env.int('PRICE_FEED_TTL_SECONDS', default=60)
+PRICE_FEED_RETRY_SECONDS = 10
+PRICE_FEED_TIMEOUT_SECONDS = 5
+PRICE_FEED_STUB_PRICES = {'USDT': '1.00', 'BNB': '600.00'}
+
+# Balance audit trail (base.audit): entries are buffered in memory and written
+# in batches; a full buffer is written synchronously
+AUDIT_BUFFER_SIZE = env.int('AUDIT_BUFFER_SIZE', default=5000)
+AUDIT_FLUSH_SIZE = 500
+AUDIT_FLUSH_SECONDS = env.float('AUDIT_FLUSH_SECONDS', default=2.0)
+
+# Staff request profiles (X-Profile: 1); only the newest PROFILE_KEEP are kept
+PROFILE_DIR = env('PROFILE_DIR', default=os.path.join(
+    tempfile.gettempdir(), 'dynamic_clay_profiles'))
+PROFILE_KEEP = env.int('PROFILE_KEEP', default=50)
+
+# Columnar snapshots of settled transactions and subscriptions for finance
+# reports (manage.py export_snapshots / snapshot_report)
+SNAPSHOT_DIR = env('SNAPSHOT_DIR', default=os.path.join(BASE_DIR, 'snapshots'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -149,11 +273,21 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.SessionAuthentication',
+        'base.authentication.SessionAuthentication',
         'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'base.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
+# Response compression (base.middleware.CompressionMiddleware); brotli is
+# preferred when the client accepts it and the package is installed.
+RESPONSE_COMPRESSION_MIN_BYTES = 1024
+RESPONSE_COMPRESSION_GZIP_LEVEL = 6
+RESPONSE_COMPRESSION_BROTLI_QUALITY = 4
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
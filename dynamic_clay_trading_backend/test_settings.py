@@ -0,0 +1,17 @@
+"""
+Settings for the test suite, which `manage.py test` uses by default.
+
+The suite always runs sharded: without DB_SHARD_URLS it gets two SQLite
+shards (in memory, as test databases). Prices always come from the stub
+provider.
+"""
+from .settings import *
+
+if not SHARD_URLS:
+    for index in (1, 2):
+        alias = f'shard{index}'
+        DATABASES[alias] = dj_database_url.parse(
+            f'sqlite:///{BASE_DIR / f"test_shard{index}.sqlite3"}')
+        DATABASE_SHARDS.append(alias)
+
+PRICE_FEED_PROVIDER = 'base.prices.StubPriceProvider'
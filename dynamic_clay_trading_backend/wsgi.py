@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dynamic_clay_trading_backend.settings')
 
 application = get_wsgi_application()
+
+# Periodic jobs only run here when SCHEDULER_AUTOSTART is set
+from base.apscheduler import autostart  # noqa: E402
+
+autostart()